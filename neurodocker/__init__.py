@@ -10,9 +10,10 @@ from neurodocker._version import __version__
 
 __version__ = __version__
 
-# Register neurodocker templates
+# Register neurodocker templates. Templates are only indexed here, and each one is
+# loaded and validated the first time it is used.
 # TODO: remove registration from the `generate` cli. otherwise we register twice.
 for template_path in (Path(__file__).parent / "templates").glob("*.yaml"):
-    reproenv.register_template(template_path)
+    reproenv.index_template(template_path)
 
 del template_path, Path
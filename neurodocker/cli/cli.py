@@ -1,10 +1,62 @@
+import importlib
+import importlib.util
+from typing import Optional
+
 import click
 
 from neurodocker import __version__
 from neurodocker.cli.generate import generate, genfromjson
 
 
-@click.group()
+# https://click.palletsprojects.com/en/8.1.x/complex/#lazily-loading-subcommands
+class LazyGroup(click.Group):
+    """Subclass of `click.Group` that imports some of its commands only when they are
+    used.
+
+    `lazy_subcommands` maps command names to the import paths and short help of the
+    commands, like `{"minify": ("neurodocker.cli.minify.trace.minify", "Minify.")}`.
+    The short help is used in the help of this group, so that showing the help does not
+    import the commands.
+    """
+
+    def __init__(
+        self, *args, lazy_subcommands: dict[str, tuple[str, str]] = None, **kwds
+    ):
+        super().__init__(*args, **kwds)
+        self.lazy_subcommands = {} if lazy_subcommands is None else lazy_subcommands
+
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted([*super().list_commands(ctx), *self.lazy_subcommands])
+
+    def get_command(self, ctx: click.Context, name: str) -> Optional[click.Command]:
+        if name in self.lazy_subcommands:
+            return self._lazy_load(name)
+        return super().get_command(ctx, name)
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter):
+        rows: list[tuple[str, str]] = []
+        for name in self.list_commands(ctx):
+            if name in self.lazy_subcommands:
+                rows.append((name, self.lazy_subcommands[name][1]))
+                continue
+            command = self.get_command(ctx, name)
+            if command is None or command.hidden:
+                continue
+            limit = formatter.width - 6 - len(name)
+            rows.append((name, command.get_short_help_str(limit)))
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+    def _lazy_load(self, name: str) -> click.Command:
+        module_name, command_name = self.lazy_subcommands[name][0].rsplit(".", 1)
+        command = getattr(importlib.import_module(module_name), command_name)
+        if not isinstance(command, click.Command):
+            raise ValueError(f"lazy loading of '{name}' did not return a command")
+        return command
+
+
+@click.group(cls=LazyGroup)
 @click.version_option(__version__, message="%(prog)s version %(version)s")
 def cli():
     """Generate custom containers, and minify existing containers."""
@@ -12,31 +64,31 @@ def cli():
 
 cli.add_command(generate)
 cli.add_command(genfromjson)
+cli.lazy_subcommands["prefetch"] = (
+    "neurodocker.cli.prefetch.prefetch",
+    "Download the files of a container specification.",
+)
 
 
 def _arm_on_mac() -> bool:
     """Return True if on an ARM processor (M1/M2) in macos operating system."""
     import platform
 
+    # Check the system first, because `platform.processor()` can start a subprocess.
     is_mac = platform.system().lower() == "darwin"
-    is_arm = platform.processor().lower() == "arm"
-    return is_mac and is_arm
+    return is_mac and platform.processor().lower() == "arm"
 
 
-# If dockerpy is installed, the Docker client can be instantiated, and if we are not
-# running on an ARM-based mac computer, then we add the minification command.
-# See https://github.com/docker/for-mac/issues/5191 for more information about why
-# we skip ARM-based macs.
+# If dockerpy is installed and we are not running on an ARM-based mac computer, then we
+# add the minification command. See https://github.com/docker/for-mac/issues/5191 for
+# more information about why we skip ARM-based macs.
 #
-# `docker-py` is required for minification but is not installed by default.
-# We also pass if there is an error retrieving the Docker client.
-# Say, for example, the Docker engine is not running (or it is not installed).
-try:
-    from neurodocker.cli.minify.trace import minify
-
-    if not _arm_on_mac():
-        cli.add_command(minify)
-except (ImportError, RuntimeError):
-    # TODO: should we log a debug message? We don't even have a logger at the
-    # time of writing, so probably not.
-    pass
+# `docker-py` is required for minification but is not installed by default. The
+# minification module (and docker-py) is only imported when `minify` is used, and the
+# Docker client is only created when `minify` runs, so that other commands do not pay
+# for connecting to the Docker Engine.
+if importlib.util.find_spec("docker") is not None and not _arm_on_mac():
+    cli.lazy_subcommands["minify"] = (
+        "neurodocker.cli.minify.trace.minify",
+        "Minify a container.",
+    )
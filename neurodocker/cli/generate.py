@@ -7,31 +7,40 @@
 
 from __future__ import annotations
 
+import copy
 import json as json_lib
 import sys
 import typing as ty
 from pathlib import Path
-from typing import IO, Any, Optional, Type, cast
+from typing import IO, Any, Iterable, Optional, Type, cast
 
 import click
 
-from neurodocker.reproenv.renderers import (
-    DockerRenderer,
-    SingularityRenderer,
-    _Renderer,
-)
+from neurodocker.reproenv.optimize import optimization_levels
 from neurodocker.reproenv.state import (
+    _TemplateRegistry,
     get_template,
-    register_template,
+    index_template,
     registered_templates,
-    registered_templates_items,
 )
 from neurodocker.reproenv.template import Template
-from neurodocker.reproenv.types import allowed_pkg_managers
+from neurodocker.reproenv.types import (
+    allowed_pkg_managers,
+    allowed_spec_encodings,
+    spec_encodings_type,
+)
 
 if ty.TYPE_CHECKING:
     from click.parser import ParsingState
 
+    # The renderers (and jinja2) are only imported when a container is generated, so
+    # that `neurodocker --help` and shell completion do not import them.
+    from neurodocker.reproenv.renderers import _Renderer
+
+
+# Key in `click.Context.meta` of the arguments passed to a `generate` subcommand.
+_SUBCOMMAND_ARGS_KEY = "neurodocker.generate.subcommand_args"
+
 
 class GroupAddCommonParamsAndRegisteredTemplates(click.Group):
     """Subclass of `click.Group` that adds parameters common to `reproenv generate`
@@ -54,6 +63,14 @@ class GroupAddCommonParamsAndRegisteredTemplates(click.Group):
             )
         ]
 
+    def resolve_command(
+        self, ctx: click.Context, args: list[str]
+    ) -> tuple[Optional[str], Optional[click.Command], list[str]]:
+        # Remember the arguments passed to the subcommand, so that `.get_command()` only
+        # adds options for the templates that are used.
+        ctx.meta[_SUBCOMMAND_ARGS_KEY] = args[1:]
+        return super().resolve_command(ctx, args)
+
     def get_command(self, ctx: click.Context, name: str) -> Optional[click.Command]:
         command = self.commands.get(name)
         if command is None:
@@ -69,20 +86,28 @@ class GroupAddCommonParamsAndRegisteredTemplates(click.Group):
                 yamls.extend(path.glob(pattern))
         # TODO: log warning if no yamls are found?
         for path in yamls:
-            _ = register_template(path)
-
-        params: list[click.Parameter] = [
-            click.Option(
-                ["-p", "--pkg-manager"],
-                type=click.Choice(list(allowed_pkg_managers), case_sensitive=False),
-                required=True,
-                multiple=False,
-                help="System package manager",
-            )
+            _ = index_template(path)
+
+        # Building the help of a template option requires loading the template, so
+        # only do that if the help of the subcommand is requested. Otherwise, only add
+        # options for the templates in the command line. When listing the subcommands
+        # or completing the command line, add options for all templates without help.
+        args: Optional[list[str]] = ctx.meta.get(_SUBCOMMAND_ARGS_KEY)
+        names: Optional[set[str]] = None
+        with_help = False
+        if args is not None and not ctx.resilient_parsing:
+            if any(arg in ctx.help_option_names for arg in args):
+                with_help = True
+            else:
+                names = _get_template_names_in_args(args)
+
+        # Do not modify the registered command, so the group can be invoked many times.
+        command = copy.copy(command)
+        command.params = [
+            *command.params,
+            *_get_common_renderer_params(),
+            *_get_params_for_registered_templates(names=names, with_help=with_help),
         ]
-        params = _get_common_renderer_params()
-        params += _get_params_for_registered_templates()
-        command.params += params
         return command
 
 
@@ -192,6 +217,18 @@ class KeyValuePair(click.ParamType):
             return fn(value)
 
 
+# Attributes of the `--spec-encoding` option of `generate` and `genfromjson`.
+_SPEC_ENCODING_OPTION_ATTRS: dict[str, Any] = dict(
+    type=click.Choice(sorted(allowed_spec_encodings), case_sensitive=False),
+    default="printf",
+    show_default=True,
+    help=(
+        "How the JSON specification is saved in the container. 'gzip' embeds compact,"
+        " compressed JSON on one line."
+    ),
+)
+
+
 def _get_common_renderer_params() -> list[click.Parameter]:
     params: list[click.Parameter] = [
         click.Option(
@@ -266,6 +303,50 @@ def _get_common_renderer_params() -> list[click.Parameter]:
         ),
         click.Option(["--workdir"], multiple=True, help="Set the working directory"),
         click.Option(["--yes"], is_flag=True, help="Reply yes to all prompts."),
+        click.Option(["--spec-encoding"], **_SPEC_ENCODING_OPTION_ATTRS),
+        click.Option(
+            ["--label-fingerprint"],
+            is_flag=True,
+            help="Add the fingerprint of the container specification as a label.",
+        ),
+        OptionEatAll(
+            ["--mirror"],
+            multiple=True,
+            type=KeyValuePair(),
+            help=(
+                "Download binaries and deb packages from a mirror. Use prefix=replacement"
+                " to replace the prefix of URLs, like"
+                " https://fsl.fmrib.ox.ac.uk=http://cache.local/fsl.fmrib.ox.ac.uk"
+            ),
+        ),
+        click.Option(
+            ["--hoist-dependencies"],
+            is_flag=True,
+            help=(
+                "Install the system dependencies of all templates in one step, after"
+                " the base image, instead of in each template."
+            ),
+        ),
+        click.Option(
+            ["--optimize"],
+            type=click.IntRange(min(optimization_levels), max(optimization_levels)),
+            default=0,
+            show_default=True,
+            help=(
+                "Optimization level. 1 merges adjacent ENV and LABEL instructions and"
+                " removes redundant USER and WORKDIR instructions. 2 also moves labels"
+                " to the end of each stage and merges adjacent RUN instructions."
+            ),
+        ),
+        click.Option(
+            ["--fingerprint"],
+            is_flag=True,
+            help=(
+                "Output the fingerprint of the container specification. Containers"
+                " generated with the same instructions and templates have the same"
+                " fingerprint."
+            ),
+        ),
         click.Option(
             ["--json"],
             is_flag=True,
@@ -306,15 +387,37 @@ def _create_help_for_template(template: Template) -> str:
     return h
 
 
-def _get_params_for_registered_templates() -> list[click.Parameter]:
-    """Return list of click parameters for registered templates."""
+def _get_template_names_in_args(args: list[str]) -> set[str]:
+    """Return names of registered templates that are used as options in `args`."""
+    options = {arg[2:].split("=", 1)[0].lower() for arg in args if arg.startswith("--")}
+    return options.intersection(registered_templates())
+
+
+def _get_params_for_registered_templates(
+    names: Optional[Iterable[str]] = None, with_help: bool = True
+) -> list[click.Parameter]:
+    """Return list of click parameters for registered templates.
+
+    Parameters
+    ----------
+    names : iterable of str
+        Names of the templates for which to return parameters. If None, return
+        parameters for all registered templates.
+    with_help : bool
+        If True, add help messages to the parameters. This loads the templates.
+    """
     params: list[click.Parameter] = []
-    names_tmpls = list(registered_templates_items())
-    names_tmpls.sort(key=lambda r: r[0])  # sort by name
-    for name, tmpl in names_tmpls:
+    if names is None:
+        names = registered_templates()
+    for name in sorted(names):
         if name.startswith("_"):  # Templates starting with _ are private
             continue
-        hlp = _create_help_for_template(Template(tmpl))
+        hlp = None
+        if with_help:
+            # The help message is stored in the on-disk template cache.
+            hlp = _TemplateRegistry.derived(
+                name, "cli_help", lambda t: _create_help_for_template(Template(t))
+            )
         param = OptionEatAll(
             [f"--{name.lower()}"], type=KeyValuePair(), multiple=True, help=hlp
         )
@@ -439,10 +542,15 @@ def generate(*, template_path):
 
 
 def _base_generate(
-    ctx: click.Context, renderer: Type[_Renderer], pkg_manager: str, **kwds
+    ctx: click.Context,
+    renderer: Type[_Renderer],
+    pkg_manager: str,
+    renderer_kwds: Optional[dict[str, Any]] = None,
+    **kwds,
 ):
     """Function that does all of the work of `generate docker` and
     `generate singularity`. The difference between those two is the renderer used.
+    `renderer_kwds` are options of the renderer that only one of them has.
     """
     renderer_dict = _params_to_renderer_dict(ctx=ctx, pkg_manager=pkg_manager)
 
@@ -457,7 +565,15 @@ def _base_generate(
                 {"name": "entrypoint", "kwds": {"args": ["/neurodocker/startup.sh"]}}
             )
 
-    r = renderer.from_dict(renderer_dict)
+    r = renderer.from_dict(
+        renderer_dict,
+        hoist_dependencies=kwds["hoist_dependencies"],
+        optimize=kwds["optimize"],
+        spec_encoding=kwds["spec_encoding"],
+        label_fingerprint=kwds["label_fingerprint"],
+        mirrors=dict(pair for pairs in kwds["mirror"] for pair in pairs),
+        **(renderer_kwds or {}),
+    )
 
     # Print the instructions in JSON if that's what the user wants.
     # We get the JSON instructions from the renderer itself -- rather than the
@@ -472,18 +588,52 @@ def _base_generate(
         click.echo(r.to_json())
         ctx.exit(0)
 
-    output = str(r)
-    click.echo(output)
+    if kwds.get("fingerprint", False):
+        click.echo(r.fingerprint())
+        ctx.exit(0)
+
+    # Write the container specification in chunks instead of building the full
+    # string first.
+    r.render_to(sys.stdout)
+    click.echo()
 
 
 @generate.command(cls=OrderedParamsCommand)
+@click.option(
+    "--buildkit-cache",
+    is_flag=True,
+    help=(
+        "Keep apt, yum, conda and pip caches in BuildKit cache mounts, so that"
+        " packages are not downloaded again when the image is rebuilt."
+    ),
+)
+@click.option(
+    "--multistage",
+    is_flag=True,
+    help=(
+        "Install self-contained templates in separate builder stages, and copy their"
+        " installation directories into the image. BuildKit builds these stages in"
+        " parallel."
+    ),
+)
 @click.pass_context
-def docker(ctx: click.Context, pkg_manager: str, **kwds):
+def docker(
+    ctx: click.Context,
+    pkg_manager: str,
+    buildkit_cache: bool,
+    multistage: bool,
+    **kwds,
+):
     """Generate a Dockerfile."""
+    from neurodocker.reproenv.renderers import DockerRenderer
+
+    if multistage and kwds["optimize"]:
+        ctx.fail("--multistage cannot be used with --optimize")
     _base_generate(
         ctx=ctx,
         renderer=DockerRenderer,
         pkg_manager=pkg_manager,
+        renderer_kwds={"buildkit_cache": buildkit_cache, "multistage": multistage},
         **kwds,
     )
 
@@ -492,6 +642,8 @@ def docker(ctx: click.Context, pkg_manager: str, **kwds):
 @click.pass_context
 def singularity(ctx: click.Context, pkg_manager: str, **kwds):
     """Generate a Singularity recipe."""
+    from neurodocker.reproenv.renderers import SingularityRenderer
+
     _base_generate(
         ctx=ctx,
         renderer=SingularityRenderer,
@@ -511,11 +663,14 @@ def singularity(ctx: click.Context, pkg_manager: str, **kwds):
     type=click.File("r"),
     default=sys.stdin,
 )
-def genfromjson(*, container_type: str, input: IO):
+@click.option("--spec-encoding", **_SPEC_ENCODING_OPTION_ATTRS)
+def genfromjson(*, container_type: str, input: IO, spec_encoding: spec_encodings_type):
     """Generate a container from a ReproEnv JSON file.
 
     INPUT is standard input by default or a path to a JSON file.
     """
+    from neurodocker.reproenv.renderers import DockerRenderer, SingularityRenderer
+
     d = json_lib.load(input)
 
     renderer: Type[_Renderer]
@@ -524,6 +679,6 @@ def genfromjson(*, container_type: str, input: IO):
     elif container_type.lower() == "singularity":
         renderer = SingularityRenderer
 
-    r = renderer.from_dict(d)
-    spec = str(r)
-    click.echo(spec)
+    r = renderer.from_dict(d, spec_encoding=spec_encoding)
+    r.render_to(sys.stdout)
+    click.echo()
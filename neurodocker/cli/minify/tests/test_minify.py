@@ -1,18 +1,37 @@
+import gc
 from pathlib import Path
 
 import pytest
 from click.testing import CliRunner
 
 from neurodocker.cli.cli import _arm_on_mac
-from neurodocker.cli.minify.trace import minify
 
 docker = pytest.importorskip("docker", reason="docker-py not found")
 
+from neurodocker.cli.minify.trace import _get_client, minify  # noqa: E402
+
 skip_arm_on_mac = pytest.mark.skipif(
     _arm_on_mac(), reason="minification does not work on M1/M2 macs"
 )
 
 
+# docker-py leaves a socket open when it cannot connect to the Docker Engine.
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnraisableExceptionWarning")
+def test_minify_no_docker_engine(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{tmp_path / 'docker.sock'}")
+    _get_client.cache_clear()
+    try:
+        runner = CliRunner()
+        result = runner.invoke(
+            minify, ["--container", "foobar", "--dir", "/usr/local", "ls"]
+        )
+    finally:
+        _get_client.cache_clear()
+        gc.collect()
+    assert result.exit_code != 0
+    assert "Could not communicate with the Docker Engine" in result.output
+
+
 @skip_arm_on_mac
 def test_minify():
     client = docker.from_env()
@@ -9,6 +9,7 @@ by the given command(s).
 
 from __future__ import annotations
 
+import functools
 import io
 import logging
 import tarfile
@@ -24,19 +25,28 @@ except ImportError:
         "The `docker` Python package is required for minification functions."
     )
 
-try:
-    client = docker.from_env()
-    if not client.ping():
-        raise RuntimeError("Could not communicate with the Docker Engine.")
-except docker.errors.DockerException:
-    raise RuntimeError("Could not create a Docker client.")
-
 logger = logging.getLogger(__name__)
 
 _trace_script = Path(__file__).parent / "_trace.sh"
 _prune_script = Path(__file__).parent / "_prune.py"
 
 
+@functools.lru_cache(maxsize=None)
+def _get_client() -> docker.DockerClient:
+    """Return a Docker client. It is created when first needed, so that importing this
+    module does not require a running Docker Engine.
+    """
+    try:
+        client = docker.from_env()
+        if not client.ping():
+            raise docker.errors.DockerException("no response to ping")
+    except docker.errors.DockerException as e:
+        raise click.ClickException(
+            f"Could not communicate with the Docker Engine. Is it running? ({e})"
+        ) from e
+    return client
+
+
 def copy_file_to_container(
     container: str | docker.models.containers.Container,
     src: str | Path,
@@ -61,7 +71,7 @@ def copy_file_to_container(
     src = Path(src)
     dest = Path(dest)
     if not isinstance(container, docker.models.containers.Container):
-        container = client.containers.get(container)
+        container = _get_client().containers.get(container)
     # https://gist.github.com/zbyte64/6800eae10ce082bb78f0b7a2cca5cbc2
     with io.BytesIO() as tar_stream:
         with tarfile.TarFile(fileobj=tar_stream, mode="w") as tar:
@@ -82,7 +92,7 @@ def _get_mounts(container: docker.models.containers.Container) -> dict:
     #         "Propagation": "rprivate",
     #     }
     # ]
-    return client.api.inspect_container(container)["Mounts"]
+    return _get_client().api.inspect_container(container)["Mounts"]
 
 
 @click.command()
@@ -119,6 +129,7 @@ def minify(
         --dir /usr/local \\
         "python -c 'a = 1 + 1; print(a)'"
     """
+    client = _get_client()
     container = client.containers.get(container)
     container = cast(docker.models.containers.Container, container)
 
@@ -0,0 +1,173 @@
+"""Download the files that a container specification downloads, so that they can be
+served from a local mirror (see `neurodocker generate --mirror`).
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import hashlib
+import json
+import posixpath
+import re
+import shutil
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path, PurePosixPath
+from typing import IO, Mapping
+
+import click
+
+from neurodocker.reproenv.renderers import DockerRenderer
+
+# Commands that download files. URLs are only collected from lines with these commands,
+# so that URLs in comments and `git clone` are skipped.
+_DOWNLOAD_COMMAND_RE = re.compile(r"\b(?:curl|wget)\b")
+_URL_RE = re.compile(r"""https?://[^\s'"`|;&()<>]+""")
+
+
+def get_urls(d: Mapping) -> list[str]:
+    """Return the URLs of the files that the renderer dictionary `d` downloads.
+
+    Templates in `d` are rendered, so URLs are collected from the commands of the
+    templates and from `add` instructions. URLs that contain shell variables are
+    skipped, because they are only known when the container is built.
+    """
+    renderer = DockerRenderer.from_dict(d)
+    urls: dict[str, None] = {}  # Ordered set.
+    for instruction in renderer._instructions["instructions"]:
+        name, kwds = instruction["name"], instruction["kwds"]
+        if name == "add":
+            candidates = _URL_RE.findall(str(kwds["source"]))
+        elif name == "run":
+            candidates = [
+                url
+                for line in kwds["command"].splitlines()
+                if not line.lstrip().startswith("#")
+                and _DOWNLOAD_COMMAND_RE.search(line)
+                for url in _URL_RE.findall(line)
+            ]
+        else:
+            continue
+        urls.update(dict.fromkeys(url for url in candidates if "$" not in url))
+    return list(urls)
+
+
+def get_path(url: str) -> PurePosixPath:
+    """Return the path, relative to the destination directory, of the file downloaded
+    from `url`. The path is the host (and port) followed by the path of the URL, so
+    that the destination directory can be served as a mirror of all hosts. If the URL
+    has a query, a hash of the query is added to the name of the file, so that URLs
+    that only differ in their query are saved to different files.
+
+    Raises `ValueError` if the host of `url` is not a valid directory name.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    host = parsed.netloc.rpartition("@")[2]
+    if host in {"", ".", ".."} or "/" in host or "\\" in host:
+        raise ValueError(f"invalid host in URL: '{url}'")
+    parts = [
+        p
+        for p in urllib.parse.unquote(parsed.path).split("/")
+        if p not in {"", ".", ".."}
+    ]
+    if not parts:
+        parts = ["index.html"]
+    if parsed.query:
+        digest = hashlib.sha256(parsed.query.encode()).hexdigest()[:12]
+        stem, ext = posixpath.splitext(parts[-1])
+        parts[-1] = f"{stem}-{digest}{ext}"
+    return PurePosixPath(host, *parts)
+
+
+def download(url: str, path: Path, chunk_size: int = 1 << 20) -> tuple[int, bool]:
+    """Download `url` to `path`, and return the size of the file and whether it was
+    downloaded. Existing files are not downloaded again. Partial downloads are kept in
+    `path` with the suffix `.part`, and are resumed if the server supports ranges.
+    """
+    if path.exists():
+        return path.stat().st_size, False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part = path.with_name(path.name + ".part")
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            # The server sends the whole file if it does not support ranges.
+            mode = "ab" if offset and response.status == 206 else "wb"
+            with open(part, mode) as f:
+                shutil.copyfileobj(response, f, chunk_size)
+    except urllib.error.HTTPError as e:
+        e.close()
+        # The partial download is already complete.
+        if not (e.code == 416 and offset):
+            raise
+    part.replace(path)
+    return path.stat().st_size, True
+
+
+def _format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+@click.command()
+@click.argument("spec", type=click.File("r"))
+@click.option(
+    "--dest",
+    required=True,
+    type=click.Path(file_okay=False, writable=True, path_type=Path),
+    help="Directory to download files to.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of concurrent downloads.",
+)
+def prefetch(*, spec: IO, dest: Path, jobs: int):
+    """Download the files of a container specification.
+
+    SPEC is a JSON container specification, like the output of
+    `neurodocker generate docker --json`. Files are saved in DEST as HOST/PATH, so a
+    web server for DEST can be used as a mirror with `neurodocker generate --mirror`.
+    Downloads that are interrupted are resumed the next time.
+    """
+    urls = get_urls(json.load(spec))
+    if not urls:
+        click.echo("No files to download.")
+        return
+
+    failed = 0
+    total = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for url in urls:
+            try:
+                path = dest / get_path(url)
+            except ValueError as e:
+                failed += 1
+                click.echo(f"failed      {url} ({e})", err=True)
+                continue
+            futures[executor.submit(download, url, path)] = url
+        for future in concurrent.futures.as_completed(futures):
+            url = futures[future]
+            try:
+                size, downloaded = future.result()
+            except (OSError, ValueError) as e:
+                failed += 1
+                click.echo(f"failed      {url} ({e})", err=True)
+                continue
+            total += size
+            status = "downloaded" if downloaded else "exists"
+            click.echo(f"{status:<11} {url} ({_format_size(size)})")
+
+    click.echo(f"{len(urls) - failed} files ({_format_size(total)}) in {dest}")
+    if failed:
+        raise click.ClickException(f"{failed} downloads failed")
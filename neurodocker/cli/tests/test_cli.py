@@ -1,12 +1,18 @@
 # TODO: add tests of individual CLI params.
 
+import json
+import subprocess
+import sys
 from pathlib import Path
 
+import click
 import pytest
 from click.testing import CliRunner
 
 from neurodocker.cli.cli import generate
-from neurodocker.cli.generate import OptionEatAll
+from neurodocker.cli.generate import _SUBCOMMAND_ARGS_KEY, OptionEatAll
+from neurodocker.reproenv.renderers import read_spec
+from neurodocker.reproenv.state import _TemplateRegistry
 
 _cmds = ["docker", "singularity"]
 
@@ -217,3 +223,323 @@ def test_default_header_and_entrypoint(cmd: str, pkg_manager: str, entrypoint: s
             assert "%runscript\n/neurodocker/startup.sh\n" in result.output
         else:
             assert "%runscript\nI decide\n" in result.output
+
+
+@pytest.mark.parametrize("cmd", _cmds)
+def test_spec_encoding(cmd: str):
+    runner = CliRunner()
+    args = [cmd, "--base-image", "debian", "--pkg-manager", "apt", "--run", "echo '%'"]
+    result = runner.invoke(generate, [*args, "--json"])
+    assert result.exit_code == 0, result.output
+    spec = json.loads(result.output)
+
+    for encoding in ["printf", "gzip"]:
+        result = runner.invoke(generate, [*args, "--spec-encoding", encoding])
+        assert result.exit_code == 0, result.output
+        assert ("base64 -d | gunzip" in result.output) == (encoding == "gzip")
+        assert read_spec(result.output) == spec
+
+
+@pytest.mark.parametrize("cmd", _cmds)
+def test_fingerprint(cmd: str):
+    runner = CliRunner()
+    args = [
+        cmd,
+        "--base-image",
+        "debian",
+        "--pkg-manager",
+        "apt",
+        "--jq",
+        "version=1.6",
+    ]
+    result = runner.invoke(generate, [*args, "--fingerprint"])
+    assert result.exit_code == 0, result.output
+    fingerprint = result.output.strip()
+    assert len(fingerprint) == 64
+
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    assert fingerprint not in result.output
+    result = runner.invoke(generate, [*args, "--label-fingerprint"])
+    assert result.exit_code == 0, result.output
+    assert "org.repronim.reproenv.fingerprint" in result.output
+    assert fingerprint in result.output
+
+    # Mirrors do not change the software in the container.
+    mirror = ["--mirror", "https://github.com/=http://mirror/gh/"]
+    result = runner.invoke(generate, [*args, *mirror, "--fingerprint"])
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == fingerprint
+    if cmd == "docker":
+        # Builder stages change the layers of the image.
+        result = runner.invoke(generate, [*args, "--multistage", "--fingerprint"])
+        assert result.exit_code == 0, result.output
+        assert result.output.strip() != fingerprint
+
+
+@pytest.mark.parametrize("pkg_manager", ["apt", "yum"])
+def test_buildkit_cache(pkg_manager: str):
+    runner = CliRunner()
+    args = ["docker", "--base-image", "debian", "--pkg-manager", pkg_manager]
+    args += ["--install", "git", "--miniconda", "version=latest", "pip_install=six"]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    assert "--mount=type=cache" not in result.output
+    assert not result.output.startswith("# syntax=")
+
+    result = runner.invoke(generate, [*args, "--buildkit-cache"])
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith("# syntax=docker/dockerfile:1.6\n")
+    cache = "/var/cache/apt" if pkg_manager == "apt" else "/var/cache/yum"
+    assert f"RUN --mount=type=cache,target={cache},sharing=locked \\\n" in (
+        result.output
+    )
+    assert "--mount=type=cache,target=/root/.cache/pip,sharing=locked" in result.output
+    # Caches are not cleaned up, because they are not saved in the image.
+    assert "rm -rf /var/lib/apt/lists/*" not in result.output
+    assert "yum clean all" not in result.output
+    assert "--no-cache-dir" not in result.output
+    assert "rm -rf ~/.cache/pip/*" not in result.output
+    assert "--mount=type=cache,target=/var/cache/conda/pkgs" in result.output
+
+    # Cache mounts are owned by root, so other users do not use them, and clean up
+    # their caches.
+    args = ["docker", "--base-image", "debian", "--pkg-manager", pkg_manager]
+    args += ["--user", "nonroot", "--miniconda", "version=latest", "pip_install=six"]
+    result = runner.invoke(generate, [*args, "--buildkit-cache"])
+    assert result.exit_code == 0, result.output
+    miniconda = result.output.split("USER nonroot")[1].split("# Save specification")[0]
+    assert "--mount" not in miniconda
+    assert "CONDA_PKGS_DIRS" not in miniconda
+    assert "--no-cache-dir" in miniconda
+    assert "rm -rf ~/.cache/pip/*" in miniconda
+
+
+def test_multistage():
+    runner = CliRunner()
+    args = ["docker", "--base-image", "debian", "--pkg-manager", "apt"]
+    args += ["--ants", "version=2.4.3", "--miniconda", "version=latest"]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    assert "builder" not in result.output
+
+    result = runner.invoke(generate, [*args, "--multistage"])
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith(
+        "# syntax=docker/dockerfile:1.6\n# Generated by Neurodocker and Reproenv.\n\n"
+        "FROM debian AS ants-builder\n"
+    )
+    assert "\n\nFROM debian\n" in result.output
+    assert (
+        "\nCOPY --from=ants-builder --link /opt/ants-2.4.3 /opt/ants-2.4.3\n"
+        in result.output
+    )
+    # Miniconda is not self-contained, so it is installed in the image.
+    assert "miniconda-builder" not in result.output
+
+    # Build dependencies of templates in builder stages are not installed in the
+    # image, and runtime dependencies are installed once.
+    args = ["docker", "--base-image", "debian", "--pkg-manager", "apt"]
+    args += ["--ants", "version=2.4.3", "--dcm2niix", "version=latest"]
+    args += ["--mrtrix3", "version=3.0.4", "--multistage"]
+    for hoist in [[], ["--hoist-dependencies"]]:
+        result = runner.invoke(generate, [*args, *hoist])
+        assert result.exit_code == 0, result.output
+        image = result.output.split("\n\nFROM debian\n")[1]
+        image = image.split("# Save specification")[0]
+        # One install for the default header, and one for the runtime dependencies.
+        assert image.count("apt-get install") == 2
+        runtime = image.split("apt-get install")[2].split("COPY")[0].split()
+        assert "libtiff6" in runtime
+        assert "unzip" not in runtime and "bzip2" not in runtime
+        assert result.output.count("\nFROM debian AS ") == 3
+
+
+@pytest.mark.parametrize("cmd", _cmds)
+def test_optimize(cmd: str):
+    runner = CliRunner()
+    args = [cmd, "--base-image", "debian", "--pkg-manager", "apt"]
+    args += ["--env", "A=1", "--env", "B=2", "--run", "echo 1", "--run", "echo 2"]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    names = [i["name"] for i in read_spec(result.output)["instructions"]]
+    assert names[-5:] == ["env", "env", "run", "run", "entrypoint"]
+
+    result = runner.invoke(generate, [*args, "--optimize", "1"])
+    assert result.exit_code == 0, result.output
+    names = [i["name"] for i in read_spec(result.output)["instructions"]]
+    assert names[-4:] == ["env", "run", "run", "entrypoint"]
+
+    result = runner.invoke(generate, [*args, "--optimize", "2"])
+    assert result.exit_code == 0, result.output
+    names = [i["name"] for i in read_spec(result.output)["instructions"]]
+    assert names[-3:] == ["env", "run", "entrypoint"]
+
+    # Commands are not merged after commands that would join them.
+    loop = [cmd, "--base-image", "debian", "--pkg-manager", "apt"]
+    loop += ["--run", "for f in a b; do echo $f; done;", "--run", "echo b"]
+    result = runner.invoke(generate, [*loop, "--optimize", "2"])
+    assert result.exit_code == 0, result.output
+    names = [i["name"] for i in read_spec(result.output)["instructions"]]
+    assert names[-3:] == ["run", "run", "entrypoint"]
+
+    # Instructions that other instructions add are not replayed twice.
+    install = [
+        cmd,
+        "--base-image",
+        "debian",
+        "--pkg-manager",
+        "apt",
+        "--install",
+        "vim",
+    ]
+    for level in ["0", "1", "2"]:
+        result = runner.invoke(generate, [*install, "--optimize", level])
+        assert result.exit_code == 0, result.output
+        # The default header and vim are installed once, and vim is logged once.
+        assert result.output.count("apt-get install") == 3
+        names = [i["name"] for i in read_spec(result.output)["instructions"]]
+        assert names.count("install") == 1
+        assert names.count("run") == 1
+
+    result = runner.invoke(generate, [*args, "--optimize", "3"])
+    assert result.exit_code != 0
+    if cmd == "docker":
+        result = runner.invoke(generate, [*args, "--optimize", "1", "--multistage"])
+        assert result.exit_code != 0
+        assert "--multistage cannot be used with --optimize" in result.output
+
+
+@pytest.mark.parametrize("cmd", _cmds)
+@pytest.mark.parametrize("pkg_manager", ["apt", "yum"])
+def test_hoist_dependencies(cmd: str, pkg_manager: str):
+    runner = CliRunner()
+    args = [cmd, "--base-image", "debian", "--pkg-manager", pkg_manager]
+    args += ["--ants", "version=2.4.3", "--dcm2niix", "method=source", "version=master"]
+    # The compressed specification does not repeat the instructions.
+    args += ["--miniconda", "version=latest", "--spec-encoding", "gzip"]
+    install = "apt-get install -y" if pkg_manager == "apt" else "yum install -y"
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    assert result.output.count(install) == 4
+
+    result = runner.invoke(generate, [*args, "--hoist-dependencies"])
+    assert result.exit_code == 0, result.output
+    # One install for the default header, and one for all templates.
+    assert result.output.count(install) == 2
+    clean = "rm -rf /var/lib/apt/lists" if pkg_manager == "apt" else "yum clean"
+    hoisted = result.output.split(install)[2].split(clean)[0].split()
+    # Packages are installed once, and not again if the header installs them.
+    assert hoisted.count("git") == 1
+    assert "cmake" in hoisted
+    assert "ca-certificates" not in hoisted
+    spec = read_spec(result.output)
+    assert [i["name"] for i in spec["instructions"]][:4] == [
+        "from_",
+        "env",
+        "run",
+        "run",
+    ]
+
+    # Dependencies are not installed before a `--run` between templates, so ANTs
+    # installs its own dependencies.
+    args[7:7] = ["--run", "echo hi"]
+    result = runner.invoke(generate, [*args, "--hoist-dependencies"])
+    assert result.exit_code == 0, result.output
+    assert result.output.count(install) == 3
+    before, after = result.output.split("echo hi", 1)
+    assert before.count(install) == 2
+    assert after.count(install) == 1
+
+
+@pytest.mark.parametrize("cmd", _cmds)
+def test_mirror(cmd: str):
+    runner = CliRunner()
+    args = [cmd, "--base-image", "debian", "--pkg-manager", "apt"]
+    args += ["--jq", "version=1.6", "--mirror", "https://github.com/=http://mirror/gh/"]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    assert (
+        "http://mirror/gh/jqlang/jq/releases/download/jq-1.6/jq-linux64"
+        in result.output
+    )
+    assert "https://github.com/" not in result.output
+
+
+def test_cli_does_not_import_docker():
+    code = "import sys, neurodocker.cli.cli; print('docker' in sys.modules)"
+    out = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    assert out.stdout.strip() == "False"
+
+
+def test_template_options_only_for_used_templates(monkeypatch: pytest.MonkeyPatch):
+    derived = _TemplateRegistry.derived
+
+    def fail(name, key, func):
+        if key == "cli_help":
+            raise AssertionError("help of template options should not be built")
+        return derived(name, key, func)
+
+    monkeypatch.setattr(_TemplateRegistry, "derived", fail)
+
+    ctx = click.Context(generate)
+    ctx.meta[_SUBCOMMAND_ARGS_KEY] = ["-p", "apt", "--jq", "version=1.6"]
+    command = generate.get_command(ctx, "docker")
+    assert command is not None
+    names = {param.name for param in command.params}
+    assert {"pkg_manager", "from_", "run", "jq"} <= names
+    assert "fsl" not in names
+    # The registered command is not modified.
+    assert [param.name for param in generate.commands["docker"].params] == [
+        "buildkit_cache",
+        "multistage",
+    ]
+
+    runner = CliRunner()
+    result = runner.invoke(
+        generate, ["docker", "-p", "apt", "-b", "debian", "--jq", "version=1.6"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "jq-1.6" in result.output
+
+
+# Modules that lightweight commands must not import, and ceilings for the number of
+# modules imported by neurodocker and for the cumulative import time of the CLI.
+_heavy_modules = {"docker", "jinja2", "jsonschema", "yaml"}
+_max_imported_modules = 100
+_max_import_time_us = 1_000_000
+
+
+@pytest.mark.parametrize("args", [["--version"], ["--help"]])
+def test_lightweight_commands_import_budget(args: list[str]):
+    code = f"""\
+import sys
+before = set(sys.modules)
+from neurodocker.cli.cli import cli
+try:
+    cli({args!r})
+except SystemExit:
+    pass
+print(*sorted(set(sys.modules) - before), sep="\\n")
+"""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    modules = set(out.stdout.splitlines())
+    imported_heavy = {m for m in modules if m.split(".")[0] in _heavy_modules}
+    assert not imported_heavy
+    assert "neurodocker.reproenv.renderers" not in modules
+    assert len(modules) <= _max_imported_modules
+
+    # Lines look like "import time:  self [us] | cumulative | imported package".
+    cumulative = {
+        line.split("|")[2].strip(): int(line.split("|")[1])
+        for line in out.stderr.splitlines()
+        if line.startswith("import time:") and "[us]" not in line
+    }
+    assert cumulative["neurodocker.cli.cli"] <= _max_import_time_us
@@ -0,0 +1,135 @@
+import http.server
+import json
+import threading
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from neurodocker.cli.cli import cli
+from neurodocker.cli.prefetch import get_path, get_urls
+
+_files = {"/jq/jq-linux64": b"jq" * 1000, "/data.tar.gz": b"data" * 1000}
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in _files:
+            self.send_error(404)
+            return
+        body = _files[self.path]
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"][len("bytes=") :].rstrip("-"))
+            if start >= len(body):
+                self.send_error(416)
+                return
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _spec(url: str) -> dict:
+    return {
+        "pkg_manager": "apt",
+        "instructions": [
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            {
+                "name": "run",
+                "kwds": {
+                    "command": (
+                        f"# curl {url}/comment\n"
+                        f"curl -fsSL -o /usr/local/bin/jq {url}/jq/jq-linux64\n"
+                        f"curl -fsSL {url}/$VERSION.tar.gz | tar xz\n"
+                        f"git clone {url}/repo.git"
+                    )
+                },
+            },
+            {
+                "name": "add",
+                "kwds": {"source": f"{url}/data.tar.gz", "destination": "/data"},
+            },
+        ],
+    }
+
+
+def test_get_urls():
+    url = "http://example.com"
+    assert get_urls(_spec(url)) == [f"{url}/jq/jq-linux64", f"{url}/data.tar.gz"]
+
+    spec = {
+        "pkg_manager": "apt",
+        "instructions": [
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            {"name": "install", "kwds": {"pkgs": ["curl"]}},
+            {"name": "jq", "kwds": {"version": "1.6"}},
+        ],
+    }
+    assert get_urls(spec) == [
+        "https://github.com/jqlang/jq/releases/download/jq-1.6/jq-linux64"
+    ]
+
+
+def test_get_path():
+    assert get_path("https://example.com/a/b%20c.tar.gz") == Path(
+        "example.com/a/b c.tar.gz"
+    )
+    assert get_path("https://example.com/../../etc/passwd") == Path(
+        "example.com/etc/passwd"
+    )
+    assert get_path("http://user@example.com:8000/a.tar.gz") == Path(
+        "example.com:8000/a.tar.gz"
+    )
+    # URLs that only differ in their query are saved to different files.
+    a = get_path("https://example.com/a.tar.gz?version=1")
+    b = get_path("https://example.com/a.tar.gz?version=2")
+    assert a != b
+    assert a.parent == Path("example.com")
+    assert a.name.startswith("a.tar-") and a.suffix == ".gz"
+    for url in ["file:///etc/passwd", "http://../a", "http://./a", "http://a\\b/c"]:
+        with pytest.raises(ValueError, match="invalid host"):
+            get_path(url)
+
+
+def test_prefetch(server: str, tmp_path: Path):
+    spec = tmp_path / "spec.json"
+    spec.write_text(json.dumps(_spec(server)))
+    dest = tmp_path / "mirror"
+    # The port of the server is part of the path.
+    host = server.split("//")[1]
+    jq = dest / host / "jq" / "jq-linux64"
+
+    # Resume an interrupted download.
+    jq.parent.mkdir(parents=True)
+    jq.with_name("jq-linux64.part").write_bytes(_files["/jq/jq-linux64"][:100])
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ["prefetch", str(spec), "--dest", str(dest)])
+    assert result.exit_code == 0, result.output
+    assert jq.read_bytes() == _files["/jq/jq-linux64"]
+    assert (dest / host / "data.tar.gz").read_bytes() == _files["/data.tar.gz"]
+    assert not jq.with_name("jq-linux64.part").exists()
+    assert "2 files (5.9 KB)" in result.output
+
+    result = runner.invoke(cli, ["prefetch", str(spec), "--dest", str(dest)])
+    assert result.exit_code == 0, result.output
+    assert result.output.count("exists") == 2
+
+    spec.write_text(json.dumps(_spec(f"{server}/missing")))
+    result = runner.invoke(cli, ["prefetch", str(spec), "--dest", str(dest)])
+    assert result.exit_code != 0
+    assert "2 downloads failed" in result.output
@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import pytest
+
+import neurodocker
+from neurodocker import reproenv
+from neurodocker.reproenv import renderers, state, template
+
+# Functions with in-memory caches. They are collected here, because tests can replace
+# them with functions that do not have caches.
+_cached_functions = (
+    state._get_template_validator,
+    state._get_renderer_validators,
+    renderers._compile_template,
+    template._get_reserved_names,
+)
+
+
+def _reset_reproenv() -> None:
+    """Clear the template registry and in-memory caches, and index the templates of
+    neurodocker again.
+    """
+    state._TemplateRegistry._reset()
+    for func in _cached_functions:
+        func.cache_clear()
+    renderers.clear_fragment_cache()
+    for path in (Path(neurodocker.__file__).parent / "templates").glob("*.yaml"):
+        reproenv.index_template(path)
+
+
+@pytest.fixture(autouse=True)
+def isolate_reproenv(
+    tmp_path_factory: pytest.TempPathFactory, monkeypatch: pytest.MonkeyPatch
+):
+    """Keep the on-disk template and bytecode caches of each test in a temporary
+    directory, and start each test with fresh registry and caches.
+    """
+    cache_dir = tmp_path_factory.mktemp("reproenv-cache")
+    monkeypatch.setenv("REPROENV_CACHE_DIR", str(cache_dir))
+    _reset_reproenv()
+    yield
+    _reset_reproenv()
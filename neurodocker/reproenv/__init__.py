@@ -2,13 +2,61 @@
 core of Neurodocker.
 """
 
-from neurodocker.reproenv.renderers import (  # noqa: F401
-    DockerRenderer,
-    SingularityRenderer,
-)
-from neurodocker.reproenv.state import (  # noqa: F401
-    get_template,
-    register_template,
-    registered_templates,
-)
-from neurodocker.reproenv.template import Template  # noqa: F401
+from __future__ import annotations
+
+import importlib
+import typing as ty
+
+if ty.TYPE_CHECKING:
+    from neurodocker.reproenv.optimize import optimize_instructions  # noqa: F401
+    from neurodocker.reproenv.renderers import (  # noqa: F401
+        DockerRenderer,
+        SingularityRenderer,
+        clear_fragment_cache,
+        fragment_cache_info,
+        read_spec,
+        set_fragment_cache_size,
+    )
+    from neurodocker.reproenv.state import (  # noqa: F401
+        get_template,
+        index_template,
+        register_template,
+        register_templates,
+        registered_templates,
+    )
+    from neurodocker.reproenv.template import Template  # noqa: F401
+
+# Public names and the modules that define them. The modules are imported on first
+# attribute access (PEP 562), so that importing reproenv does not import jinja2,
+# jsonschema and PyYAML. This keeps commands like `neurodocker --version` fast.
+_lazy_attrs = {
+    "optimize_instructions": "neurodocker.reproenv.optimize",
+    "DockerRenderer": "neurodocker.reproenv.renderers",
+    "SingularityRenderer": "neurodocker.reproenv.renderers",
+    "clear_fragment_cache": "neurodocker.reproenv.renderers",
+    "fragment_cache_info": "neurodocker.reproenv.renderers",
+    "read_spec": "neurodocker.reproenv.renderers",
+    "set_fragment_cache_size": "neurodocker.reproenv.renderers",
+    "get_template": "neurodocker.reproenv.state",
+    "index_template": "neurodocker.reproenv.state",
+    "register_template": "neurodocker.reproenv.state",
+    "register_templates": "neurodocker.reproenv.state",
+    "registered_templates": "neurodocker.reproenv.state",
+    "Template": "neurodocker.reproenv.template",
+}
+
+__all__ = list(_lazy_attrs)
+
+
+def __getattr__(name: str) -> ty.Any:
+    try:
+        module_name = _lazy_attrs[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value  # Cache, so __getattr__ is not called again.
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted([*globals(), *_lazy_attrs])
@@ -0,0 +1,215 @@
+"""Optimization passes over the instructions of a renderer.
+
+The instructions of a renderer dictionary (see `_Renderer.from_dict`) are a list of
+mappings with the name of a renderer method and its keyword arguments. Templates log
+their environment and commands as `env` and `run` instructions, so the instructions of
+a renderer (`renderer._instructions`) only refer to renderer methods. Passes take such
+a list and return a new list that produces the same container with fewer instructions.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Callable, Mapping
+
+from neurodocker.reproenv.exceptions import RendererError
+
+_InstructionsType = list[Mapping]
+
+# Maximum number of `run` instructions that are merged into one.
+_MAX_MERGED_RUNS = 4
+
+# Commands that change the state of the shell, like the working directory, variables
+# or the exit of the shell. Commands that follow these cannot be merged into the same
+# `RUN`.
+_SHELL_STATE_RE = re.compile(
+    r"(?:^|[;&|(]|\s)"
+    r"(?:cd|pushd|popd|export|unset|set|source|alias|umask|trap|shopt|exit|\.)"
+    r"(?=\s|;|$)",
+    re.MULTILINE,
+)
+
+# Variable assignments at the start of a command, like `x=1`.
+_ASSIGNMENT_RE = re.compile(r"(?:^|[;&|(])\s*[A-Za-z_][A-Za-z0-9_]*=", re.MULTILINE)
+
+# Endings of commands that would join the next command to them, like `;` (which the
+# Dockerfile renderer follows with `&&`), `&`, `|` and line continuations.
+_CONTINUED_ENDINGS = (";", "&", "|", "\\")
+
+
+def _references(value: str, names: set[str]) -> bool:
+    """Return True if `value` references any of the variables in `names`."""
+    for m in re.finditer(r"\$\{?([A-Za-z_][A-Za-z0-9_]*)", value):
+        if m.group(1) in names:
+            return True
+    return False
+
+
+def drop_redundant_instructions(instructions: _InstructionsType) -> _InstructionsType:
+    """Remove `user` and `workdir` instructions that do not change anything.
+
+    A `user` instruction is removed if it switches to the current user, or if the user
+    was created before and the next instruction switches to another user. A `workdir`
+    instruction is removed if it switches to the current absolute working directory.
+    The current user and working directory are unknown at the start of each stage.
+    """
+    users = {"root"}
+    out = []
+    current_user = current_workdir = None
+    for i, instruction in enumerate(instructions):
+        name, kwds = instruction["name"], instruction["kwds"]
+        if name == "from_":
+            current_user = current_workdir = None
+        elif name == "user":
+            user = kwds["user"]
+            next_is_user = (
+                i + 1 < len(instructions) and instructions[i + 1]["name"] == "user"
+            )
+            if user == current_user or (next_is_user and user in users):
+                continue
+            users.add(user)
+            current_user = user
+        elif name == "workdir":
+            path = str(kwds["path"])
+            if path == current_workdir:
+                continue
+            current_workdir = path if path.startswith("/") else None
+        out.append(instruction)
+    return out
+
+
+def move_labels(instructions: _InstructionsType) -> _InstructionsType:
+    """Move `label` instructions to the end of their stage. Labels do not affect the
+    other instructions, and labels at the end of a stage can be merged.
+    """
+    out: _InstructionsType = []
+    labels: _InstructionsType = []
+    for instruction in instructions:
+        if instruction["name"] == "label":
+            labels.append(instruction)
+            continue
+        if instruction["name"] == "from_":
+            out += labels
+            labels = []
+        out.append(instruction)
+    return out + labels
+
+
+def merge_adjacent(instructions: _InstructionsType) -> _InstructionsType:
+    """Merge adjacent `env` instructions, and adjacent `label` instructions.
+
+    Instructions are not merged if they set the same keys, or if a value references a
+    variable that the previous instruction sets, because values in one Dockerfile
+    `ENV` instruction cannot reference each other.
+    """
+    out: _InstructionsType = []
+    for instruction in instructions:
+        name, kwds = instruction["name"], instruction["kwds"]
+        previous = out[-1] if out else None
+        if (
+            name in {"env", "label"}
+            and previous is not None
+            and previous["name"] == name
+            and not set(previous["kwds"]).intersection(kwds)
+            and not (
+                name == "env"
+                and any(_references(v, set(previous["kwds"])) for v in kwds.values())
+            )
+        ):
+            out[-1] = {"name": name, "kwds": {**previous["kwds"], **kwds}}
+            continue
+        out.append(instruction)
+    return out
+
+
+def _has_comment(command: str) -> bool:
+    """Return True if `command` has a `#` comment outside of quotes."""
+    quote = None
+    previous = "\n"
+    escaped = False
+    for char in command:
+        if escaped:
+            escaped = False
+        elif char == "\\" and quote != "'":
+            escaped = True
+        elif quote is not None:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        # Like in the shell, `#` only starts a comment at the start of a word.
+        elif char == "#" and (previous.isspace() or previous in ";&|()"):
+            return True
+        previous = char
+    return False
+
+
+def _can_merge_after(command: str) -> bool:
+    """Return True if other commands can be appended to `command`."""
+    # A Dockerfile joins continued lines before the shell runs them, so a command
+    # appended after a comment can be commented out.
+    return not (
+        command.rstrip().endswith(_CONTINUED_ENDINGS)
+        or _has_comment(command)
+        or _SHELL_STATE_RE.search(command)
+        or _ASSIGNMENT_RE.search(command)
+    )
+
+
+def merge_runs(
+    instructions: _InstructionsType, max_merged: int = _MAX_MERGED_RUNS
+) -> _InstructionsType:
+    """Merge up to `max_merged` adjacent `run` instructions into one.
+
+    A command is not merged into the previous one if the previous command changes the
+    state of the shell (for example, with `cd`, `export` or `x=1`), has a `#` comment,
+    or ends with `;`, `&`, `|` or a line continuation.
+    """
+    out: _InstructionsType = []
+    merged = 0
+    for instruction in instructions:
+        previous = out[-1] if out else None
+        if (
+            instruction["name"] == "run"
+            and previous is not None
+            and previous["name"] == "run"
+            and merged < max_merged
+        ):
+            command = previous["kwds"]["command"]
+            if _can_merge_after(command):
+                command = "{}\n{}".format(command, instruction["kwds"]["command"])
+                out[-1] = {"name": "run", "kwds": {"command": command}}
+                merged += 1
+                continue
+        merged = 1
+        out.append(instruction)
+    return out
+
+
+# Passes of each optimization level. Level 1 only removes and merges instructions that
+# do not run commands. Level 2 also reorders labels and merges commands.
+optimization_levels: Mapping[
+    int, tuple[Callable[[_InstructionsType], _InstructionsType], ...]
+] = {
+    0: (),
+    1: (drop_redundant_instructions, merge_adjacent),
+    2: (drop_redundant_instructions, move_labels, merge_adjacent, merge_runs),
+}
+
+
+def optimize_instructions(d: Mapping, level: int) -> dict:
+    """Return a copy of the renderer dictionary `d` with the passes of optimization
+    `level` applied to its instructions.
+    """
+    try:
+        passes = optimization_levels[level]
+    except KeyError:
+        raise RendererError(
+            "Unknown optimization level '{}'. Allowed levels are '{}'.".format(
+                level, "', '".join(map(str, optimization_levels))
+            )
+        ) from None
+    instructions = list(d["instructions"])
+    for func in passes:
+        instructions = func(instructions)
+    return {**d, "instructions": instructions}
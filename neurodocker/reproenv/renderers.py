@@ -2,33 +2,130 @@
 
 from __future__ import annotations
 
+import base64
+import collections
 import functools
+import gzip
+import hashlib
 import inspect
 import json
 import os
 import pathlib
-import types
-from typing import Callable, Mapping, NoReturn, Optional, Union
+import posixpath
+import re
+import threading
+import urllib.parse
+from typing import (
+    IO,
+    Callable,
+    Hashable,
+    Iterator,
+    Mapping,
+    NamedTuple,
+    NoReturn,
+    Optional,
+    Union,
+    cast,
+)
 
 import jinja2
 
-from neurodocker.reproenv.exceptions import RendererError, TemplateError
-from neurodocker.reproenv.state import _TemplateRegistry, _validate_renderer
-from neurodocker.reproenv.template import Template, _BaseInstallationTemplate
+from neurodocker.reproenv.exceptions import (
+    RendererError,
+    TemplateError,
+    TemplateKeywordArgumentError,
+)
+from neurodocker.reproenv.optimize import optimize_instructions
+from neurodocker.reproenv.state import (
+    _get_cache_dir,
+    _sort_arguments,
+    _TemplateRegistry,
+    _validate_renderer,
+)
+from neurodocker.reproenv.template import (
+    Template,
+    _BaseInstallationTemplate,
+    _BinariesTemplate,
+)
 from neurodocker.reproenv.types import (
+    REPROENV_FINGERPRINT_LABEL,
     REPROENV_SPEC_FILE_IN_CONTAINER,
     _SingularityHeaderType,
     allowed_installation_methods,
     allowed_pkg_managers,
+    allowed_spec_encodings,
     installation_methods_type,
     pkg_managers_type,
+    spec_encodings_type,
 )
 
+
+class _SourceLoader(jinja2.BaseLoader):
+    """Loader that uses the name of a template as its source.
+
+    Strings are loaded through this loader instead of `jinja2.Environment.from_string`,
+    because only loaded templates are stored in the bytecode cache.
+    """
+
+    def get_source(
+        self, environment: jinja2.Environment, template: str
+    ) -> tuple[str, None, Callable[[], bool]]:
+        return template, None, lambda: True
+
+
+class _BytecodeCache(jinja2.BytecodeCache):
+    """Bytecode cache that stores compiled templates in the template cache directory.
+
+    Templates are compiled once, and later processes load the compiled code instead of
+    running the jinja2 lexer and parser again. Entries are keyed by source text, and
+    jinja2 does not use entries written by other versions of jinja2 or Python. Errors
+    are ignored, because the cache is only an optimization.
+    """
+
+    def _get_path(self, bucket: jinja2.bccache.Bucket) -> Optional[pathlib.Path]:
+        cache_dir = _get_cache_dir()
+        if cache_dir is None:
+            return None
+        return cache_dir / "jinja" / f"{bucket.key}.cache"
+
+    def load_bytecode(self, bucket: jinja2.bccache.Bucket) -> None:
+        path = self._get_path(bucket)
+        if path is None:
+            return
+        try:
+            with path.open("rb") as f:
+                bucket.load_bytecode(f)
+        except OSError:
+            pass
+
+    def dump_bytecode(self, bucket: jinja2.bccache.Bucket) -> None:
+        path = self._get_path(bucket)
+        if path is None:
+            return
+        # Write to a temporary file first, so concurrent processes never read a
+        # partially written entry.
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tmp_path.open("wb") as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+
 # All jinja2 templates are instantiated from this environment object. It is
 # configured to dislike undefined attributes. For example, if a template is
 # created with the string '{{ foo.bar }}' and 'foo' does not have a 'bar'
 # attribute, an error will be thrown when the jinja template is instantiated.
-_jinja_env = jinja2.Environment(undefined=jinja2.StrictUndefined)
+# The environment's own template cache is disabled, because `_compile_template`
+# caches compiled templates.
+_jinja_env = jinja2.Environment(
+    undefined=jinja2.StrictUndefined,
+    loader=_SourceLoader(),
+    bytecode_cache=_BytecodeCache(),
+    cache_size=0,
+)
 
 # Add globals to the jinja environment. These functions can be called from within a
 # template.
@@ -40,50 +137,387 @@ def _raise_helper(msg: str) -> NoReturn:
 
 _jinja_env.globals["raise"] = _raise_helper
 
+
+@functools.lru_cache(maxsize=1024)
+def _compile_template(source: str) -> jinja2.Template:
+    """Return the compiled jinja2 template for `source`.
+
+    The same sources are rendered every time a template is added to a renderer, so the
+    compiled templates are kept in a bounded LRU cache keyed by source text. Use
+    `_compile_template.cache_info()` to get the number of hits and misses. Templates
+    that are not in this cache are read from the on-disk bytecode cache if possible.
+
+    Variables in templates are written as `self.X`, but `self` is a special variable in
+    jinja2, so the compiled template takes the variables as `template.X` instead.
+    """
+    return _jinja_env.get_template(source.replace("self.", "template."))
+
+
+class _TemplateFragment(NamedTuple):
+    """The rendered environment and instructions of a template.
+
+    If the dependencies of the template were hoisted, `dependencies` holds the system
+    packages and deb URLs that `install_dependencies()` would have installed, and the
+    instructions do not install them.
+    """
+
+    env: Optional[tuple[tuple[str, str], ...]]
+    command: Optional[str]
+    dependencies: Optional[tuple[tuple[str, ...], tuple[str, ...]]] = None
+
+
+class FragmentCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class _FragmentCache:
+    """Bounded LRU cache of rendered template fragments.
+
+    The rendered environment and instructions of a template only depend on the content
+    of the template, the installation method, the keyword arguments, and the package
+    manager. Renderers look up fragments by these, so templates that are used by many
+    renderers (for example, when generating many container specifications in one
+    process) are rendered once. Setting `maxsize` to 0 disables the cache.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._data: collections.OrderedDict[Hashable, _TemplateFragment] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: Hashable) -> Optional[_TemplateFragment]:
+        with self._lock:
+            fragment = self._data.get(key)
+            if fragment is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._data.move_to_end(key)
+            return fragment
+
+    def set(self, key: Hashable, fragment: _TemplateFragment) -> None:
+        with self._lock:
+            if self._maxsize <= 0:
+                return
+            self._data[key] = fragment
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def resize(self, maxsize: int) -> None:
+        """Set the maximum number of fragments in the cache, evicting the least
+        recently used fragments if necessary.
+        """
+        if maxsize < 0:
+            raise ValueError("maxsize must be a non-negative integer")
+        with self._lock:
+            self._maxsize = maxsize
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all fragments from the cache and reset the statistics."""
+        with self._lock:
+            self._data.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def info(self) -> FragmentCacheInfo:
+        """Return the number of hits and misses, and the maximum and current size of the
+        cache.
+        """
+        with self._lock:
+            return FragmentCacheInfo(
+                hits=self._hits,
+                misses=self._misses,
+                maxsize=self._maxsize,
+                currsize=len(self._data),
+            )
+
+
+def _get_fragment_cache_size() -> int:
+    """Return the size of the fragment cache from `$REPROENV_FRAGMENT_CACHE_SIZE`, or
+    the default size if that variable is not set or is not a non-negative integer.
+    """
+    try:
+        return max(int(os.environ["REPROENV_FRAGMENT_CACHE_SIZE"]), 0)
+    except (KeyError, ValueError):
+        return 256
+
+
+_fragment_cache = _FragmentCache(maxsize=_get_fragment_cache_size())
+
+fragment_cache_info = _fragment_cache.info
+set_fragment_cache_size = _fragment_cache.resize
+clear_fragment_cache = _fragment_cache.clear
+
+
+class _PackageManagerHelpers:
+    """Functions that templates use to install packages with the package manager of a
+    renderer. Each renderer creates one of these objects.
+    """
+
+    __slots__ = ("pkg_manager", "buildkit_cache", "mirrors")
+
+    def __init__(
+        self,
+        pkg_manager: pkg_managers_type,
+        buildkit_cache: bool = False,
+        mirrors: Mapping[str, str] = None,
+    ):
+        self.pkg_manager = pkg_manager
+        # If true, package caches are kept in BuildKit cache mounts, so they are not
+        # cleaned up.
+        self.buildkit_cache = buildkit_cache
+        # URL prefixes and their replacements, longest prefixes first.
+        self.mirrors: tuple[tuple[str, str], ...] = tuple(
+            sorted((mirrors or {}).items(), key=lambda item: -len(item[0]))
+        )
+
+    def get_url(self, url: str) -> str:
+        """Return `url` with its prefix replaced by a mirror, if there is one."""
+        for prefix, replacement in self.mirrors:
+            if url.startswith(prefix):
+                return replacement + url[len(prefix) :]
+        return url
+
+    def install(self, pkgs: list[str], opts: str = None) -> str:
+        return _install(
+            pkgs=pkgs, pkg_manager=self.pkg_manager, clean=not self.buildkit_cache
+        )
+
+    def install_packages(self, pkgs: list[str], debs: list[str]) -> str:
+        """Return command that installs system packages and deb packages from URLs."""
+        clean = not self.buildkit_cache
+        cmds = []
+        if pkgs:
+            cmds.append(_install(pkgs=pkgs, pkg_manager=self.pkg_manager, clean=clean))
+        if debs:
+            debs = [self.get_url(url) for url in debs]
+            cmds.append(_apt_install_debs(debs, clean=clean))
+        return "\n".join(cmds)
+
+    def install_dependencies(
+        self, template: _BaseInstallationTemplate, opts: str = None
+    ) -> str:
+        # TODO: test that template with empty dependencies (apt: []) does not render
+        # any installation of dependencies.
+        cmd = ""
+        pkgs = template.dependencies(pkg_manager=self.pkg_manager)
+        clean = not self.buildkit_cache
+        if pkgs:
+            cmd += _install(
+                pkgs=pkgs, pkg_manager=self.pkg_manager, opts=opts, clean=clean
+            )
+        if self.pkg_manager == "apt":
+            debs = [self.get_url(url) for url in template.dependencies("debs")]
+            if debs:
+                cmd += "\n" + _apt_install_debs(debs, clean=clean)
+        return cmd
+
+
+# What `install_dependencies()` returns if the dependencies are hoisted. The line
+# with this text is removed from the rendered instructions.
+_HOISTED_DEPENDENCIES = "# reproenv: hoisted dependencies"
+
+
+class _TemplateContext:
+    """The object that templates refer to as `self` when they are rendered.
+
+    It gives templates the keyword arguments and attributes of an installation
+    template, and the package manager and install functions of a renderer.
+    """
+
+    __slots__ = ("_template", "_helpers", "_dependencies")
+
+    def __init__(
+        self,
+        template: _BaseInstallationTemplate,
+        helpers: _PackageManagerHelpers,
+        hoist_dependencies: bool = False,
+    ):
+        self._template = template
+        self._helpers = helpers
+        # If hoisting, `install_dependencies()` collects the dependencies here instead
+        # of installing them.
+        self._dependencies: Optional[tuple[list[str], list[str]]] = (
+            ([], []) if hoist_dependencies else None
+        )
+
+    @property
+    def pkg_manager(self) -> str:
+        return self._helpers.pkg_manager
+
+    @property
+    def buildkit_cache(self) -> bool:
+        return self._helpers.buildkit_cache
+
+    @property
+    def urls(self) -> Mapping[str, str]:
+        # Only templates for binaries have URLs.
+        template = cast(_BinariesTemplate, self._template)
+        urls = template.urls
+        if self._helpers.mirrors:
+            urls = {k: self._helpers.get_url(v) for k, v in urls.items()}
+        if template.checksums:
+            # Files with checksums are used from where `_add_download_commands` puts
+            # them. curl reads `file://` URLs like remote URLs.
+            urls = {
+                k: "file://" + _get_download_path(v, template.checksums[k])
+                if k in template.checksums
+                else v
+                for k, v in urls.items()
+            }
+        return urls
+
+    @property
+    def downloads(self) -> list[tuple[str, str]]:
+        """The URLs and SHA256 checksums of the files with checksums."""
+        if not isinstance(self._template, _BinariesTemplate):
+            return []
+        checksums = self._template.checksums
+        return [
+            (self._helpers.get_url(url), checksums[k])
+            for k, url in self._template.urls.items()
+            if k in checksums
+        ]
+
+    def install(self, pkgs: list[str], opts: str = None) -> str:
+        return self._helpers.install(pkgs, opts=opts)
+
+    def install_dependencies(self, opts: str = None) -> str:
+        # Dependencies with custom options are installed where they are used.
+        if self._dependencies is not None and opts is None:
+            pkgs, debs = self._dependencies
+            pkgs += self._template.dependencies(self.pkg_manager)
+            if self.pkg_manager == "apt":
+                debs += self._template.dependencies("debs")
+            return _HOISTED_DEPENDENCIES
+        return self._helpers.install_dependencies(self._template, opts=opts)
+
+    def __getattr__(self, name: str):
+        # Keyword arguments, and attributes like `urls`.
+        return getattr(self._template, name)
+
+
 # TODO: add a flag that avoids buggy behavior when basing a new container on
 # one created with ReproEnv.
 
 PathType = Union[str, pathlib.Path, os.PathLike]
 
 
-def _render_string_from_template(
-    source: str, template: _BaseInstallationTemplate
-) -> str:
+def _render_string_from_template(source: str, template: _TemplateContext) -> str:
     """Take a string from a template and render"""
-    # TODO: we could use a while loop or recursive function to render the template until
-    # there are no jinja-specific things. At this point, we support one level of
-    # nesting.
-    n_renders = 0
-    max_renders = 20
-
-    err = (
-        "A template included in this renderer raised an error. Please check the"
-        " template definition. A required argument might not be included in the"
-        " required arguments part of the template. Variables in the template should"
-        " start with `self.`."
-    )
-
-    # Render the string again. This is sometimes necessary because some defaults in the
-    # template are rendered as {{ self.X }}. These defaults need to be rendered again.
-
-    while (
+    if not (
         _jinja_env.variable_start_string in source
         and _jinja_env.variable_end_string in source
     ):
-        source = source.replace("self.", "template.")
-        tmpl = _jinja_env.from_string(source)
-        try:
-            source = tmpl.render(template=template)
-        except jinja2.exceptions.UndefinedError as e:
-            raise RendererError(err) from e
-        n_renders += 1
+        return source
+    try:
+        return _compile_template(source).render(template=template)
+    except jinja2.exceptions.UndefinedError as e:
+        raise RendererError(
+            "A template included in this renderer raised an error. Please check the"
+            " template definition. A required argument might not be included in the"
+            " required arguments part of the template. Variables in the template"
+            " should start with `self.`."
+        ) from e
+
+
+def _resolve_arguments(
+    template: _BaseInstallationTemplate, context: _TemplateContext
+) -> None:
+    """Render the values of arguments and URLs of `template` that reference other
+    arguments.
+
+    Defaults like `install_path: /opt/fsl-{{ self.version }}` are rendered once, in
+    dependency order, so that the instructions of the template can be rendered in a
+    single pass.
+    """
+    kwds = template._kwds
+    try:
+        names = _sort_arguments(kwds)
+    except TemplateError as e:
+        raise TemplateKeywordArgumentError(f"Invalid keyword arguments: {e}.") from e
+    for name in names:
+        kwds[name] = _render_string_from_template(kwds[name], context)
+    if isinstance(template, _BinariesTemplate):
+        template._urls = {
+            k: _render_string_from_template(v, context)
+            for k, v in template.urls.items()
+        }
 
-        if n_renders > max_renders:
-            raise RendererError(
-                f"reached maximum rendering iterations ({max_renders}). Templates"
-                f" should not nest variables more than {max_renders} times."
-            )
-    return source
+
+def _get_argument_recorder(func: Callable) -> Callable[[tuple, dict], dict]:
+    """Return a function that takes the positional and keyword arguments of a call to
+    the renderer method `func` (without `self`), and returns the arguments that are
+    logged for that call.
+
+    The signature of `func` is inspected once. Calls of methods that only have
+    positional-or-keyword parameters, or only `**kwds`, are recorded without
+    `inspect.Signature.bind`. Other calls, and calls with invalid arguments, use
+    `inspect.Signature.bind`, which raises `TypeError` for invalid arguments.
+    """
+    sig = inspect.signature(func)
+    params = list(sig.parameters.values())[1:]
+    self_name = next(iter(sig.parameters))
+
+    # If a function takes **kwds, save those without wrapping them in another dict.
+    # Assume that **kwds arguments are _always_ kwds (eg, not kwargs).
+    # TODO: generalize this to work on any VAR_KEYWORD parameter.
+    kwds_param = sig.parameters.get("kwds")
+    has_var_kwds = kwds_param is not None and kwds_param.kind == kwds_param.VAR_KEYWORD
+
+    def bind(args: tuple, kwds: dict) -> dict:
+        # We could apply defaults with `bargs.apply_defaults()` but we do not because
+        # many defaults are None and the renderer schema does not support null values.
+        bargs = sig.bind(None, *args, **kwds)
+        # self is not an argument in the spec, but it is present because these are
+        # instance methods.
+        del bargs.arguments[self_name]
+        if has_var_kwds:
+            bargs_kwds = bargs.arguments.pop("kwds", None)
+            if bargs_kwds is not None:
+                bargs.arguments.update(bargs_kwds)
+        return dict(bargs.arguments)
+
+    if has_var_kwds and len(params) == 1:
+
+        def record_kwds(args: tuple, kwds: dict) -> dict:
+            return bind(args, kwds) if args else dict(kwds)
+
+        return record_kwds
+
+    if all(p.kind == p.POSITIONAL_OR_KEYWORD for p in params):
+        names = [p.name for p in params]
+        required = {p.name for p in params if p.default is p.empty}
+
+        def record(args: tuple, kwds: dict) -> dict:
+            if len(args) > len(names):
+                return bind(args, kwds)
+            d = {}
+            for i, name in enumerate(names):
+                if i < len(args):
+                    d[name] = args[i]
+                elif name in kwds:
+                    d[name] = kwds[name]
+                elif name in required:
+                    return bind(args, kwds)
+            # Unexpected keyword arguments, or arguments given more than once.
+            if len(d) != len(args) + len(kwds):
+                return bind(args, kwds)
+            return d
+
+        return record
+
+    return bind
 
 
 def _log_instruction(func: Callable):
@@ -91,6 +525,8 @@ def _log_instruction(func: Callable):
 
     This adds the logs to the `_instructions` attribute of the Renderer instance.
     """
+    record = _get_argument_recorder(func)
+    name = func.__name__
 
     @functools.wraps(func)
     def with_logging(self, *args, **kwds):
@@ -98,40 +534,30 @@ def _log_instruction(func: Callable):
             raise ValueError(
                 "This wrapper should only be applied to Renderer instances."
             )
-        # This gets all arguments, even if their value is None.
-        # We remove key-value pairs where value is None, because the schema does not
-        # allow for None values.
-        # TODO: consider this further...
-        sig = inspect.signature(func)
-
-        # We could apply defaults with `bargs.apply_defaults()` but we do not because
-        # many defaults are None and the renderer schema does not support null values.
-        bargs = sig.bind(self, *args, **kwds)
-        # self is not an argument in the spec, but it is present because these are
-        # instance methods.
-        del bargs.arguments["self"]
-
-        # If a function takes **kwds, save those without wrapping them in another dict.
-        # Assume that **kwds arguments are _always_ kwds (eg, not kwargs).
-        # TODO: generalize this to work on any VAR_KEYWORD parameter.
-        kwds_param = sig.parameters.get("kwds")
-        if kwds_param is not None:
-            if kwds_param.kind == kwds_param.VAR_KEYWORD:
-                bargs_kwds = bargs.arguments.pop("kwds")
-                if bargs_kwds is not None:
-                    bargs.arguments.update(bargs_kwds)
-
-        d = {"name": func.__name__, "kwds": dict(bargs.arguments)}
-
-        self._instructions["instructions"].append(d)
-        return func(self, *args, **kwds)
+        # Instructions that other instructions add, like the `run` of `install`, are
+        # not logged, so that replaying the log does not add them twice.
+        nested = self._logging_instruction
+        if not nested:
+            d = {"name": name, "kwds": record(args, kwds)}
+            self._instructions["instructions"].append(d)
+        self._logging_instruction = True
+        try:
+            return func(self, *args, **kwds)
+        finally:
+            self._logging_instruction = nested
+            self._clear_cache()
 
     return with_logging
 
 
 class _Renderer:
     def __init__(
-        self, pkg_manager: pkg_managers_type, users: Optional[set[str]] = None
+        self,
+        pkg_manager: pkg_managers_type,
+        users: Optional[set[str]] = None,
+        spec_encoding: spec_encodings_type = "printf",
+        label_fingerprint: bool = False,
+        mirrors: Optional[Mapping[str, str]] = None,
     ) -> None:
         if pkg_manager not in allowed_pkg_managers:
             raise RendererError(
@@ -140,6 +566,12 @@ class _Renderer:
             )
 
         self.pkg_manager = pkg_manager
+        self.spec_encoding = spec_encoding
+        self.label_fingerprint = label_fingerprint
+        # URLs of binaries and deb packages that start with a key of `mirrors` are
+        # downloaded from the corresponding value instead.
+        self.mirrors = {} if mirrors is None else dict(mirrors)
+        self._pkg_manager_helpers = self._get_pkg_manager_helpers()
         self._users = {"root"} if users is None else users
         # This keeps track of the current user. This is useful when saving the JSON
         # specification to JSON, because if we are not root, we can change to root,
@@ -150,6 +582,8 @@ class _Renderer:
             "existing_users": list(self._users),
             "instructions": [],
         }
+        # True while a logged instruction runs.
+        self._logging_instruction = False
 
         # Strings (comments) that indicate the beginning and end of saving the JSON
         # spec to a file. This helps us in testing because sometimes we don't care
@@ -158,42 +592,258 @@ class _Renderer:
         self._json_save_start = "# Save specification to JSON."
         self._json_save_end = "# End saving to specification to JSON."
 
-    def __eq__(self, other: object) -> bool:
-        if not isinstance(other, (_Renderer, str)):
-            raise NotImplementedError()
-
-        def rm_empty_lines(s):
-            return "\n".join(
-                j
-                for j in str(s).splitlines()
-                if j.strip() and not j.strip().startswith("#")
+        # Ranges of logged instructions that the fingerprint replaces with what they
+        # were rendered from, like the name, installation method, content hash and
+        # keyword arguments of a template. Options like `mirrors` change the rendered
+        # instructions, but not the software in the container.
+        self._fingerprint_parts: list[tuple[int, int, Mapping]] = []
+
+        # Cached output of `render`, `digest` and `fingerprint`. These are reset
+        # whenever an instruction is added or an option of the output is changed.
+        self._rendered: Optional[str] = None
+        self._digest: Optional[str] = None
+        self._fingerprint: Optional[str] = None
+
+    def _get_pkg_manager_helpers(self) -> _PackageManagerHelpers:
+        """Return new helpers that install packages for the options of this renderer."""
+        return _PackageManagerHelpers(self.pkg_manager, mirrors=self.mirrors)
+
+    def _clear_cache(self) -> None:
+        """Reset the cached output of `render`, `digest` and `fingerprint`."""
+        self._rendered = None
+        self._digest = None
+        self._fingerprint = None
+
+    @property
+    def spec_encoding(self) -> spec_encodings_type:
+        """How the JSON specification is saved in the container."""
+        return self._spec_encoding
+
+    @spec_encoding.setter
+    def spec_encoding(self, value: spec_encodings_type) -> None:
+        if value not in allowed_spec_encodings:
+            raise RendererError(
+                "Unknown spec encoding '{}'. Allowed spec encodings are '{}'.".format(
+                    value, "', '".join(allowed_spec_encodings)
+                )
             )
+        self._spec_encoding = value
+        self._clear_cache()
 
-        # Empty lines and commented lines do not affect container definitions.
-        return rm_empty_lines(self) == rm_empty_lines(other)
+    @property
+    def label_fingerprint(self) -> bool:
+        """If true, the fingerprint of this renderer is added to the container as a
+        label.
+        """
+        return self._label_fingerprint
+
+    @label_fingerprint.setter
+    def label_fingerprint(self, value: bool) -> None:
+        self._label_fingerprint = value
+        self._clear_cache()
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, _Renderer):
+            return self.digest == other.digest
+        if isinstance(other, str):
+            return self.digest == _get_content_digest(other)
+        raise NotImplementedError()
 
     def __str__(self) -> str:
-        masthead = "# Generated by Neurodocker and Reproenv."
-        image_spec = self.render()
-        return f"{masthead}\n\n{image_spec}"
+        directives = self._get_directives()
+        rendered = self.render()[len(directives) :]
+        return f"{directives}{_MASTHEAD}\n\n{rendered}"
+
+    def _iter_str(self) -> Iterator[str]:
+        """Yield chunks of the full container specification, including the masthead
+        after the directives.
+        """
+        directives = self._get_directives()
+        yield directives
+        yield _MASTHEAD
+        yield "\n\n"
+        if self._rendered is not None:
+            yield self._rendered[len(directives) :]
+        else:
+            chunks = self.render_iter()
+            # `render_iter` yields the directives in one chunk.
+            if directives:
+                next(chunks)
+            yield from chunks
+
+    def _get_directives(self) -> str:
+        """Return the lines that must start the rendered container specification, like
+        parser directives of a Dockerfile. `render_iter` yields them first.
+        """
+        return ""
+
+    @property
+    def digest(self) -> str:
+        """SHA256 digest of the rendered container specification, ignoring empty lines
+        and comments. Renderers with the same digest are equal.
+        """
+        if self._digest is None:
+            self._digest = _get_content_digest(self.render())
+        return self._digest
+
+    def fingerprint(self) -> str:
+        """Return a SHA256 digest that identifies the container specification.
+
+        The digest is computed from the instructions of this renderer, serialized as
+        canonical JSON, where templates are replaced by their content hashes and
+        keyword arguments, and from the options that change the container (see
+        `_get_fingerprint_options`). It does not depend on how the specification is
+        rendered, or on mirrors of the downloaded files, so renderers of the same type
+        with the same instructions, templates and options have the same fingerprint.
+        """
+        if self._fingerprint is None:
+            instructions = dict(self._instructions)
+            # Users are kept in a set, so their order is arbitrary.
+            instructions["existing_users"] = sorted(instructions["existing_users"])
+            instructions["instructions"] = self._get_fingerprint_instructions()
+            d = {
+                "renderer": type(self).__name__,
+                "instructions": instructions,
+                "options": self._get_fingerprint_options(),
+            }
+            j = json.dumps(d, sort_keys=True, separators=(",", ":"))
+            self._fingerprint = hashlib.sha256(j.encode()).hexdigest()
+        return self._fingerprint
+
+    def _get_fingerprint_instructions(self) -> list[Mapping]:
+        """Return the logged instructions, with the ranges in `_fingerprint_parts`
+        replaced by what they were rendered from.
+        """
+        instructions: list[Mapping] = list(self._instructions["instructions"])
+        for start, stop, part in reversed(self._fingerprint_parts):
+            instructions[start:stop] = [part]
+        return instructions
+
+    def _get_fingerprint_options(self) -> dict:
+        """Return the options of this renderer that change the container."""
+        return {}
 
     @property
     def users(self) -> set[str]:
         return self._users
 
     @classmethod
-    def from_dict(cls, d: Mapping) -> _Renderer:
-        """Instantiate a new renderer from a dictionary of instructions."""
+    def from_dict(
+        cls,
+        d: Mapping,
+        hoist_dependencies: bool = False,
+        optimize: int = 0,
+        **renderer_kwds,
+    ) -> _Renderer:
+        """Instantiate a new renderer from a dictionary of instructions.
+
+        If `hoist_dependencies` is true, the system dependencies of the templates in
+        the first stage are installed in one step, right after the `_default` template
+        or the base image, instead of by each template.
+
+        If `optimize` is not 0, the instructions of the renderer, including those of
+        templates, are optimized with the passes of that level (see
+        `neurodocker.reproenv.optimize`), and a renderer with the optimized
+        instructions is returned.
+
+        Other keyword arguments, like `spec_encoding`, are passed to the renderer.
+        """
+        if optimize:
+            if renderer_kwds.get("multistage"):
+                raise RendererError(
+                    "Instructions of multi-stage builds cannot be optimized."
+                )
+            renderer = cls.from_dict(
+                d, hoist_dependencies=hoist_dependencies, **renderer_kwds
+            )
+            optimized = cls.from_dict(
+                optimize_instructions(renderer._instructions, optimize),
+                **renderer_kwds,
+            )
+            # The templates are part of the fingerprint, so the fingerprint uses the
+            # instructions that the optimized instructions were rendered from.
+            part = {
+                "name": "optimize",
+                "level": optimize,
+                "instructions": renderer._get_fingerprint_instructions(),
+            }
+            stop = len(optimized._instructions["instructions"])
+            optimized._fingerprint_parts = [(0, stop, part)]
+            return optimized
+
         # raise error if invalid
         _validate_renderer(d)
 
         pkg_manager = d["pkg_manager"]
         users = d.get("existing_users", None)
+        # Users are a list in JSON, but renderers keep them in a set.
+        users = None if users is None else set(users)
 
         # create new renderer object
-        renderer = cls(pkg_manager=pkg_manager, users=users)
+        renderer = cls(pkg_manager=pkg_manager, users=users, **renderer_kwds)
+
+        # Templates whose dependencies are hoisted are rendered first, to collect
+        # their dependencies. They are added to the renderer in order below.
+        instructions = d["instructions"]
+        ranges = []
+        if hoist_dependencies:
+            ranges = _get_hoisting_ranges(renderer, instructions)
+        hoisted: dict[int, tuple[Template, str, _TemplateFragment]] = {}
+        # The packages installed before the first template of each range.
+        installs: dict[int, tuple[list[str], list[str]]] = {}
+        installed: set[str] = set()
+        for start, stop in ranges:
+            pkgs: dict[str, None] = {}  # Ordered sets.
+            debs: dict[str, None] = {}
+            for index in range(start, stop):
+                mapping = instructions[index]
+                try:
+                    template, method = renderer._get_registered_template(
+                        mapping["name"], **mapping["kwds"]
+                    )
+                    getattr(template, method).validate_kwds()
+                    fragment = renderer._get_fragment(
+                        template, method, hoist_dependencies=True
+                    )
+                except TemplateError as e:
+                    raise RendererError(
+                        f"Error on template '{mapping['name']}'. Please see above"
+                        " for more information."
+                    ) from e
+                hoisted[index] = (template, method, fragment)
+                if fragment.dependencies is not None:
+                    pkgs.update(dict.fromkeys(fragment.dependencies[0]))
+                    debs.update(dict.fromkeys(fragment.dependencies[1]))
+            # Do not install packages again that the template before the range
+            # (usually `_default`) or an earlier range installs.
+            previous = instructions[start - 1]
+            if not hasattr(renderer, previous["name"]):
+                template, method = renderer._get_registered_template(
+                    previous["name"], **previous["kwds"]
+                )
+                if not renderer._uses_builder_stages(template, method):
+                    dependencies = getattr(template, method).dependencies(pkg_manager)
+                    installed.update(dependencies)
+            installs[start] = (
+                [pkg for pkg in pkgs if pkg not in installed],
+                [deb for deb in debs if deb not in installed],
+            )
+            installed.update(pkgs, debs)
 
-        for mapping in d["instructions"]:
+        for index, mapping in enumerate(instructions):
+            if any(installs.get(index, ())):
+                start = len(renderer._instructions["instructions"])
+                renderer.run(
+                    renderer._pkg_manager_helpers.install_packages(*installs[index])
+                )
+                # Deb packages are downloaded from mirrors, which are not part of the
+                # fingerprint.
+                part = {
+                    "name": "hoisted_dependencies",
+                    "pkgs": installs[index][0],
+                    "debs": installs[index][1],
+                }
+                renderer._fingerprint_parts.append((start, start + 1, part))
             method_or_template = mapping["name"]
             kwds = mapping["kwds"]
             this_instance_method = getattr(renderer, method_or_template, None)
@@ -206,6 +856,9 @@ class _Renderer:
                         f"Error on step '{method_or_template}'. Please see the"
                         " traceback above for details."
                     ) from e
+            # This is a template whose dependencies were hoisted.
+            elif index in hoisted:
+                renderer._add_fragment(*hoisted[index])
             # This is actually a template.
             else:
                 try:
@@ -225,9 +878,30 @@ class _Renderer:
         sequence of instructions into a string. For a Singularity recipe, it might
         organize the instructions into their respective locations, like %post, %files.
 
-        This method is used by Renderer.__str__ to create the full container spec.
+        This method joins the chunks yielded by `Renderer.render_iter`. The result is
+        cached until another instruction is added.
         """
-        raise NotImplementedError("subclasses must implement .render()")
+        if self._rendered is None:
+            self._rendered = "".join(self.render_iter())
+        return self._rendered
+
+    def render_iter(self) -> Iterator[str]:
+        """Yield the rendered container specification in chunks.
+
+        Joining the chunks gives the same string as `Renderer.render`. This method is
+        used by Renderer.__str__ and Renderer.render_to to create the full container
+        spec without building intermediate strings.
+        """
+        raise NotImplementedError("subclasses must implement .render_iter()")
+
+    def render_to(self, fp: IO[str]) -> None:
+        """Write the full container specification, as returned by `str(self)`, to the
+        text file object `fp`.
+
+        The specification is written in chunks, so it is never held in memory as a
+        whole.
+        """
+        fp.writelines(self._iter_str())
 
     def add_template(
         self, template: Template, method: installation_methods_type
@@ -266,78 +940,143 @@ class _Renderer:
         # If we print to stdout, however, we can cause problems if the user is piping
         # the output to a file or directly to a container build command.
 
-        # If we keep the `self.VAR` syntax of the template, then we need to pass
-        # `self=template_method` to the renderer function. But that function is an
-        # instance method, so passing `self` will override the `self` argument.
-        # To get around this, we replace `self.` with something that is not an
-        # argument to the renderer function.
+        fragment = self._get_fragment(template, method)
+        self._add_fragment(template, method, fragment)
+        return self
 
-        # Add environment (render any jinja templates).
-        if template_method.env:
-            d: Mapping[str, str] = {
-                _render_string_from_template(
-                    k, template_method
-                ): _render_string_from_template(v, template_method)
-                for k, v in template_method.env.items()
-            }
-            self.env(**d)
-
-        # Patch the `template_method.install_dependencies` instance method so it can be
-        # used (ie rendered) in a template and have access to the pkg_manager requested.
-        def install_patch(
-            inner_self: _BaseInstallationTemplate, pkgs: list[str], opts: str = None
-        ) -> str:
-            return _install(pkgs=pkgs, pkg_manager=self.pkg_manager)
-
-        # mypy complains when we try to patch a class, so we do it behind its back with
-        # setattr. See https://github.com/python/mypy/issues/2427
-        setattr(
-            template_method, "install", types.MethodType(install_patch, template_method)
+    def _get_fragment(
+        self, template: Template, method: str, hoist_dependencies: bool = False
+    ) -> _TemplateFragment:
+        """Return the rendered environment and instructions of a template, from the
+        cache of rendered fragments if possible.
+        """
+        template_method: _BaseInstallationTemplate = getattr(template, method)
+        helpers = self._get_template_helpers()
+        key = (
+            template._hash,
+            method,
+            tuple(sorted(template_method._kwds.items())),
+            self.pkg_manager,
+            helpers.buildkit_cache,
+            helpers.mirrors,
+            hoist_dependencies,
         )
+        fragment = _fragment_cache.get(key)
+        if fragment is None:
+            fragment = self._render_template(
+                template, template_method, hoist_dependencies=hoist_dependencies
+            )
+            _fragment_cache.set(key, fragment)
+        return fragment
 
-        # Set pkg_manager onto the template.
-        setattr(template_method, "pkg_manager", self.pkg_manager)
-
-        # Patch the `template_method.install_dependencies` instance method so it can be
-        # used (ie rendered) in a template and have access to the pkg_manager requested.
-        def install_dependencies_patch(
-            inner_self: _BaseInstallationTemplate, opts: str = None
-        ) -> str:
-            # TODO: test that template with empty dependencies (apt: []) does not render
-            # any installation of dependencies.
-            cmd = ""
-            pkgs = inner_self.dependencies(pkg_manager=self.pkg_manager)
-            if pkgs:
-                cmd += _install(pkgs=pkgs, pkg_manager=self.pkg_manager, opts=opts)
-            if self.pkg_manager == "apt":
-                debs = inner_self.dependencies("debs")
-                if debs:
-                    cmd += "\n" + _apt_install_debs(debs)
-            return cmd
-
-        # mypy complains when we try to patch a class, so we do it behind its back with
-        # setattr. See https://github.com/python/mypy/issues/2427
-        setattr(
+    def _get_template_helpers(self) -> _PackageManagerHelpers:
+        """Return the package manager helpers that templates use. BuildKit cache mounts
+        are owned by root, so templates that other users install do not use them, and
+        clean up their caches.
+        """
+        helpers = self._pkg_manager_helpers
+        if helpers.buildkit_cache and self._current_user != "root":
+            return _PackageManagerHelpers(self.pkg_manager, mirrors=self.mirrors)
+        return helpers
+
+    def _uses_builder_stages(self, template: Template, method: str) -> bool:
+        """Return True if `template` can be installed in a builder stage."""
+        return False
+
+    def _add_fragment(
+        self, template: Template, method: str, fragment: _TemplateFragment
+    ) -> None:
+        """Add the rendered environment and instructions of a template."""
+        start = len(self._instructions["instructions"])
+        if fragment.env is not None:
+            self.env(**dict(fragment.env))
+        if fragment.command is not None:
+            self.run(fragment.command)
+        template_method: _BaseInstallationTemplate = getattr(template, method)
+        part = {
+            "name": template.name,
+            "method": method,
+            "hash": template._hash,
+            "kwds": dict(template_method._kwds),
+        }
+        stop = len(self._instructions["instructions"])
+        self._fingerprint_parts.append((start, stop, part))
+        self._clear_cache()
+
+    def _render_template(
+        self,
+        template: Template,
+        template_method: _BaseInstallationTemplate,
+        hoist_dependencies: bool = False,
+    ) -> _TemplateFragment:
+        """Render the environment and instructions of `template_method`."""
+        context = _TemplateContext(
             template_method,
-            "install_dependencies",
-            types.MethodType(install_dependencies_patch, template_method),
+            self._get_template_helpers(),
+            hoist_dependencies=hoist_dependencies,
         )
 
-        # Add installation instructions (render any jinja templates).
+        # Render the values of arguments that reference other arguments, so that the
+        # environment and instructions are rendered in a single pass.
+        _resolve_arguments(template_method, context)
+
+        # Render environment (render any jinja templates).
+        env = None
+        if template_method.env:
+            env = tuple(
+                (
+                    _render_string_from_template(k, context),
+                    _render_string_from_template(v, context),
+                )
+                for k, v in template_method.env.items()
+            )
+
+        # Render installation instructions (render any jinja templates).
+        command = None
         if template_method.instructions:
+            # Trailing newlines are not part of the instructions.
             command = _render_string_from_template(
-                template_method.instructions, template_method
-            )
+                template_method.instructions, context
+            ).rstrip("\n")
+            # Remove the line that installed the hoisted dependencies.
+            if context._dependencies is not None:
+                command = "\n".join(
+                    line
+                    for line in command.splitlines()
+                    if line.strip() != _HOISTED_DEPENDENCIES
+                )
+            if context.downloads:
+                command = _add_download_commands(command, context.downloads)
             # TODO: raise exception here or skip the run instruction?
-            if not command.strip():
+            if context._dependencies is not None and all(
+                not line.strip() or line.lstrip().startswith("#")
+                for line in command.splitlines()
+            ):
+                # Instructions can be empty (or only comments) if they only install
+                # dependencies.
+                command = None
+            elif not command.strip():
                 raise RendererError(f"empty rendered instructions in {template.name}")
-            self.run(command)
 
-        return self
+        dependencies = None
+        if context._dependencies is not None:
+            pkgs, debs = context._dependencies
+            dependencies = (tuple(pkgs), tuple(debs))
+        return _TemplateFragment(env=env, command=command, dependencies=dependencies)
 
     def add_registered_template(
         self, name: str, method: installation_methods_type = None, **kwds
     ) -> _Renderer:
+        template, method = self._get_registered_template(name, method, **kwds)
+        self.add_template(template=template, method=method)
+        return self
+
+    def _get_registered_template(
+        self, name: str, method: installation_methods_type = None, **kwds
+    ) -> tuple[Template, installation_methods_type]:
+        """Return a registered template with keyword arguments for `method`, and the
+        installation method.
+        """
         # Template was validated at registration time.
         template_dict = _TemplateRegistry.get(name)
 
@@ -360,9 +1099,7 @@ class _Renderer:
         template = Template(
             template=template_dict, binaries_kwds=binaries_kwds, source_kwds=source_kwds
         )
-
-        self.add_template(template=template, method=method)
-        return self
+        return template, method
 
     def arg(self, key: str, value: str = None):
         raise NotImplementedError()
@@ -423,44 +1160,243 @@ class _Renderer:
         return json.dumps(self._instructions, **json_kwds)
 
     def _get_instructions(self) -> str:
-        """Return string representation of a printf command that writes the renderer
+        """Return string representation of a command that writes the renderer
         instructions to a JSON file in the container.
         """
-        j = self.to_json(indent=2)
-        # Double-escape escaped sequences so that when printf is done with them, they
-        # are escaped with a single slash.
-        j = j.replace("\\", "\\\\")
-        # Same with parentheses.
-        j = j.replace("(", "\\(").replace(")", "\\)")
-        # Add slash to the end of each line, except the last.
-        j = " \\\n".join(j.splitlines())
-        # Escape the % characters so printf does not interpret them as delimiters.
-        j = j.replace("%", "%%")
-        # Escape single quotes with '"'"'
-        j = j.replace("'", "'\"'\"'")
-        cmd = f"printf '{j}' > {REPROENV_SPEC_FILE_IN_CONTAINER}"
-        return cmd
+        return "".join(self._iter_instructions())
+
+    def _iter_instructions(self) -> Iterator[str]:
+        """Yield chunks of the command returned by `_get_instructions`."""
+        if self.spec_encoding == "gzip":
+            # Compact JSON, compressed and base64-encoded, fits on one line and does
+            # not have to be escaped. The modification time is omitted from the gzip
+            # header, so the output is reproducible.
+            j = json.dumps(self._instructions, separators=(",", ":"))
+            b64 = base64.b64encode(gzip.compress(j.encode(), mtime=0)).decode()
+            yield (
+                f"echo {b64} | base64 -d | gunzip > {REPROENV_SPEC_FILE_IN_CONTAINER}"
+            )
+            return
+
+        yield "printf '"
+        # The JSON is encoded in pieces, which are collected into chunks of bounded
+        # size. Each chunk is escaped on its own.
+        chunk: list[str] = []
+        size = 0
+        for piece in json.JSONEncoder(indent=2).iterencode(self._instructions):
+            chunk.append(piece)
+            size += len(piece)
+            if size >= _JSON_CHUNK_SIZE:
+                yield _escape_for_printf("".join(chunk))
+                chunk.clear()
+                size = 0
+        yield _escape_for_printf("".join(chunk))
+        yield f"' > {REPROENV_SPEC_FILE_IN_CONTAINER}"
 
 
 class DockerRenderer(_Renderer):
-    def __init__(self, pkg_manager: pkg_managers_type, users: set[str] = None) -> None:
-        super().__init__(pkg_manager=pkg_manager, users=users)
+    def __init__(
+        self,
+        pkg_manager: pkg_managers_type,
+        users: set[str] = None,
+        spec_encoding: spec_encodings_type = "printf",
+        label_fingerprint: bool = False,
+        mirrors: Optional[Mapping[str, str]] = None,
+        buildkit_cache: bool = False,
+        multistage: bool = False,
+    ) -> None:
+        # The package manager helpers depend on this, so it is set first.
+        self._buildkit_cache = buildkit_cache
+        self._multistage = multistage
+        super().__init__(
+            pkg_manager=pkg_manager,
+            users=users,
+            spec_encoding=spec_encoding,
+            label_fingerprint=label_fingerprint,
+            mirrors=mirrors,
+        )
+        self._base_image: Optional[str] = None
+        self._builder_stages: list[tuple[str, str]] = []
+        # The index in `_parts` of the instruction that installs the runtime
+        # dependencies of adjacent templates in builder stages, and the packages and
+        # deb packages that it installs. The parts of the last of these templates end
+        # at `_runtime_dependencies_end`.
+        self._runtime_dependencies: tuple[
+            Optional[int], dict[str, None], dict[str, None]
+        ] = (None, {}, {})
+        self._runtime_dependencies_end = -1
+        # The Dockerfile frontend that the instructions need, if the default frontend
+        # of older Docker versions cannot parse them.
+        self._dockerfile_syntax: Optional[str] = None
         self._parts: list[str] = []
 
-    def render(self) -> str:
-        """Return the rendered Dockerfile."""
-        s = "\n".join(self._parts)
+    def _get_pkg_manager_helpers(self) -> _PackageManagerHelpers:
+        return _PackageManagerHelpers(
+            self.pkg_manager, buildkit_cache=self._buildkit_cache, mirrors=self.mirrors
+        )
+
+    def _get_fingerprint_options(self) -> dict:
+        # Builder stages and cache mounts change the layers and files of the image.
+        return {"buildkit_cache": self.buildkit_cache, "multistage": self.multistage}
+
+    @property
+    def buildkit_cache(self) -> bool:
+        """If true, `RUN` instructions mount BuildKit caches for the package managers
+        they use, and package caches are not cleaned up.
+        """
+        return self._buildkit_cache
+
+    @buildkit_cache.setter
+    def buildkit_cache(self, value: bool) -> None:
+        self._buildkit_cache = value
+        self._pkg_manager_helpers = self._get_pkg_manager_helpers()
+        self._clear_cache()
+
+    @property
+    def multistage(self) -> bool:
+        """If true, self-contained templates are installed in builder stages, and their
+        `install_path` is copied into the image. Builder stages do not depend on each
+        other, so BuildKit builds them in parallel.
+        """
+        return self._multistage
+
+    @multistage.setter
+    def multistage(self, value: bool) -> None:
+        self._multistage = value
+        self._clear_cache()
+
+    def _get_directives(self) -> str:
+        # The syntax directive must be the first line of the Dockerfile.
+        if self._dockerfile_syntax is None:
+            return ""
+        return f"# syntax={self._dockerfile_syntax}\n"
+
+    def render_iter(self) -> Iterator[str]:
+        """Yield the rendered Dockerfile in chunks."""
+        directives = self._get_directives()
+        if directives:
+            yield directives
+        parts = self._parts
+        if self._builder_stages:
+            # Builder stages come before the first stage of the image.
+            first = next((i for i, p in enumerate(parts) if p.startswith("FROM ")), 0)
+            stages = [f"{stage}\n" for _, stage in self._builder_stages]
+            parts = [*parts[:first], *stages, *parts[first:]]
+        for i, part in enumerate(parts):
+            if i:
+                yield "\n"
+            yield part
 
         # Save specification to JSON.
-        s += f"\n\n{self._json_save_start}"
+        if self._parts:
+            yield "\n\n"
+        yield self._json_save_start
         if self._current_user != "root":
-            s += "\nUSER root"
-        s += f"\nRUN {self._get_instructions()}"
+            yield "\nUSER root"
+        yield "\nRUN "
+        yield from self._iter_instructions()
         if self._current_user != "root":
-            s += f"\nUSER {self._current_user}"
-        s += f"\n{self._json_save_end}"
-        s = s.strip()  # Prune whitespace from beginning and end.
-        return s
+            yield f"\nUSER {self._current_user}"
+        yield f"\n{self._json_save_end}"
+
+        if self.label_fingerprint:
+            yield f'\nLABEL {REPROENV_FINGERPRINT_LABEL}="{self.fingerprint()}"'
+
+    def _add_fragment(
+        self, template: Template, method: str, fragment: _TemplateFragment
+    ) -> None:
+        """Add the rendered environment and instructions of a template. In multi-stage
+        mode, self-contained templates are installed in a builder stage, and the image
+        gets their environment, their runtime dependencies and a copy of their
+        `install_path`. The runtime dependencies of adjacent templates are installed in
+        one step.
+        """
+        install_path = self._get_builder_install_path(template, method)
+        if install_path is None:
+            super()._add_fragment(template, method, fragment)
+            return
+
+        names = {name for name, _ in self._builder_stages}
+        name = stage = f"{template.name}-builder"
+        n = 1
+        while stage in names:
+            n += 1
+            stage = f"{name}-{n}"
+
+        # The instructions are logged as usual, but are added to the builder stage.
+        parts = self._parts
+        self._parts = [f"FROM {self._base_image} AS {stage}"]
+        try:
+            super()._add_fragment(template, method, fragment)
+            builder = self._parts
+        finally:
+            self._parts = parts
+        self._builder_stages.append((stage, "\n".join(builder)))
+
+        self._add_runtime_dependencies(cast(_BinariesTemplate, template.binaries))
+        if fragment.env is not None:
+            self._parts.append(_get_env_instruction(dict(fragment.env)))
+        self._parts.append(f"COPY --from={stage} --link {install_path} {install_path}")
+        self._dockerfile_syntax = _DOCKERFILE_SYNTAX
+        self._runtime_dependencies_end = len(self._parts)
+        self._clear_cache()
+
+    def _add_runtime_dependencies(self, template_method: _BinariesTemplate) -> None:
+        """Install the runtime dependencies of a template in the image. If the last
+        parts of the image are those of other templates in builder stages, their
+        install instruction installs these dependencies too.
+        """
+        if self._runtime_dependencies_end != len(self._parts):
+            self._runtime_dependencies = (None, {}, {})
+        pkgs = template_method.runtime_dependencies(self.pkg_manager)
+        debs = []
+        if self.pkg_manager == "apt":
+            debs = template_method.runtime_dependencies("debs")
+        if not pkgs and not debs:
+            return
+        index, all_pkgs, all_debs = self._runtime_dependencies
+        if index is None:
+            self._parts.append("")
+            index = len(self._parts) - 1
+            self._runtime_dependencies = (index, all_pkgs, all_debs)
+        all_pkgs.update(dict.fromkeys(pkgs))
+        all_debs.update(dict.fromkeys(debs))
+        command = self._pkg_manager_helpers.install_packages(
+            list(all_pkgs), list(all_debs)
+        )
+        self._parts[index] = self._get_run_instruction(command)
+
+    def _uses_builder_stages(self, template: Template, method: str) -> bool:
+        """Return True if `template` can be installed in a builder stage. Whether it is
+        also depends on the state of the renderer when it is added.
+        """
+        if not self.multistage or method != "binaries":
+            return False
+        template_method = template.binaries
+        return (
+            isinstance(template_method, _BinariesTemplate)
+            and template_method.self_contained
+            and "install_path" in template_method._kwds
+        )
+
+    def _get_builder_install_path(
+        self, template: Template, method: str
+    ) -> Optional[str]:
+        """Return the `install_path` of a template that is installed in a builder
+        stage, or None if the template is installed in the image.
+        """
+        if (
+            not self._uses_builder_stages(template, method)
+            or self._base_image is None
+            # Builder stages install as root.
+            or self._current_user != "root"
+        ):
+            return None
+        template_method = cast(_BinariesTemplate, template.binaries)
+        # Arguments of templates whose fragments were cached are not rendered yet.
+        context = _TemplateContext(template_method, self._pkg_manager_helpers)
+        _resolve_arguments(template_method, context)
+        return template_method.install_path
 
     @_log_instruction
     def arg(self, key: str, value: str = None) -> DockerRenderer:
@@ -505,8 +1441,7 @@ class DockerRenderer(_Renderer):
     @_log_instruction
     def env(self, **kwds: str) -> DockerRenderer:
         """Add a Dockerfile `ENV` instruction."""
-        s = "ENV " + " \\\n    ".join(f'{k}="{v}"' for k, v in kwds.items())
-        self._parts.append(s)
+        self._parts.append(_get_env_instruction(kwds))
         return self
 
     @_log_instruction
@@ -523,12 +1458,15 @@ class DockerRenderer(_Renderer):
         else:
             s = f"FROM {base_image} AS {as_}"
         self._parts.append(s)
+        self._base_image = base_image
         return self
 
     @_log_instruction
     def install(self, pkgs: list[str], opts=None) -> DockerRenderer:
         """Install system packages."""
-        command = _install(pkgs, pkg_manager=self.pkg_manager, opts=opts)
+        command = _install(
+            pkgs, pkg_manager=self.pkg_manager, opts=opts, clean=not self.buildkit_cache
+        )
         command = _indent_run_instruction(command)
         self.run(command)
         return self
@@ -543,14 +1481,53 @@ class DockerRenderer(_Renderer):
     @_log_instruction
     def run(self, command: str) -> DockerRenderer:
         """Add a Dockerfile `RUN` instruction."""
+        self._parts.append(self._get_run_instruction(command))
+        return self
+
+    def _get_run_instruction(self, command: str) -> str:
+        """Return a Dockerfile `RUN` instruction."""
         # TODO: should the command be quoted?
         # s = shlex.quote(command)
         # if s.startswith("'"):
         #     s = s[1:-1]  # Remove quotes on either end of the string.
-        s = command
+        # Leading comments would comment out the instruction, so they are put before
+        # it as Dockerfile comments.
+        lines = command.splitlines()
+        comments = []
+        while len(lines) > 1 and (
+            not lines[0].strip() or lines[0].lstrip().startswith("#")
+        ):
+            line = lines.pop(0).strip()
+            if line:
+                comments.append(line)
+        s = "\n".join(lines)
         s = _indent_run_instruction(f"RUN {s}")
-        self._parts.append(s)
-        return self
+        mounts = []
+        # Cache mounts are owned by root, so other users cannot write to them.
+        if self.buildkit_cache and self._current_user == "root":
+            mounts += _get_buildkit_cache_mounts(command)
+        # Files with checksums are downloaded with `ADD --checksum` in a stage of
+        # their own, so BuildKit caches them by content, and are mounted where the
+        # command would download them.
+        for path, sha256, url in _DOWNLOAD_RE.findall(command):
+            stage = f"download-{sha256[:12]}"
+            name = posixpath.basename(path)
+            if stage not in {n for n, _ in self._builder_stages}:
+                self._builder_stages.append(
+                    (
+                        stage,
+                        f"FROM scratch AS {stage}\n"
+                        f"ADD --checksum=sha256:{sha256} {url} /{name}",
+                    )
+                )
+            mounts.append(
+                f"--mount=type=bind,from={stage},source=/{name},target={path}"
+            )
+        if mounts:
+            self._dockerfile_syntax = _DOCKERFILE_SYNTAX
+            # Put the --mount options on their own lines, before the command.
+            s = "RUN {} \\\n    {}".format(" \\\n    ".join(mounts), s[len("RUN ") :])
+        return "\n".join([*comments, s])
 
     @_log_instruction
     def user(self, user: str) -> DockerRenderer:
@@ -579,9 +1556,20 @@ class DockerRenderer(_Renderer):
 
 class SingularityRenderer(_Renderer):
     def __init__(
-        self, pkg_manager: pkg_managers_type, users: Optional[set[str]] = None
+        self,
+        pkg_manager: pkg_managers_type,
+        users: Optional[set[str]] = None,
+        spec_encoding: spec_encodings_type = "printf",
+        label_fingerprint: bool = False,
+        mirrors: Optional[Mapping[str, str]] = None,
     ) -> None:
-        super().__init__(pkg_manager=pkg_manager, users=users)
+        super().__init__(
+            pkg_manager=pkg_manager,
+            users=users,
+            spec_encoding=spec_encoding,
+            label_fingerprint=label_fingerprint,
+            mirrors=mirrors,
+        )
 
         self._header: _SingularityHeaderType = {}
         # The '%setup' section is intentionally omitted.
@@ -592,51 +1580,55 @@ class SingularityRenderer(_Renderer):
         # TODO: is it OK to use a dict here? Labels could be overwritten.
         self._labels: dict[str, str] = {}
 
-    def render(self) -> str:
-        s = ""
+    def render_iter(self) -> Iterator[str]:
+        """Yield the rendered Singularity recipe in chunks."""
         # Create header.
         if self._header:
-            s += (
+            yield (
                 f"Bootstrap: {self._header['bootstrap']}\nFrom: {self._header['from_']}"
             )
 
         # Add files.
         if self._files:
-            s += "\n\n%files\n"
-            s += "\n".join(self._files)
+            yield "\n\n%files\n"
+            yield "\n".join(self._files)
 
         # Add environment.
         if self._environment:
-            s += "\n\n%environment"
+            yield "\n\n%environment"
             for k, v in self._environment:
-                s += f'\nexport {k}="{v}"'
+                yield f'\nexport {k}="{v}"'
 
         # Add post.
         # There will always be a post section, because we always want to add the
         # reproenv specification.
-        s += "\n\n%post\n"
+        yield "\n\n%post\n"
         # This section might be empty, but that is OK.
-        s += "\n\n".join(self._post)
-        s += f"\n\n{self._json_save_start}"
+        for i, post in enumerate(self._post):
+            if i:
+                yield "\n\n"
+            yield post
+        yield f"\n\n{self._json_save_start}"
         if self._current_user != "root":
-            s += "\nsu - root"
-        s += f"\n{self._get_instructions()}"
+            yield "\nsu - root"
+        yield "\n"
+        yield from self._iter_instructions()
         if self._current_user != "root":
-            s += f"\nsu - {self._current_user}"
-        s += f"\n{self._json_save_end}"
+            yield f"\nsu - {self._current_user}"
+        yield f"\n{self._json_save_end}"
 
         # Add runscript.
         if self._runscript:
-            s += "\n\n%runscript\n"
-            s += self._runscript
+            yield "\n\n%runscript\n"
+            yield self._runscript
 
         # Add labels.
-        if self._labels:
-            s += "\n\n%labels"
+        if self._labels or self.label_fingerprint:
+            yield "\n\n%labels"
             for kv in self._labels.items():
-                s += "\n" + " ".join(kv)
-
-        return s
+                yield "\n" + " ".join(kv)
+            if self.label_fingerprint:
+                yield f"\n{REPROENV_FINGERPRINT_LABEL} {self.fingerprint()}"
 
     @_log_instruction
     def arg(self, key: str, value: str = None) -> SingularityRenderer:
@@ -721,6 +1713,82 @@ class SingularityRenderer(_Renderer):
         return self
 
 
+_MASTHEAD = "# Generated by Neurodocker and Reproenv."
+
+# Dockerfile frontend for `COPY --link`, `ADD --checksum` and `RUN --mount`.
+_DOCKERFILE_SYNTAX = "docker/dockerfile:1.6"
+
+_GZIP_SPEC_RE = re.compile(
+    r"echo ([A-Za-z0-9+/=]+) \| base64 -d \| gunzip > "
+    + re.escape(REPROENV_SPEC_FILE_IN_CONTAINER)
+)
+_PRINTF_SPEC_RE = re.compile(
+    r"printf '(.*)' > " + re.escape(REPROENV_SPEC_FILE_IN_CONTAINER), flags=re.DOTALL
+)
+
+
+def read_spec(spec: str) -> dict:
+    """Return the renderer dictionary that is embedded in a Dockerfile or Singularity
+    recipe generated by a renderer, with any spec encoding.
+
+    The dictionary can be passed to `Renderer.from_dict`. In a container, the same
+    dictionary is saved as JSON in `/.reproenv.json`.
+    """
+    match = _GZIP_SPEC_RE.search(spec)
+    if match is not None:
+        j = gzip.decompress(base64.b64decode(match.group(1))).decode()
+        return json.loads(j)
+    match = _PRINTF_SPEC_RE.search(spec)
+    if match is not None:
+        return json.loads(_unescape_for_printf(match.group(1)))
+    raise RendererError("Container specification does not contain a reproenv spec.")
+
+
+def _get_content_digest(spec: str) -> str:
+    """Return the SHA256 digest of a container specification. Empty lines and
+    commented lines do not affect container definitions, so they are skipped.
+    """
+    h = hashlib.sha256()
+    for line in spec.splitlines():
+        stripped = line.strip()
+        if stripped and not stripped.startswith("#"):
+            h.update(line.encode())
+            h.update(b"\n")
+    return h.hexdigest()
+
+
+# Number of characters of the JSON specification that are escaped at a time.
+_JSON_CHUNK_SIZE = 2**16
+
+
+def _escape_for_printf(s: str) -> str:
+    """Return a chunk of the JSON specification escaped for a single-quoted printf
+    format string.
+    """
+    # Double-escape escaped sequences so that when printf is done with them, they
+    # are escaped with a single slash.
+    s = s.replace("\\", "\\\\")
+    # Same with parentheses.
+    s = s.replace("(", "\\(").replace(")", "\\)")
+    # Add slash to the end of each line. JSON strings cannot contain raw newlines, so
+    # every newline separates two lines.
+    s = s.replace("\n", " \\\n")
+    # Escape the % characters so printf does not interpret them as delimiters.
+    s = s.replace("%", "%%")
+    # Escape single quotes with '"'"'
+    s = s.replace("'", "'\"'\"'")
+    return s
+
+
+def _unescape_for_printf(s: str) -> str:
+    """Return the JSON specification from a printf format string created with
+    `_escape_for_printf`.
+    """
+    s = s.replace("'\"'\"'", "'").replace(" \\\n", "\n")
+    s = re.sub(r"\\([\\()])", r"\1", s)
+    return s.replace("%%", "%")
+
+
 def _indent_run_instruction(string: str, indent=4) -> str:
     """Return indented string for Dockerfile `RUN` command."""
     out = []
@@ -746,20 +1814,189 @@ def _indent_run_instruction(string: str, indent=4) -> str:
     return "\n".join(out)
 
 
-def _install(pkgs: list[str], pkg_manager: str, opts: str = None) -> str:
+def _get_env_instruction(env: Mapping[str, str]) -> str:
+    """Return a Dockerfile `ENV` instruction."""
+    return "ENV " + " \\\n    ".join(f'{k}="{v}"' for k, v in env.items())
+
+
+def _get_hoisting_ranges(
+    renderer: _Renderer, instructions: list[Mapping]
+) -> list[tuple[int, int]]:
+    """Return the ranges of instructions whose template dependencies are hoisted.
+
+    Each range is a run of at least two adjacent templates in the first stage, after
+    the `_default` template, and their dependencies are installed before the first of
+    them. Other instructions, like `run` and `copy`, end a range, so that dependencies
+    are not installed before the instructions that the user put first. Dependencies of
+    templates in later stages are not hoisted, because they must be installed in those
+    stages. Templates that are installed in builder stages of a multi-stage build end
+    a range too, so that their dependencies are not installed in the image.
+    """
+
+    def is_hoisted(mapping: Mapping) -> bool:
+        # Templates are the instructions that are not methods of the renderer.
+        if hasattr(renderer, mapping["name"]):
+            return False
+        try:
+            template, method = renderer._get_registered_template(
+                mapping["name"], **mapping["kwds"]
+            )
+        except TemplateError:
+            # The error is raised when the template is rendered.
+            return True
+        return not renderer._uses_builder_stages(template, method)
+
+    names = [mapping["name"] for mapping in instructions]
+    if "from_" not in names:
+        return []
+    first = names.index("from_")
+    try:
+        stop = names.index("from_", first + 1)
+    except ValueError:
+        stop = len(names)
+    # Templates are rendered before the instructions are added, so they are rendered
+    # as root. Templates after a `user` instruction are not hoisted, because they
+    # are rendered for that user.
+    if "user" in names[first:stop]:
+        stop = names.index("user", first, stop)
+    start = first + 1
+    if "_default" in names[start:stop]:
+        start = names.index("_default", start, stop) + 1
+
+    ranges = []
+    while start < stop:
+        end = start
+        while end < stop and is_hoisted(instructions[end]):
+            end += 1
+        if end - start > 1:
+            ranges.append((start, end))
+        start = end + 1
+    return ranges
+
+
+def _get_command_re(command: str) -> re.Pattern:
+    """Return a regular expression that matches `command` where the shell runs it: at
+    the start of a line or after an operator, optionally after variable assignments
+    and a directory. Mentions of the command in arguments, like in `echo "conda"`, do
+    not match.
+    """
+    return re.compile(
+        r"(?:^|[;&|(]|\b(?:then|do|else|sudo)\b)\s*"
+        r"(?:[A-Za-z_][A-Za-z0-9_]*=\S*\s+)*(?:\S*/)?" + command,
+        re.MULTILINE,
+    )
+
+
+# BuildKit cache mounts, and the commands that use them. In BuildKit cache mode, a
+# `RUN` instruction mounts the caches of the commands in it. Conda only uses the cache
+# mount if the command sets `CONDA_PKGS_DIRS` to it, like the miniconda template does.
+_BUILDKIT_CACHE_MOUNTS = (
+    (_get_command_re(r"apt-get\s"), ("/var/cache/apt", "/var/lib/apt")),
+    (_get_command_re(r"yum\s"), ("/var/cache/yum",)),
+    (
+        _get_command_re(r"export\s+CONDA_PKGS_DIRS=/var/cache/conda/pkgs\b"),
+        ("/var/cache/conda/pkgs",),
+    ),
+    (
+        _get_command_re(r"(?:pip3?|python3?\s+-m\s+pip)\s+install\s"),
+        ("/root/.cache/pip",),
+    ),
+)
+
+
+def _get_buildkit_cache_mounts(command: str) -> list[str]:
+    """Return the `--mount` options of a Dockerfile `RUN` instruction that mount the
+    caches used by `command`. The caches are owned by root, so they are only used by
+    commands that run as root.
+    """
+    lines = [line for line in command.splitlines() if not line.lstrip().startswith("#")]
+    command = "\n".join(lines)
+    return [
+        f"--mount=type=cache,target={target},sharing=locked"
+        for pattern, targets in _BUILDKIT_CACHE_MOUNTS
+        if pattern.search(command)
+        for target in targets
+    ]
+
+
+# Directory that files with checksums are downloaded to, in a directory per checksum.
+_DOWNLOADS_DIR = "/tmp/reproenv-downloads"
+
+# The command of `_add_download_commands` that downloads a file. The groups are the path,
+# the SHA256 checksum and the URL of the file.
+_DOWNLOAD_RE = re.compile(
+    r"^\(test -f ("
+    + re.escape(_DOWNLOADS_DIR)
+    + r"/([0-9a-f]{64})/[^/\s]+) \|\| curl -fsSL -o \S+ (\S+)\)$",
+    re.MULTILINE,
+)
+
+
+def _get_download_path(url: str, sha256: str) -> str:
+    """Return the path that the file at `url` with checksum `sha256` is downloaded to.
+    The name of the file is kept, because templates can use it.
+    """
+    name = posixpath.basename(urllib.parse.urlsplit(url).path)
+    name = re.sub(r"[^A-Za-z0-9._+-]", "_", name).lstrip(".") or "download"
+    return f"{_DOWNLOADS_DIR}/{sha256}/{name}"
+
+
+def _add_download_commands(command: str, downloads: list[tuple[str, str]]) -> str:
+    """Return `command` with commands that download and verify the files in
+    `downloads` (pairs of URLs and SHA256 checksums) before their first use, and that
+    remove them at the end. Files that `command` does not use are skipped.
+
+    Files that exist are not downloaded again, so renderers can provide them in
+    other ways, like with a bind mount.
+    """
+    lines = command.splitlines()
+    dirs: list[str] = []
+    for url, sha256 in downloads:
+        path = _get_download_path(url, sha256)
+        first = next((i for i, line in enumerate(lines) if path in line), None)
+        if first is None or posixpath.dirname(path) in dirs:
+            continue
+        # Insert the commands before the line that the first use continues.
+        while first and lines[first - 1].rstrip().endswith("\\"):
+            first -= 1
+        dirs.append(posixpath.dirname(path))
+        lines[first:first] = [
+            f"mkdir -p {dirs[-1]}",
+            f"(test -f {path} || curl -fsSL -o {path} {url})",
+            f'echo "{sha256}  {path}" | sha256sum -c',
+        ]
+    if dirs:
+        # Mounted files cannot be removed.
+        lines.append("(rm -rf {} 2>/dev/null || true)".format(" ".join(dirs)))
+    return "\n".join(lines)
+
+
+def _install(
+    pkgs: list[str], pkg_manager: str, opts: str = None, clean: bool = True
+) -> str:
     if pkg_manager == "apt":
-        return _apt_install(pkgs, opts)
+        return _apt_install(pkgs, opts, clean=clean)
     elif pkg_manager == "yum":
-        return _yum_install(pkgs, opts)
+        return _yum_install(pkgs, opts, clean=clean)
     # TODO: add debs here?
     else:
         raise RendererError(f"Unknown package manager '{pkg_manager}'.")
 
 
-def _apt_install(pkgs: list[str], opts: str = None, sort=True) -> str:
+# Commands that configure apt to keep downloaded packages. The Docker images of Debian
+# and Ubuntu delete them after every installation.
+_APT_KEEP_CACHE = """\
+rm -f /etc/apt/apt.conf.d/docker-clean
+echo 'Binary::apt::APT::Keep-Downloaded-Packages "true";' > /etc/apt/apt.conf.d/keep-cache
+"""
+
+
+def _apt_install(pkgs: list[str], opts: str = None, sort=True, clean=True) -> str:
     """Return command to install deb packages with `apt-get` (Debian-based distros).
 
     `opts` are options passed to `yum install`. Default is "-q --no-install-recommends".
+    If `clean` is false, downloaded packages and package lists are kept, so they can be
+    reused from a cache.
     """
     pkgs = sorted(pkgs) if sort else pkgs
     opts = "-q --no-install-recommends" if opts is None else opts
@@ -767,15 +2004,19 @@ def _apt_install(pkgs: list[str], opts: str = None, sort=True) -> str:
 apt-get update -qq
 apt-get install -y {opts} \\
     {pkgs}
-rm -rf /var/lib/apt/lists/*
 """.format(opts=opts, pkgs=" \\\n    ".join(pkgs))
+    if clean:
+        s += "rm -rf /var/lib/apt/lists/*"
+    else:
+        s = _APT_KEEP_CACHE + s
     return s.strip()
 
 
-def _apt_install_debs(urls: list[str], opts: str = None, sort=True) -> str:
+def _apt_install_debs(urls: list[str], opts: str = None, sort=True, clean=True) -> str:
     """Return command to install deb packages with `apt-get` (Debian-based distros).
 
-    `opts` are options passed to `yum install`. Default is "-q".
+    `opts` are options passed to `yum install`. Default is "-q". If `clean` is false,
+    package lists are kept, so they can be reused from a cache.
     """
 
     def install_one(url: str):
@@ -791,23 +2032,27 @@ rm "${{_reproenv_tmppath}}\""""
     s = "\n".join(map(install_one, urls))
     s += """
 apt-get update -qq
-apt-get install --yes --quiet --fix-missing
-rm -rf /var/lib/apt/lists/*"""
+apt-get install --yes --quiet --fix-missing"""
+    if clean:
+        s += "\nrm -rf /var/lib/apt/lists/*"
     return s
 
 
-def _yum_install(pkgs: list[str], opts: str = None, sort=True) -> str:
+def _yum_install(pkgs: list[str], opts: str = None, sort=True, clean=True) -> str:
     """Return command to install packages with `yum` (CentOS, Fedora).
 
-    `opts` are options passed to `yum install`. Default is "-q".
+    `opts` are options passed to `yum install`. Default is "-q". If `clean` is false,
+    downloaded packages and metadata are kept, so they can be reused from a cache.
     """
     pkgs = sorted(pkgs) if sort else pkgs
     opts = "-q" if opts is None else opts
+    if not clean:
+        opts = f"--setopt=keepcache=1 {opts}"
 
     s = """\
 yum install -y {opts} \\
     {pkgs}
-yum clean all
-rm -rf /var/cache/yum/*
 """.format(opts=opts, pkgs=" \\\n    ".join(pkgs))
+    if clean:
+        s += "yum clean all\nrm -rf /var/cache/yum/*"
     return s.strip()
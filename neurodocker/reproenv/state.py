@@ -2,28 +2,41 @@
 
 from __future__ import annotations
 
-import copy
+import functools
+import hashlib
 import json
+import marshal
 import os
+import re
+import sys
+import types
 from pathlib import Path
-from typing import ItemsView, KeysView
-
-import jsonschema
-import yaml
-
-# The [C]SafeLoader will only load a subset of YAML, but that is fine for the
-# purposes of this package.
-try:
-    from yaml import CSafeLoader as SafeLoader
-except ImportError:  # pragma: no cover
-    from yaml import SafeLoader  # type: ignore[assignment]  # pragma: no cover
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    ItemsView,
+    Iterable,
+    KeysView,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Union,
+)
 
 from neurodocker.reproenv.exceptions import (
     RendererError,
     TemplateError,
     TemplateNotFound,
 )
-from neurodocker.reproenv.types import TemplateType
+from neurodocker.reproenv.types import (
+    TemplateType,
+    _BinariesTemplateType,
+    _SourceTemplateType,
+)
+
+if TYPE_CHECKING:
+    import jsonschema
 
 _schemas_path = Path(__file__).parent / "schemas"
 
@@ -34,39 +47,485 @@ with (_schemas_path / "renderer.json").open("r") as f:
     _RENDERER_SCHEMA: dict = json.load(f)
 
 
+# Validators are created once, because creating them is expensive relative to
+# validating a single template. They are created when first needed, so that importing
+# this module does not import jsonschema.
+@functools.lru_cache(maxsize=None)
+def _get_template_validator() -> jsonschema.Draft4Validator:
+    import jsonschema
+
+    return jsonschema.Draft4Validator(_TEMPLATE_SCHEMA)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_renderer_validators() -> tuple[
+    jsonschema.Draft4Validator,
+    dict[str, jsonschema.Draft4Validator],
+    jsonschema.Draft4Validator,
+]:
+    """Return validators for renderer dictionaries.
+
+    Renderer dictionaries are validated in two steps. The top level is validated against
+    the renderer schema, with each instruction only required to be an object with a
+    string `name`. Each instruction is then validated against the definition for its
+    `name`, found in a lookup table. This is faster than a `oneOf` over all instructions
+    and registered templates, and registering a template does not change the schema.
+
+    Return the top-level validator, the lookup table of instruction validators, and
+    the validator of instructions that refer to registered templates.
+    """
+    import jsonschema
+
+    renderer_validator = jsonschema.Draft4Validator(
+        {
+            **_RENDERER_SCHEMA,
+            "properties": {
+                **_RENDERER_SCHEMA["properties"],
+                "instructions": {
+                    **_RENDERER_SCHEMA["properties"]["instructions"],
+                    "items": {
+                        "type": "object",
+                        "required": ["name", "kwds"],
+                        "properties": {"name": {"type": "string"}},
+                    },
+                },
+            },
+        }
+    )
+    instruction_validators = {
+        name: jsonschema.Draft4Validator(definition)
+        for name, definition in _RENDERER_SCHEMA["definitions"].items()
+    }
+    # This schema is lax because the kwds just has to be an object. Keys and values in
+    # kwds are validated in the renderer.
+    template_instruction_validator = jsonschema.Draft4Validator(
+        {
+            "required": ["name", "kwds"],
+            "properties": {"name": {"type": "string"}, "kwds": {"type": "object"}},
+            "additionalProperties": False,
+        }
+    )
+    return renderer_validator, instruction_validators, template_instruction_validator
+
+
+# Hashes of templates that are known to be valid. Templates are validated when they are
+# registered, and then again each time a `Template` is created from them, so this saves
+# validating the same template many times.
+_valid_template_hashes: set[str] = set()
+
+
+def _freeze(obj: Any) -> Any:
+    """Return a read-only copy of `obj`, with dictionaries as `types.MappingProxyType`
+    and lists as tuples.
+
+    Templates are frozen when they are registered, so they can be shared by reference
+    instead of copied each time they are used. Mappings that are already read-only are
+    returned as-is.
+    """
+    if isinstance(obj, types.MappingProxyType):
+        return obj
+    if isinstance(obj, dict):
+        return types.MappingProxyType({k: _freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+
+def _thaw(obj: Any) -> Any:
+    """Return a mutable copy of `obj`. This is the inverse of `_freeze`."""
+    if isinstance(obj, (dict, types.MappingProxyType)):
+        return {k: _thaw(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_thaw(v) for v in obj]
+    return obj
+
+
+def _json_default(obj: Any) -> Any:
+    if isinstance(obj, types.MappingProxyType):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _get_template_hash(template: TemplateType) -> str:
+    """Return the sha256 hash of the canonical JSON representation of `template`.
+
+    Frozen templates have the same hash as the dictionaries they were created from.
+    """
+    s = json.dumps(
+        template, sort_keys=True, separators=(",", ":"), default=_json_default
+    )
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+def _get_registered_name(template: TemplateType) -> Optional[str]:
+    """Return the name of `template` in the registry if `template` is the frozen
+    template held by the registry, and None otherwise.
+    """
+    if not isinstance(template, types.MappingProxyType):
+        return None
+    name = template.get("name")
+    if (
+        isinstance(name, str)
+        and _TemplateRegistry._templates.get(name.lower()) is template
+    ):
+        return name.lower()
+    return None
+
+
 def _validate_template(template: TemplateType):
     """Validate template against JSON schema. Raise exception if invalid."""
+    # Registered templates were validated when they were registered.
+    if _get_registered_name(template) is not None:
+        return
+    try:
+        template_hash: Optional[str] = _get_template_hash(template)
+    except (TypeError, ValueError):
+        # Not JSON-serializable, so this template cannot be valid. Let the schema
+        # validation report the error.
+        template_hash = None
+    if template_hash in _valid_template_hashes:
+        return
+
+    import jsonschema
+
     # TODO: should reproenv have a custom exception for invalid templates? probably
+    if isinstance(template, types.MappingProxyType):
+        template = _thaw(template)
+    error = jsonschema.exceptions.best_match(
+        _get_template_validator().iter_errors(template)
+    )
+    if error is not None:
+        raise TemplateError(f"Invalid template: {error.message}.") from error
+
+    for method in ("binaries", "source"):
+        if method in template:
+            optional = template[method].get("arguments", {}).get("optional") or {}
+            try:
+                _sort_arguments(optional)
+                _check_template_variables(template[method], method)
+            except TemplateError as e:
+                raise TemplateError(f"Invalid template: {e} ({method}).") from e
+
+    if template_hash is not None:
+        _valid_template_hashes.add(template_hash)
+
+
+# Variables in templates are written as `self.X`.
+_TEMPLATE_VARIABLE_RE = re.compile(r"\bself\.([A-Za-z_]\w*)")
+
+
+def _sort_arguments(arguments: Mapping[str, str]) -> list[str]:
+    """Return the names of arguments whose values are jinja templates, ordered so that
+    every argument comes after the arguments that its value references.
+
+    Values of arguments can reference other arguments, like
+    `install_path: /opt/fsl-{{ self.version }}`. Rendering the values in this order
+    resolves every reference in one pass. Raise `TemplateError` if the references are
+    cyclic.
+    """
+    deps = {
+        name: [ref for ref in _TEMPLATE_VARIABLE_RE.findall(value) if ref in arguments]
+        for name, value in arguments.items()
+        if "{{" in value and "}}" in value
+    }
+    order: list[str] = []
+    # Arguments that are being visited. Reaching one of these again means there is a
+    # cycle.
+    path: list[str] = []
+
+    def visit(name: str) -> None:
+        if name in order or name not in deps:
+            return
+        if name in path:
+            cycle = path[path.index(name) :] + [name]
+            raise TemplateError(
+                "cyclic references in values of arguments: '{}'".format(
+                    "' -> '".join(cycle)
+                )
+            )
+        path.append(name)
+        for ref in deps[name]:
+            visit(ref)
+        path.pop()
+        order.append(name)
+
+    for name in deps:
+        visit(name)
+    return order
+
+
+def _get_template_variables(source: str) -> set[str]:
+    """Return the names of the variables `self.X` used in the jinja template `source`.
+
+    Raise `TemplateError` if `source` is not a valid jinja template, or if it uses
+    variables that are not attributes of `self`.
+    """
+    import jinja2
+    import jinja2.meta
+    import jinja2.nodes
+
     try:
-        jsonschema.validate(template, schema=_TEMPLATE_SCHEMA)
-    except jsonschema.exceptions.ValidationError as e:
-        raise TemplateError(f"Invalid template: {e.message}.") from e
+        ast = jinja2.Environment().parse(source)
+    except jinja2.TemplateSyntaxError as e:
+        raise TemplateError(f"invalid jinja syntax on line {e.lineno}: {e}") from e
+    # The renderer only provides `self` and the global `raise` function.
+    unknown = jinja2.meta.find_undeclared_variables(ast) - {"self", "raise"}
+    if unknown:
+        raise TemplateError(
+            "variables must be attributes of `self`, but found '{}'".format(
+                "', '".join(sorted(unknown))
+            )
+        )
+    return {
+        node.attr
+        for node in ast.find_all(jinja2.nodes.Getattr)
+        if isinstance(node.node, jinja2.nodes.Name) and node.node.name == "self"
+    }
 
-    # TODO: Check that all variables in the instructions are listed in arguments.
-    # something like https://stackoverflow.com/a/8284419/5666087
-    # but that solution does not get attributes like foo in `self.foo`.
-    # For now, this is taken care of in Renderer classes, but it would be good to move
-    # that behavior here, so we can catch errors early.
-    pass
+
+def _check_template_variables(
+    template: _BinariesTemplateType | _SourceTemplateType, method: str
+) -> None:
+    """Raise `TemplateError` if the binaries or source section `template` uses variables
+    `self.X` that are neither arguments of the template nor attributes of the
+    installation template object (like `self.install_dependencies`).
+    """
+    from neurodocker.reproenv.template import _BinariesTemplate, _SourceTemplate
+
+    sources = [template.get("instructions", "")]
+    for key, value in template.get("env", {}).items():
+        sources += [key, value]
+    # URLs with checksums are mappings.
+    urls = template.get("urls", {}).values()  # type: ignore[attr-defined]
+    sources += [v if isinstance(v, str) else v["url"] for v in urls]
+    arguments = template.get("arguments", {})
+    optional = arguments.get("optional") or {}
+    sources += optional.values()
+
+    used: set[str] = set()
+    for source in sources:
+        if "{{" in source or "{%" in source:
+            used |= _get_template_variables(source)
+
+    cls = _BinariesTemplate if method == "binaries" else _SourceTemplate
+    declared = {
+        *(arguments.get("required") or []),
+        *optional,
+        "pkg_manager",
+        "buildkit_cache",
+    }
+    attributes = {name for name in dir(cls) if not name.startswith("_")}
+    undeclared = used.difference(declared, attributes)
+    if undeclared:
+        raise TemplateError(
+            "variables are not declared in arguments: '{}'".format(
+                "', '".join(sorted(undeclared))
+            )
+        )
 
 
 def _validate_renderer(d):
     """Validate renderer dictionary against JSON schema. Raise exception if invalid."""
+    import jsonschema
+
+    def raise_if_invalid(validator: jsonschema.Draft4Validator, instance) -> None:
+        error = jsonschema.exceptions.best_match(validator.iter_errors(instance))
+        if error is not None:
+            raise RendererError(
+                f"Invalid renderer dictionary: {error.message}."
+            ) from error
+
+    (
+        renderer_validator,
+        instruction_validators,
+        template_instruction_validator,
+    ) = _get_renderer_validators()
+    raise_if_invalid(renderer_validator, d)
+    for instruction in d["instructions"]:
+        name = instruction["name"]
+        validator = instruction_validators.get(name)
+        if validator is None:
+            if name.lower() not in _TemplateRegistry.keys():
+                raise RendererError(
+                    f"Invalid renderer dictionary: unknown instruction or template"
+                    f" '{name}'."
+                )
+            validator = template_instruction_validator
+        raise_if_invalid(validator, instruction)
+
+
+# Matches a top-level `name: ...` entry in a template YAML file. This lets us index a
+# template by name without parsing the whole file.
+_TEMPLATE_NAME_RE = re.compile(
+    r"""^name:[ \t]*(['"]?)([\w.-]+)\1[ \t]*(?:#.*)?$""", re.M
+)
+
+
+class _TemplateIndexEntry(NamedTuple):
+    """Lightweight registry entry for a template that has not been loaded yet."""
+
+    path: Path
+
+
+class _TemplateFile(NamedTuple):
+    """A template file, identified by its modification time and content hash."""
+
+    path: Path
+    mtime: float
+    sha256: str
+
+
+# Version of the format of the on-disk template cache. Increment this if the format of
+# cache entries changes.
+_CACHE_FORMAT = 4
+
+
+def _get_cache_dir() -> Optional[Path]:
+    """Return the directory of the on-disk template cache, or None if it is disabled.
+
+    This is `$REPROENV_CACHE_DIR` if that variable is set (set it to an empty string to
+    disable the cache), and `$XDG_CACHE_HOME/neurodocker/templates` otherwise.
+    """
+    cache_dir = os.environ.get("REPROENV_CACHE_DIR")
+    if cache_dir is not None:
+        return Path(cache_dir) if cache_dir else None
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(xdg_cache_home) / "neurodocker" / "templates"
+
+
+def _get_cache_key(file: _TemplateFile) -> tuple:
+    """Return the key that a cache entry for `file` must have to be used.
+
+    Values derived from templates (like CLI help) depend on the code that created them,
+    so entries written by a different version of neurodocker are not used.
+    """
+    from neurodocker._version import __version__
+
+    return (_CACHE_FORMAT, sys.version_info[:2], __version__, file.mtime, file.sha256)
+
+
+def _get_cache_path(file: _TemplateFile) -> Optional[Path]:
+    cache_dir = _get_cache_dir()
+    if cache_dir is None:
+        return None
+    name = hashlib.sha256(str(file.path.resolve()).encode()).hexdigest()
+    return cache_dir / f"{name}.marshal"
+
+
+def _read_cache(file: _TemplateFile) -> Optional[dict]:
+    """Return the cache entry for `file`, or None if there is no valid entry."""
+    cache_path = _get_cache_path(file)
+    if cache_path is None:
+        return None
+    try:
+        entry = marshal.loads(cache_path.read_bytes())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(entry, dict) or entry.get("key") != _get_cache_key(file):
+        return None
+    return entry
+
+
+def _write_cache(file: _TemplateFile, template: TemplateType, derived: dict) -> None:
+    """Write the validated template in `file` and values derived from it to the cache.
+
+    Errors are ignored, because the cache is only an optimization.
+    """
+    cache_path = _get_cache_path(file)
+    if cache_path is None:
+        return
+    entry = {
+        "key": _get_cache_key(file),
+        "template": _thaw(template),
+        "template_hash": _get_template_hash(template),
+        "derived": derived,
+    }
+    # Write to a temporary file first, so concurrent processes never read a partially
+    # written entry.
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_bytes(marshal.dumps(entry))
+        os.replace(tmp_path, cache_path)
+    except (OSError, ValueError):
+        pass
+
+
+def _load_template_file(path: Path) -> tuple[TemplateType, dict, _TemplateFile]:
+    """Return the validated and frozen template defined in the YAML file `path`, the
+    values derived from it, and the identity of the file.
+
+    If the file has not changed since it was last loaded, the template is read from the
+    on-disk cache, and YAML parsing and validation are skipped.
+    """
+    content = path.read_bytes()
+    file = _TemplateFile(
+        path=path,
+        mtime=path.stat().st_mtime,
+        sha256=hashlib.sha256(content).hexdigest(),
+    )
+    entry = _read_cache(file)
+    if entry is not None:
+        # The template was validated before it was written to the cache.
+        _valid_template_hashes.add(entry["template_hash"])
+        return _freeze(entry["template"]), entry["derived"], file
+    import yaml
+
+    # The [C]SafeLoader will only load a subset of YAML, but that is fine for the
+    # purposes of this package.
     try:
-        jsonschema.validate(d, schema=_RENDERER_SCHEMA)
-    except jsonschema.exceptions.ValidationError as e:
-        raise RendererError(f"Invalid renderer dictionary: {e.message}.") from e
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:  # pragma: no cover
+        from yaml import SafeLoader  # type: ignore[assignment]  # pragma: no cover
+
+    template = yaml.load(content, Loader=SafeLoader)
+    _validate_template(template)
+    _write_cache(file, template, {})
+    return _freeze(template), {}, file
+
+
+def _prepare_template(
+    path_or_template: str | os.PathLike | TemplateType, name: str = None
+) -> tuple[str, TemplateType, dict[str, Any], Optional[_TemplateFile]]:
+    """Load and validate a template before it is added to the registry.
+
+    Return the name of the template, the template, values derived from it, and the file
+    it was loaded from (None if `path_or_template` is a dictionary).
+    """
+    file: Optional[_TemplateFile] = None
+    derived: dict[str, Any] = {}
+    if isinstance(path_or_template, Mapping):
+        template = _freeze(path_or_template)
+        _validate_template(template)
+    else:
+        path = Path(path_or_template)
+        if not path.is_file():
+            raise ValueError("template is not path to a file or a dictionary")
+        template, derived, file = _load_template_file(path)
+    if name is None:
+        name = template["name"]
+    return str(name), template, derived, file
 
 
 class _TemplateRegistry:
-    """Object to hold templates in memory."""
+    """Object to hold templates in memory.
+
+    Templates registered with `index` are kept as `_TemplateIndexEntry` objects and
+    are only loaded and validated the first time they are requested.
+    """
 
-    _templates: dict[str, TemplateType] = {}
+    _templates: dict[str, Union[TemplateType, _TemplateIndexEntry]] = {}
+    # Values derived from templates, like CLI help. See `derived`.
+    _derived: dict[str, dict[str, Any]] = {}
+    # Files of templates that were loaded from disk.
+    _files: dict[str, _TemplateFile] = {}
 
     @classmethod
     def _reset(cls):
         """Clear all templates."""
         cls._templates = {}
+        cls._derived = {}
+        cls._files = {}
 
     @classmethod
     def register(
@@ -78,7 +537,8 @@ class _TemplateRegistry:
         same name in the registry.
 
         The template is validated against reproenv's template JSON schema upon
-        registration. An invalid template will raise an exception.
+        registration. An invalid template will raise an exception. The registry keeps
+        a read-only copy of the template (see `_freeze`), which is returned.
 
         Parameters
         ----------
@@ -91,43 +551,97 @@ class _TemplateRegistry:
             can be omitted and instead comes from `template["name"]`. If
             `path_or_template` is a `dict`, then `name` is required.
         """
-        if isinstance(path_or_template, dict):
-            if name is None:
-                raise ValueError("`name` required when template is not a file")
-            name = str(name)
-            template = copy.deepcopy(path_or_template)
-        else:
-            path_or_template = Path(path_or_template)
-            if not path_or_template.is_file():
-                raise ValueError("template is not path to a file or a dictionary")
-            with path_or_template.open() as f:
-                template = yaml.load(f, Loader=SafeLoader)
+        if isinstance(path_or_template, Mapping) and name is None:
+            raise ValueError("`name` required when template is not a file")
+        name, template, derived, file = _prepare_template(path_or_template, name)
+        cls._add(name, template, derived, file)
+        return template
 
-        _validate_template(template)
-        if name is None:
-            name = str(template["name"])
-
-        # Add the template name as an optional key to the renderer schema. This is
-        # so that the dictionary passed to the `Renderer.from_dict()` method can
-        # contain names of registered templates. These templates are not known when the
-        # renderer schema is created.
-        # However, this schema is lax because the kwds just has to be an object. Keys
-        # and values in kwds are validated in the renderer.
-        key = f"template_{name.replace(' ', '_')}"
-        _RENDERER_SCHEMA["definitions"][key] = {
-            "required": ["name", "kwds"],
-            "properties": {"name": {"enum": [name]}, "kwds": {"type": "object"}},
-            "additionalProperties": False,
-        }
-        # Do not add template to `instructions` properties if it has already been added.
-        template_ref = {"$ref": f"#/definitions/{key}"}
-        oneof = _RENDERER_SCHEMA["properties"]["instructions"]["items"]["oneOf"]
-        if template_ref not in oneof:
-            oneof.append(template_ref)
+    @classmethod
+    def register_many(
+        cls,
+        paths_or_templates: Iterable[str | os.PathLike | TemplateType],
+        max_workers: int = None,
+    ) -> list[str]:
+        """Register many templates at once, and return their names.
+
+        Templates are loaded and validated in parallel. If any template is invalid, an
+        exception is raised and none of the templates are registered.
+
+        Parameters
+        ----------
+        paths_or_templates : iterable of str, Path-like, or TemplateType
+            Paths to YAML files that define templates, or dictionaries that represent
+            templates. The name of each template comes from `template["name"]`.
+        max_workers : int
+            Maximum number of threads used to load templates. See
+            `concurrent.futures.ThreadPoolExecutor`.
+        """
+        import concurrent.futures
 
-        # Add template to registry.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            prepared = list(executor.map(_prepare_template, paths_or_templates))
+        for name, template, derived, file in prepared:
+            cls._add(name, template, derived, file)
+        return [name for name, *_ in prepared]
+
+    @classmethod
+    def _add(
+        cls,
+        name: str,
+        template: TemplateType,
+        derived: dict[str, Any],
+        file: Optional[_TemplateFile],
+    ) -> None:
         # TODO: should we log a message if overwriting a key-value pair?
         cls._templates[name.lower()] = template
+        cls._derived[name.lower()] = derived
+        if file is None:
+            cls._files.pop(name.lower(), None)
+        else:
+            cls._files[name.lower()] = file
+
+    @classmethod
+    def index(cls, path: str | os.PathLike, name: str = None) -> str:
+        """Register a template file without loading it, and return its name.
+
+        The YAML file is only parsed and validated when the template is first
+        requested with `get` or `items`. An invalid template will raise an exception at
+        that time.
+
+        Parameters
+        ----------
+        path : str or Path-like
+            Path to YAML file that defines the template.
+        name : str
+            Name of the template. If omitted, the name is read from the top-level
+            `name` key of the file. If that key cannot be found without parsing the
+            YAML, the template is registered eagerly with `register`.
+        """
+        path = Path(path)
+        if not path.is_file():
+            raise ValueError("template is not path to a file")
+        if name is None:
+            match = _TEMPLATE_NAME_RE.search(path.read_text())
+            if match is None:
+                return str(cls.register(path)["name"])
+            name = match.group(2)
+        name = str(name)
+
+        cls._templates[name.lower()] = _TemplateIndexEntry(path=path)
+        cls._derived.pop(name.lower(), None)
+        cls._files.pop(name.lower(), None)
+        return name
+
+    @classmethod
+    def _load(cls, name: str) -> TemplateType:
+        """Return the template `name`, loading and validating it if necessary."""
+        template = cls._templates[name]
+        if isinstance(template, _TemplateIndexEntry):
+            template, derived, file = _load_template_file(template.path)
+            cls._templates[name] = template
+            cls._derived[name] = derived
+            cls._files[name] = file
         return template
 
     @classmethod
@@ -140,17 +654,35 @@ class _TemplateRegistry:
             The name of the registered template.
 
         If the template is not found, perhaps it was not added to the registry using
-        `register`.
+        `register`. The template is read-only and is shared by all callers.
         """
         name = name.lower()
         try:
-            return cls._templates[name]
+            return cls._load(name)
         except KeyError:
             known = "', '".join(cls._templates.keys())
             raise TemplateNotFound(
                 f"Unknown template '{name}'. Registered templates are '{known}'."
             )
 
+    @classmethod
+    def derived(cls, name: str, key: str, func: Callable[[TemplateType], Any]) -> Any:
+        """Return `func(template)` for the registered template `name`.
+
+        The result is memoized under `key`. For templates that were loaded from files,
+        it is also saved in the on-disk cache, so later processes do not have to
+        compute it again. The result must be serializable with `marshal`.
+        """
+        template = cls.get(name)
+        name = name.lower()
+        derived = cls._derived.setdefault(name, {})
+        if key not in derived:
+            derived[key] = func(template)
+            file = cls._files.get(name)
+            if file is not None:
+                _write_cache(file, template, derived)
+        return derived[key]
+
     @classmethod
     def keys(cls) -> KeysView[str]:
         """Return names of registered templates."""
@@ -158,10 +690,17 @@ class _TemplateRegistry:
 
     @classmethod
     def items(cls) -> ItemsView[str, TemplateType]:
-        return cls._templates.items()
+        """Return names and templates of registered templates. This loads all indexed
+        templates.
+        """
+        for name in cls._templates:
+            cls._load(name)
+        return cls._templates.items()  # type: ignore[return-value]
 
 
 register_template = _TemplateRegistry.register
+register_templates = _TemplateRegistry.register_many
+index_template = _TemplateRegistry.index
 registered_templates = _TemplateRegistry.keys
 registered_templates_items = _TemplateRegistry.items
 get_template = _TemplateRegistry.get
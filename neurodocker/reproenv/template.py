@@ -2,11 +2,17 @@
 
 from __future__ import annotations
 
-import copy
+import functools
 from typing import Mapping, Optional, cast
 
 from neurodocker.reproenv.exceptions import TemplateKeywordArgumentError
-from neurodocker.reproenv.state import _validate_template
+from neurodocker.reproenv.state import (
+    _freeze,
+    _get_registered_name,
+    _get_template_hash,
+    _TemplateRegistry,
+    _validate_template,
+)
 from neurodocker.reproenv.types import (
     TemplateType,
     _BinariesTemplateType,
@@ -46,10 +52,13 @@ class Template:
     ):
         # Validate against JSON schema. Registered templates were already validated at
         # registration time, but if we do not validate here, then in-memory templates
-        # (ie python dictionaries) will never be validated.
+        # (ie python dictionaries) will never be validated. Templates that were
+        # validated before are recognized by their hash and are not validated again.
         _validate_template(template)
 
-        self._template = copy.deepcopy(template)
+        # Templates from the registry are already frozen, so they are shared instead
+        # of copied. Keyword arguments are kept separately.
+        self._template = _freeze(template)
         self._binaries: Optional[_BinariesTemplate] = None
         self._binaries_kwds = {} if binaries_kwds is None else binaries_kwds
         self._source: Optional[_SourceTemplate] = None
@@ -76,6 +85,16 @@ class Template:
     def source(self) -> None | _SourceTemplate:
         return self._source
 
+    @functools.cached_property
+    def _hash(self) -> str:
+        """Hash of the content of the template. For registered templates, this is
+        computed once and saved with the other values derived from the template.
+        """
+        name = _get_registered_name(self._template)
+        if name is not None:
+            return _TemplateRegistry.derived(name, "template_hash", _get_template_hash)
+        return _get_template_hash(self._template)
+
     @property
     def alert(self) -> str:
         """Return the template's `alert` property. Return an empty string if it does
@@ -99,32 +118,57 @@ class _BaseInstallationTemplate:
         from source.
     kwds
         Keyword arguments to pass to the template. All values must be strings. Values
-        that are not strings are cast to string.
+        that are not strings are cast to string. Keyword arguments are available as
+        attributes, like `self.version`.
     """
 
+    __slots__ = (
+        "_template",
+        "_required_arguments",
+        "_optional_arguments",
+        "_all_arguments",
+        "_kwds",
+        "pkg_manager",
+    )
+
     def __init__(
         self,
         template: _BinariesTemplateType | _SourceTemplateType,
         **kwds: str,
     ) -> None:
-        self._template = copy.deepcopy(template)
+        self._template = _freeze(template)
+        # Names of arguments. Variables in the template were checked against these
+        # when the template was validated, so `validate_kwds` only needs to check the
+        # keyword arguments.
+        arguments = self.arguments
+        self._required_arguments = frozenset(arguments.get("required") or ())
+        self._optional_arguments: Mapping[str, str] = arguments.get("optional") or {}
+        self._all_arguments = self._required_arguments.union(self._optional_arguments)
         # User-defined arguments that are passed to template at render time.
         for key, value in kwds.items():
             if not isinstance(value, str):
                 kwds[key] = str(value)  # type: ignore[unreachable]
         self._kwds = kwds
 
-        # This is meant to be overwritten by renderers, so that self.pkg_manager can
-        # be used in templates.
+        # Renderers provide the package manager to templates when they render them.
         self.pkg_manager = None
 
         # We cannot validate kwds immediately... The Renderer should not validate
         # immediately. It should validate only the installation method being used.
-        self._set_kwds_as_attrs()
+        self._set_kwds()
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self._template}, **{self._kwds})"
 
+    def __getattr__(self, name: str) -> str:
+        # This is only called if `name` is not a regular attribute.
+        try:
+            return self._kwds[name]
+        except KeyError:
+            raise AttributeError(
+                f"'{self.__class__.__name__}' object has no attribute '{name}'"
+            ) from None
+
     def validate_kwds(self):
         """Raise `TemplateKeywordArgumentError` if keyword arguments to template are
         invalid.
@@ -139,8 +183,7 @@ class _BaseInstallationTemplate:
             )
 
         # Check that unknown kwargs were not provided.
-        all_kwds = self.required_arguments.union(self.optional_arguments.keys())
-        unknown_kwds = set(self._kwds).difference(all_kwds)
+        unknown_kwds = set(self._kwds).difference(self._all_arguments)
         if unknown_kwds:
             raise TemplateKeywordArgumentError(
                 "Keyword argument provided is not specified in template: '{}'.".format(
@@ -169,9 +212,9 @@ class _BaseInstallationTemplate:
                     )
                 )
 
-    def _set_kwds_as_attrs(self):
+    def _set_kwds(self):
         # Check that keywords do not shadow attributes of this object.
-        shadowed = set(self._kwds).intersection(dir(self))
+        shadowed = _get_reserved_names(type(self)).intersection(self._kwds)
         if shadowed:
             raise TemplateKeywordArgumentError(
                 "Invalid keyword arguments: '{}'. If these keywords are used by the"
@@ -182,10 +225,6 @@ class _BaseInstallationTemplate:
         # provided.
         for k, v in self.optional_arguments.items():
             self._kwds.setdefault(k, v)
-        # Set keywords as attributes to this object. This makes it easy to render
-        # variables in the jinja template.
-        for k, v in self._kwds.items():
-            setattr(self, k, v)
 
     @property
     def template(self):
@@ -204,58 +243,92 @@ class _BaseInstallationTemplate:
         return self._template.get("arguments", {})
 
     @property
-    def required_arguments(self) -> set[str]:
-        args = self.arguments.get("required", None)
-        return set(args) if args is not None else set()
+    def required_arguments(self) -> frozenset[str]:
+        return self._required_arguments
 
     @property
-    def optional_arguments(self) -> dict[str, str]:
-        args = self.arguments.get("optional", None)
-        return args if args is not None else {}
+    def optional_arguments(self) -> Mapping[str, str]:
+        return self._optional_arguments
 
     @property
-    def versions(self) -> set[str]:
+    def versions(self) -> frozenset[str]:
         raise NotImplementedError()
 
     def dependencies(self, pkg_manager: str) -> list[str]:
         deps_dict = self._template.get("dependencies", {})
         # TODO: not sure why the following line raises a type error in mypy.
-        return deps_dict.get(pkg_manager, [])  # type: ignore[return-value]
+        return list(deps_dict.get(pkg_manager, []))  # type: ignore[arg-type]
 
     def install(self, pkgs: list[str], opts: str = None) -> str:
         raise NotImplementedError(
-            "This method is meant to be patched by renderer objects, so it can be used"
+            "This method is meant to be provided by renderer objects, so it can be used"
             " in templates and have access to the pkg_manager being used."
         )
 
     def install_dependencies(self, opts: str = None) -> str:
         raise NotImplementedError(
-            "This method is meant to be patched by renderer objects, so it can be used"
+            "This method is meant to be provided by renderer objects, so it can be used"
             " in templates and have access to the pkg_manager being used."
         )
 
 
 class _BinariesTemplate(_BaseInstallationTemplate):
+    __slots__ = ("_urls", "_checksums", "_versions")
+
     def __init__(self, template: _BinariesTemplateType, **kwds: str):
         super().__init__(template=template, **kwds)
+        urls = cast(_BinariesTemplateType, self._template).get("urls", {})
+        # URLs can reference arguments, like `{{ self.version }}`. Renderers replace
+        # these with the rendered URLs before rendering the instructions.
+        self._urls: Mapping[str, str] = {
+            k: v if isinstance(v, str) else v["url"] for k, v in urls.items()
+        }
+        self._checksums: Mapping[str, str] = {
+            k: v["sha256"] for k, v in urls.items() if not isinstance(v, str)
+        }
+        self._versions = frozenset(self._urls)
 
     @property
     def urls(self) -> Mapping[str, str]:
-        # TODO: how can the code be changed so this cast is not necessary?
-        self._template = cast(_BinariesTemplateType, self._template)
-        return self._template.get("urls", {})
+        return self._urls
+
+    @property
+    def checksums(self) -> Mapping[str, str]:
+        """SHA256 checksums of the files at `urls`, for the versions that have one."""
+        return self._checksums
 
     @property
-    def versions(self) -> set[str]:
-        # TODO: how can the code be changed so this cast is not necessary?
-        self._template = cast(_BinariesTemplateType, self._template)
-        return set(self.urls.keys())
+    def versions(self) -> frozenset[str]:
+        return self._versions
+
+    @property
+    def self_contained(self) -> bool:
+        """True if the installation only writes to `install_path`."""
+        return bool(self._template.get("self_contained", False))
+
+    def runtime_dependencies(self, pkg_manager: str) -> list[str]:
+        """Return the dependencies that the installed software needs to run. These
+        are usually a subset of `dependencies`, without the tools used to install it.
+        """
+        template = cast(_BinariesTemplateType, self._template)
+        deps_dict = template.get("runtime_dependencies", {})
+        return list(deps_dict.get(pkg_manager, []))  # type: ignore[call-overload]
 
 
 class _SourceTemplate(_BaseInstallationTemplate):
+    __slots__ = ()
+
     def __init__(self, template: _SourceTemplateType, **kwds: str):
         super().__init__(template=template, **kwds)
 
     @property
-    def versions(self) -> set[str]:
-        return {"ANY"}
+    def versions(self) -> frozenset[str]:
+        return frozenset({"ANY"})
+
+
+@functools.lru_cache(maxsize=None)
+def _get_reserved_names(cls: type[_BaseInstallationTemplate]) -> frozenset[str]:
+    """Return the names that keyword arguments of `cls` cannot use, because they are
+    attributes of `cls`.
+    """
+    return frozenset(dir(cls))
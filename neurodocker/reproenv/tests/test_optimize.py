@@ -0,0 +1,177 @@
+import pytest
+
+from neurodocker.reproenv.exceptions import RendererError
+from neurodocker.reproenv.optimize import (
+    drop_redundant_instructions,
+    merge_adjacent,
+    merge_runs,
+    move_labels,
+    optimize_instructions,
+)
+from neurodocker.reproenv.renderers import DockerRenderer, SingularityRenderer
+
+
+def _i(name, **kwds):
+    return {"name": name, "kwds": kwds}
+
+
+def test_drop_redundant_instructions():
+    instructions = [
+        _i("from_", base_image="debian"),
+        _i("user", user="root"),
+        _i("user", user="foo"),
+        _i("user", user="foo"),
+        _i("workdir", path="/opt"),
+        _i("workdir", path="/opt"),
+        _i("workdir", path="bin"),
+        _i("workdir", path="/opt"),
+        _i("user", user="root"),
+        _i("user", user="foo"),
+        _i("from_", base_image="debian"),
+        _i("user", user="foo"),
+    ]
+    assert drop_redundant_instructions(instructions) == [
+        _i("from_", base_image="debian"),
+        _i("user", user="foo"),
+        _i("workdir", path="/opt"),
+        _i("workdir", path="bin"),
+        _i("workdir", path="/opt"),
+        # Switching to root and back to foo does nothing. The user of a new stage is
+        # not known.
+        _i("from_", base_image="debian"),
+        _i("user", user="foo"),
+    ]
+
+
+def test_merge_adjacent():
+    instructions = [
+        _i("env", A="1"),
+        _i("env", B="2"),
+        # References a variable of the previous instruction.
+        _i("env", C="$A"),
+        # Sets the same variable.
+        _i("env", C="3"),
+        _i("label", a="1"),
+        _i("label", b="$A"),
+        _i("run", command="echo"),
+        _i("env", D="4"),
+    ]
+    assert merge_adjacent(instructions) == [
+        _i("env", A="1", B="2"),
+        _i("env", C="$A"),
+        _i("env", C="3"),
+        _i("label", a="1", b="$A"),
+        _i("run", command="echo"),
+        _i("env", D="4"),
+    ]
+
+
+def test_move_labels():
+    instructions = [
+        _i("from_", base_image="debian"),
+        _i("label", a="1"),
+        _i("run", command="echo"),
+        _i("from_", base_image="debian"),
+        _i("label", b="2"),
+        _i("run", command="echo"),
+    ]
+    assert move_labels(instructions) == [
+        _i("from_", base_image="debian"),
+        _i("run", command="echo"),
+        _i("label", a="1"),
+        _i("from_", base_image="debian"),
+        _i("run", command="echo"),
+        _i("label", b="2"),
+    ]
+
+
+def test_merge_runs():
+    instructions = [_i("run", command=f"echo {n}") for n in range(5)]
+    assert merge_runs(instructions, max_merged=3) == [
+        _i("run", command="echo 0\necho 1\necho 2"),
+        _i("run", command="echo 3\necho 4"),
+    ]
+    # Commands that change the state of the shell are not merged with the next ones.
+    instructions = [
+        _i("run", command="echo 0"),
+        _i("run", command="mkdir foo\ncd foo"),
+        _i("run", command="echo 1"),
+        _i("run", command="export A=1"),
+        _i("run", command="conda config --set foo"),
+        _i("run", command="echo 2"),
+    ]
+    assert merge_runs(instructions) == [
+        _i("run", command="echo 0\nmkdir foo\ncd foo"),
+        _i("run", command="echo 1\nexport A=1"),
+        _i("run", command="conda config --set foo\necho 2"),
+    ]
+
+    # Commands that end with `;`, `&` or `|`, that assign variables, or that use
+    # builtins that change the shell are not merged with the next ones.
+    for command in [
+        "for f in a b; do echo $f; done;",
+        "sleep 10 &",
+        "echo a |",
+        "x=1",
+        "echo a; y=2",
+        "umask 077",
+        "trap 'rm -f /tmp/x' EXIT",
+        "shopt -s globstar",
+        "exit 0",
+        # A comment would comment out the next command.
+        "echo a # note",
+        "# note\necho a",
+        "echo a;# note",
+    ]:
+        instructions = [_i("run", command=command), _i("run", command="echo b")]
+        assert merge_runs(instructions) == instructions, command
+    # `#` in quotes, in words and in parameter expansions is not a comment.
+    for command in ["echo '# a' \"b # c\"", "echo a#b ${#x} $#", "echo \\# a"]:
+        instructions = [_i("run", command=command), _i("run", command="echo b")]
+        assert merge_runs(instructions) == [_i("run", command=f"{command}\necho b")]
+    # Assignments in arguments are not commands.
+    instructions = [_i("run", command="pip install a==1 --b=c"), _i("run", command="b")]
+    assert merge_runs(instructions) == [_i("run", command="pip install a==1 --b=c\nb")]
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_optimize(renderer_cls):
+    d = {
+        "pkg_manager": "apt",
+        "instructions": [
+            _i("from_", base_image="debian"),
+            _i("env", A="1"),
+            _i("env", B="2"),
+            _i("label", a="1"),
+            _i("run", command="echo 1"),
+            _i("run", command="echo 2"),
+            _i("user", user="foo"),
+            _i("user", user="foo"),
+        ],
+    }
+    assert optimize_instructions(d, 0) == d
+    assert [i["name"] for i in optimize_instructions(d, 1)["instructions"]] == [
+        "from_",
+        "env",
+        "label",
+        "run",
+        "run",
+        "user",
+    ]
+    assert [i["name"] for i in optimize_instructions(d, 2)["instructions"]] == [
+        "from_",
+        "env",
+        "run",
+        "user",
+        "label",
+    ]
+    with pytest.raises(RendererError, match="Unknown optimization level"):
+        optimize_instructions(d, 3)
+
+    # The renderer saves the optimized instructions.
+    r = renderer_cls.from_dict(d, optimize=2)
+    assert r._instructions == {
+        "existing_users": ["root"],
+        **optimize_instructions(d, 2),
+    }
+    assert renderer_cls.from_dict(d, optimize=0).render() != r.render()
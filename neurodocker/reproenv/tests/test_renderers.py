@@ -1,11 +1,17 @@
 import pytest
 
-from neurodocker.reproenv.exceptions import RendererError
+from neurodocker.reproenv.exceptions import RendererError, TemplateKeywordArgumentError
 from neurodocker.reproenv.renderers import (
     DockerRenderer,
     SingularityRenderer,
+    _compile_template,
     _Renderer,
+    clear_fragment_cache,
+    fragment_cache_info,
+    read_spec,
+    set_fragment_cache_size,
 )
+from neurodocker.reproenv.template import Template
 
 
 def test_renderer():
@@ -63,3 +69,373 @@ def test_not_implemented_methods():
 
 
 # TODO: add many tests for `indent`.
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_compiled_templates_are_reused(renderer_cls):
+    d = {
+        "name": "foobar",
+        "url": "some-url",
+        "binaries": {
+            "urls": {"1.0.0": "foobar"},
+            "env": {"FOOBAR_HOME": "{{ self.install_path }}"},
+            "instructions": "echo {{ self.version }} > {{ self.install_path }}",
+            "arguments": {
+                "required": ["version"],
+                "optional": {"install_path": "/opt"},
+            },
+        },
+    }
+    template = Template(d, binaries_kwds=dict(version="1.0.0"))
+
+    renderer_cls("apt").from_("debian").add_template(template, method="binaries")
+    clear_fragment_cache()
+    info = _compile_template.cache_info()
+    r = renderer_cls("apt").from_("debian").add_template(template, method="binaries")
+    assert _compile_template.cache_info().misses == info.misses
+    assert _compile_template.cache_info().hits > info.hits
+    assert "echo 1.0.0 > /opt" in str(r)
+
+
+def test_compiled_templates_are_cached_on_disk(tmp_path, monkeypatch):
+    from neurodocker.reproenv import renderers
+
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("REPROENV_CACHE_DIR", str(cache_dir))
+    source = "echo {{ template.version }} # test_compiled_templates_are_cached_on_disk"
+    _compile_template.cache_clear()
+    assert (
+        _compile_template(source)
+        .render(template={"version": "1.0"})
+        .startswith("echo 1.0 #")
+    )
+    assert len(list((cache_dir / "jinja").glob("*.cache"))) == 1
+
+    # A new process loads the compiled template instead of compiling it.
+    def compile(*args, **kwds):
+        raise AssertionError("template was compiled again")
+
+    _compile_template.cache_clear()
+    monkeypatch.setattr(renderers._jinja_env, "compile", compile)
+    assert (
+        _compile_template(source)
+        .render(template={"version": "2.0"})
+        .startswith("echo 2.0 #")
+    )
+
+    # The cache is not used if it is disabled.
+    monkeypatch.setenv("REPROENV_CACHE_DIR", "")
+    _compile_template.cache_clear()
+    with pytest.raises(AssertionError, match="compiled again"):
+        _compile_template(source)
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_nested_arguments_are_resolved(renderer_cls):
+    d = {
+        "name": "foobar",
+        "url": "some-url",
+        "binaries": {
+            "urls": {"1.0": "https://foo.com/foobar-{{ self.version }}.tar.gz"},
+            "env": {"FOOBAR_HOME": "{{ self.install_path }}"},
+            "instructions": (
+                "curl {{ self.urls[self.version] }}\n./configure {{ self.opts }}"
+            ),
+            "arguments": {
+                "required": ["version"],
+                "optional": {
+                    "opts": "--prefix={{ self.install_path }}",
+                    "install_path": "/opt/foobar-{{ self.version }}",
+                },
+            },
+        },
+    }
+    r = renderer_cls("apt").from_("debian")
+    r.add_template(Template(d, binaries_kwds=dict(version="1.0")), method="binaries")
+    assert "/opt/foobar-1.0" in str(r)
+    assert "curl https://foo.com/foobar-1.0.tar.gz" in str(r)
+    assert "./configure --prefix=/opt/foobar-1.0" in str(r)
+    assert "{{" not in str(r)
+
+    # Keyword arguments can reference other arguments, too.
+    r = renderer_cls("apt").from_("debian")
+    t = Template(d, binaries_kwds=dict(version="1.0", install_path="/{{ self.opts }}"))
+    with pytest.raises(TemplateKeywordArgumentError, match="'opts' -> 'install_path'"):
+        r.add_template(t, method="binaries")
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_rendered_fragments_are_reused(renderer_cls):
+    d = {
+        "name": "foobar",
+        "url": "some-url",
+        "binaries": {
+            "urls": {"1.0": "foobar"},
+            "env": {"FOOBAR_HOME": "/opt/foobar-{{ self.version }}"},
+            "instructions": "echo {{ self.version }} {{ self.pkg_manager }}",
+            "arguments": {"required": ["version"]},
+        },
+    }
+
+    def render(pkg_manager, **kwds):
+        r = renderer_cls(pkg_manager).from_("debian")
+        return str(r.add_template(Template(d, binaries_kwds=kwds), method="binaries"))
+
+    clear_fragment_cache()
+    first = render("apt", version="1.0")
+    assert fragment_cache_info()[:2] == (0, 1)
+    # Identical templates, methods, keyword arguments and package managers are
+    # rendered once.
+    assert render("apt", version="1.0") == first
+    assert fragment_cache_info()[:2] == (1, 1)
+    assert "echo 1.0 apt" in first
+    assert "echo 1.0 yum" in render("yum", version="1.0")
+    assert fragment_cache_info()[:2] == (1, 2)
+
+    # The least recently used fragments are evicted.
+    set_fragment_cache_size(1)
+    assert fragment_cache_info().currsize == 1
+    render("apt", version="1.0")
+    assert fragment_cache_info().misses == 3
+    set_fragment_cache_size(0)
+    render("apt", version="1.0")
+    render("apt", version="1.0")
+    assert fragment_cache_info()[1:] == (5, 0, 0)
+    with pytest.raises(ValueError):
+        set_fragment_cache_size(-1)
+    set_fragment_cache_size(256)
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_log_instruction_arguments(renderer_cls):
+    r = renderer_cls("apt").from_("debian")
+    r.arg("foo")
+    r.arg(value="1", key="bar")
+    r.env(A="1", B="2")
+    r.copy("a", "/c")
+    r.run(command="echo hi")
+    assert r._instructions["instructions"] == [
+        {"name": "from_", "kwds": {"base_image": "debian"}},
+        {"name": "arg", "kwds": {"key": "foo"}},
+        {"name": "arg", "kwds": {"key": "bar", "value": "1"}},
+        {"name": "env", "kwds": {"A": "1", "B": "2"}},
+        {"name": "copy", "kwds": {"source": "a", "destination": "/c"}},
+        {"name": "run", "kwds": {"command": "echo hi"}},
+    ]
+
+    # Invalid arguments raise TypeError and are not logged.
+    n = len(r._instructions["instructions"])
+    with pytest.raises(TypeError):
+        r.run()
+    with pytest.raises(TypeError):
+        r.run("echo hi", command="echo hi")
+    with pytest.raises(TypeError):
+        r.run("echo hi", "echo hi")
+    with pytest.raises(TypeError):
+        r.user(name="foo")
+    with pytest.raises(TypeError):
+        r.env("A=1")
+    assert len(r._instructions["instructions"]) == n
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_render_iter_and_render_to(renderer_cls, tmp_path):
+    r = renderer_cls("apt")
+    assert "".join(r.render_iter()) == r.render()
+
+    r.from_("debian").run("echo '%s (x)'").env(A="1").user("nonroot")
+    assert "".join(r.render_iter()) == r.render()
+    assert str(r) == "# Generated by Neurodocker and Reproenv.\n\n" + r.render()
+
+    path = tmp_path / "spec"
+    with path.open("w") as f:
+        r.render_to(f)
+    assert path.read_text() == str(r)
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_rendered_output_is_cached(renderer_cls):
+    r = renderer_cls("apt").from_("debian")
+    rendered = r.render()
+    digest = r.digest
+    assert r.render() is rendered
+    assert r.digest == digest
+
+    # Adding an instruction invalidates the cached output.
+    r.run("echo hi")
+    assert r.render() is not rendered
+    assert "echo hi" in r.render()
+    assert r.digest != digest
+
+    # Changing an option of the output invalidates the cached output too.
+    rendered, digest = r.render(), r.digest
+    r.label_fingerprint = True
+    assert r.fingerprint() in r.render()
+    assert r.digest != digest
+    r.label_fingerprint = False
+    r.spec_encoding = "gzip"
+    assert r.render() != rendered
+    assert r.digest != digest
+    r.spec_encoding = "printf"
+    assert r.render() == rendered
+    with pytest.raises(RendererError, match="Unknown spec encoding"):
+        r.spec_encoding = "json"
+
+    # Empty lines and comments do not affect equality.
+    other = renderer_cls("apt").from_("debian").run("echo hi")
+    assert r == other
+    assert r == "\n# comment\n" + str(other) + "\n\n"
+    assert r != other.run("echo bye")
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+@pytest.mark.parametrize("spec_encoding", ["printf", "gzip"])
+def test_read_spec(renderer_cls, spec_encoding):
+    r = renderer_cls("apt", spec_encoding=spec_encoding).from_("debian")
+    r.run("echo '%s (x)' \\\\ \"y\" > /.reproenv.json").user("nonroot")
+    spec = read_spec(str(r))
+    assert spec == r._instructions
+    assert renderer_cls.from_dict(spec, spec_encoding=spec_encoding) == r
+
+    with pytest.raises(RendererError):
+        read_spec("FROM debian")
+    with pytest.raises(RendererError):
+        renderer_cls("apt", spec_encoding="zip")
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_fingerprint(renderer_cls):
+    d = {
+        "name": "foobar",
+        "url": "some-url",
+        "binaries": {
+            "urls": {"1.0": "foobar"},
+            "instructions": "echo {{ self.version }}",
+            "arguments": {"required": ["version"]},
+        },
+    }
+
+    def make(**kwds):
+        r = renderer_cls("apt", users={"root", "foo", "bar"}, **kwds).from_("debian")
+        t = Template(d, binaries_kwds=dict(version="1.0"))
+        return r.add_template(t, method="binaries")
+
+    r = make()
+    fingerprint = r.fingerprint()
+    assert len(fingerprint) == 64
+    assert make().fingerprint() == fingerprint
+    # The content of the template is part of the fingerprint.
+    d["alert"] = "foobar is experimental."
+    assert make().fingerprint() != fingerprint
+    del d["alert"]
+    # The fingerprint does not depend on how the specification is rendered.
+    assert make(spec_encoding="gzip").fingerprint() == fingerprint
+    # Mirrors do not change the software in the container.
+    d["binaries"]["instructions"] = "curl {{ self.urls[self.version] }}"
+    fingerprint = make().fingerprint()
+    mirrored = make(mirrors={"foo": "http://mirror/foo"})
+    assert "curl http://mirror/foo" in str(mirrored)
+    assert mirrored.fingerprint() == fingerprint
+    assert fingerprint not in str(r)
+    assert fingerprint in str(make(label_fingerprint=True))
+
+    r.run("echo hi")
+    assert r.fingerprint() != fingerprint
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_downloads_with_checksums(renderer_cls):
+    sha256 = "0123456789abcdef" * 4
+    path = f"/tmp/reproenv-downloads/{sha256}/foo.tar.gz"
+    d = {
+        "name": "foo",
+        "url": "some-url",
+        "binaries": {
+            "arguments": {"required": ["version"]},
+            "urls": {
+                "1.0": {"url": "https://example.com/foo.tar.gz", "sha256": sha256},
+                "2.0": "https://example.com/bar.tar.gz",
+            },
+            "instructions": "echo hi\ncurl -fsSL {{ self.urls[self.version] }} \\\n"
+            "  | tar -xz",
+        },
+    }
+    r = renderer_cls("apt").from_("debian")
+    r.add_template(Template(d, binaries_kwds={"version": "1.0"}), "binaries")
+    assert r._instructions["instructions"][-1]["kwds"]["command"] == (
+        f"""echo hi
+mkdir -p /tmp/reproenv-downloads/{sha256}
+(test -f {path} || curl -fsSL -o {path} https://example.com/foo.tar.gz)
+echo "{sha256}  {path}" | sha256sum -c
+curl -fsSL file://{path} \\
+  | tar -xz
+(rm -rf /tmp/reproenv-downloads/{sha256} 2>/dev/null || true)"""
+    )
+
+    # URLs without checksums are downloaded as usual.
+    r = renderer_cls("apt").from_("debian")
+    r.add_template(Template(d, binaries_kwds={"version": "2.0"}), "binaries")
+    assert r._instructions["instructions"][-1]["kwds"]["command"] == (
+        "echo hi\ncurl -fsSL https://example.com/bar.tar.gz \\\n  | tar -xz"
+    )
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_mirrors(renderer_cls):
+    mirrors = {
+        "http://": "http://mirror/",
+        "http://mirrors.kernel.org/debian/": "http://debian-mirror/",
+    }
+    r = renderer_cls("apt", mirrors=mirrors).from_("debian")
+    r.add_registered_template("afni", method="binaries", version="latest")
+    s = str(r)
+    assert "http://debian-mirror/pool/main/libx/libxp/libxp6_1.0.2-2_amd64.deb" in s
+    assert "http://mirror/snapshot.debian.org/archive/" in s
+    assert "http://mirrors.kernel.org" not in s
+    assert "http://mirror/afni.nimh.nih.gov/" not in s
+
+    # Fragments are cached per mirrors.
+    r = renderer_cls("apt").from_("debian")
+    r.add_registered_template("afni", method="binaries", version="latest")
+    assert "http://mirrors.kernel.org" in str(r)
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_hoist_dependencies(renderer_cls):
+    ants = {"name": "ants", "kwds": {"version": "2.4.3"}}
+    d = {
+        "pkg_manager": "apt",
+        "instructions": [
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            {"name": "run", "kwds": {"command": "echo hi"}},
+            ants,
+            {"name": "jq", "kwds": {"version": "1.6"}},
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            ants,
+        ],
+    }
+    r = renderer_cls.from_dict(d, hoist_dependencies=True)
+    instructions = r._instructions["instructions"]
+    assert [i["name"] for i in instructions[:3]] == ["from_", "run", "run"]
+    # Dependencies are installed after the `run` instruction, once for both templates.
+    assert instructions[1]["kwds"]["command"] == "echo hi"
+    hoisted = instructions[2]["kwds"]["command"]
+    assert hoisted.count("apt-get install") == 1
+    assert hoisted.split().count("curl") == 1
+    assert "apt-get install" not in instructions[4]["kwds"]["command"]
+    # Templates in later stages install their own dependencies.
+    assert "apt-get install" in instructions[-1]["kwds"]["command"]
+
+    # Dependencies are not installed before instructions between templates.
+    d["instructions"][1:4] = [
+        ants,
+        {"name": "run", "kwds": {"command": "echo hi"}},
+        ants,
+    ]
+    r = renderer_cls.from_dict(d, hoist_dependencies=True)
+    instructions = r._instructions["instructions"]
+    names = [i["name"] for i in instructions]
+    assert names[:6] == ["from_", "env", "run", "run", "env", "run"]
+    assert "apt-get install" in instructions[2]["kwds"]["command"]
+    assert instructions[3]["kwds"]["command"] == "echo hi"
+    assert "apt-get install" in instructions[5]["kwds"]["command"]
@@ -1,7 +1,13 @@
+import io
+
 import pytest
 
 from neurodocker.reproenv.exceptions import RendererError
-from neurodocker.reproenv.renderers import DockerRenderer
+from neurodocker.reproenv.renderers import (
+    DockerRenderer,
+    _get_buildkit_cache_mounts,
+    _TemplateFragment,
+)
 from neurodocker.reproenv.template import Template
 from neurodocker.reproenv.tests.utils import prune_rendered
 
@@ -317,3 +323,195 @@ RUN bash -c 'source activate'"""
 FROM debian:bullseye-slim
 ENTRYPOINT ["echo", "foo bar"]"""
     )
+
+
+def test_docker_renderer_multistage():
+    d = {
+        "name": "foobar",
+        "url": "some-url",
+        "binaries": {
+            "self_contained": True,
+            "urls": {"1.0.0": "foobar"},
+            "env": {"foo": "bar"},
+            "instructions": "{{self.install_dependencies()}}\necho {{self.install_path}}",
+            "arguments": {"required": [], "optional": {"install_path": "/opt/foo"}},
+            "dependencies": {"apt": ["curl"], "debs": [], "yum": ["python"]},
+            "runtime_dependencies": {"apt": ["libfoo"]},
+        },
+    }
+    r = DockerRenderer("apt", multistage=True).from_("debian")
+    r.add_template(Template(d), method="binaries")
+    r.add_template(Template(d, binaries_kwds={"install_path": "/opt/bar"}), "binaries")
+    assert [stage for stage, _ in r._builder_stages] == [
+        "foobar-builder",
+        "foobar-builder-2",
+    ]
+    assert r._builder_stages[1][1] == (
+        """FROM debian AS foobar-builder-2
+ENV foo="bar"
+RUN apt-get update -qq \\
+    && apt-get install -y -q --no-install-recommends \\
+           curl \\
+    && rm -rf /var/lib/apt/lists/* \\
+    && echo /opt/bar"""
+    )
+    # The image only installs the runtime dependencies, once for both templates.
+    assert r._parts[1:] == [
+        """RUN apt-get update -qq \\
+    && apt-get install -y -q --no-install-recommends \\
+           libfoo \\
+    && rm -rf /var/lib/apt/lists/*""",
+        'ENV foo="bar"',
+        "COPY --from=foobar-builder --link /opt/foo /opt/foo",
+        'ENV foo="bar"',
+        "COPY --from=foobar-builder-2 --link /opt/bar /opt/bar",
+    ]
+    rendered = str(r)
+    assert rendered.index("AS foobar-builder-2") < rendered.index("FROM debian\n")
+    # `COPY --link` needs a newer frontend than the default of older Docker versions.
+    assert rendered.startswith("# syntax=docker/dockerfile:1.6\n# Generated by")
+    # Dockerfiles built from `render()` need the directive too.
+    assert r.render().startswith("# syntax=docker/dockerfile:1.6\nFROM debian AS ")
+    assert r.render().count("# syntax=") == rendered.count("# syntax=") == 1
+    f = io.StringIO()
+    r.render_to(f)
+    assert f.getvalue() == rendered
+    # The specification does not depend on the stages.
+    single = DockerRenderer("apt").from_("debian")
+    single.add_template(Template(d), method="binaries")
+    single.add_template(
+        Template(d, binaries_kwds={"install_path": "/opt/bar"}), "binaries"
+    )
+    assert r._instructions == single._instructions
+    assert str(single).startswith("# Generated by")
+    # The stages change the image, so they are part of the fingerprint.
+    assert r.fingerprint() != single.fingerprint()
+    single.multistage = True
+    assert r.fingerprint() == single.fingerprint()
+
+    # Runtime dependencies are not installed before other instructions.
+    r.run("echo hi")
+    d["binaries"]["runtime_dependencies"]["apt"] = ["libfoo", "libbar"]
+    r.add_template(Template(d, binaries_kwds={"install_path": "/opt/baz"}), "binaries")
+    assert r._parts[-4] == "RUN echo hi"
+    assert "libbar" in r._parts[-3] and "curl" not in r._parts[-3]
+
+    # Templates that are not self-contained are installed in the image.
+    d["binaries"]["self_contained"] = False
+    r = DockerRenderer("apt", multistage=True).from_("debian")
+    r.add_template(Template(d), method="binaries")
+    assert not r._builder_stages
+    assert "COPY" not in str(r)
+
+
+def test_docker_renderer_downloads_with_checksums():
+    sha256 = "0123456789abcdef" * 4
+    path = f"/tmp/reproenv-downloads/{sha256}/foo.tar.gz"
+    d = {
+        "name": "foo",
+        "url": "some-url",
+        "binaries": {
+            "urls": {
+                "1.0": {"url": "https://example.com/foo.tar.gz", "sha256": sha256}
+            },
+            "instructions": "curl -fsSL {{ self.urls['1.0'] }} | tar -xz",
+        },
+    }
+    r = DockerRenderer("apt").from_("debian")
+    r.add_template(Template(d), "binaries")
+    r.add_template(Template(d), "binaries")
+    # Both templates use one download stage.
+    assert r._builder_stages == [
+        (
+            "download-0123456789ab",
+            "FROM scratch AS download-0123456789ab\n"
+            f"ADD --checksum=sha256:{sha256} https://example.com/foo.tar.gz"
+            " /foo.tar.gz",
+        )
+    ]
+    mount = (
+        "RUN --mount=type=bind,from=download-0123456789ab,source=/foo.tar.gz,"
+        f"target={path} \\\n"
+    )
+    assert r._parts[-1].startswith(mount)
+    rendered = str(r)
+    assert rendered.startswith("# syntax=docker/dockerfile:1.6\n")
+    assert r.render().startswith("# syntax=docker/dockerfile:1.6\nFROM scratch AS ")
+    assert rendered.index("FROM scratch AS download") < rendered.index("FROM debian\n")
+
+    # Instructions from a specification mount the downloads too.
+    assert str(DockerRenderer.from_dict(r._instructions)) == rendered
+
+
+def test_docker_renderer_run_leading_comments():
+    d = DockerRenderer("apt").from_("debian")
+    d.run("\n# Install foo.\n\necho foo\n# Install bar.\necho bar")
+    # Leading comments are put before the instruction, so they do not comment it out.
+    assert (
+        d._parts[-1]
+        == """\
+# Install foo.
+RUN echo foo \\
+    # Install bar.
+    && echo bar"""
+    )
+
+
+@pytest.mark.parametrize(
+    "command,targets",
+    [
+        ("apt-get update", ["/var/cache/apt", "/var/lib/apt"]),
+        ("cd /tmp && yum install -y git", ["/var/cache/yum"]),
+        (
+            'bash -c "source activate env\n  python -m pip install six"',
+            ["/root/.cache/pip"],
+        ),
+        ("/opt/conda/bin/pip install six", ["/root/.cache/pip"]),
+        ("export CONDA_PKGS_DIRS=/var/cache/conda/pkgs", ["/var/cache/conda/pkgs"]),
+        # Commands that are only mentioned do not use caches.
+        ('echo "Installing FSL conda environment ..."', []),
+        ("# pip install six\necho apt-get", []),
+        # Conda only uses the cache if `CONDA_PKGS_DIRS` is set to it.
+        ("conda install -y numpy", []),
+    ],
+)
+def test_docker_renderer_buildkit_cache_mounts(command, targets):
+    assert _get_buildkit_cache_mounts(command) == [
+        f"--mount=type=cache,target={target},sharing=locked" for target in targets
+    ]
+
+
+def test_docker_renderer_cached_output_is_reset():
+    d = {
+        "name": "foobar",
+        "url": "some-url",
+        "binaries": {
+            "self_contained": True,
+            "urls": {"1.0.0": "foobar"},
+            "instructions": "{{self.install_dependencies()}}",
+            "arguments": {"required": [], "optional": {"install_path": "/opt/foo"}},
+        },
+    }
+    r = DockerRenderer("apt", multistage=True).from_("debian")
+    rendered, digest = r.render(), r.digest
+    # Templates whose dependencies are hoisted can be empty. They do not log any
+    # instructions, but they add a stage and a copy.
+    fragment = _TemplateFragment(env=None, command=None, dependencies=((), ()))
+    r._add_fragment(Template(d), "binaries", fragment)
+    assert r.render() != rendered
+    assert "COPY --from=foobar-builder" in r.render()
+    assert r.digest != digest
+
+    # Changing options resets the cached output, and updates how templates install
+    # packages.
+    r = DockerRenderer("apt").from_("debian")
+    r.install(["curl"])
+    rendered = r.render()
+    r.buildkit_cache = True
+    assert r._pkg_manager_helpers.buildkit_cache
+    assert r.render() is not rendered
+    r.install(["git"])
+    assert "--mount=type=cache" in r.render()
+    rendered = r.render()
+    r.multistage = True
+    assert r.render() is not rendered
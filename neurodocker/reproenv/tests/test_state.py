@@ -1,10 +1,16 @@
+import copy
 from pathlib import Path
 
 import pytest
 import yaml
 
-from neurodocker.reproenv import exceptions, types
-from neurodocker.reproenv.state import _TemplateRegistry, _validate_template
+from neurodocker.reproenv import exceptions, state, types
+from neurodocker.reproenv.state import (
+    _TemplateIndexEntry,
+    _TemplateRegistry,
+    _validate_renderer,
+    _validate_template,
+)
 
 
 def test_validate_template_invalid_templates():
@@ -124,8 +130,85 @@ def test_validate_template_invalid_templates():
             }
         )
 
-    # defines variable but does not indicate if optional or required
-    # TODO
+    # cyclic default values of optional arguments
+    with pytest.raises(
+        exceptions.TemplateError,
+        match="cyclic references in values of arguments: 'a' -> 'b' -> 'a'",
+    ):
+        _validate_template(
+            {
+                "name": "foobar",
+                "url": "some-url",
+                "source": {
+                    "instructions": "echo {{ self.a }}",
+                    "arguments": {
+                        "optional": {"a": "{{ self.b }}", "b": "x-{{ self.a }}"}
+                    },
+                },
+            }
+        )
+
+    # uses variable that is not declared in arguments
+    with pytest.raises(
+        exceptions.TemplateError,
+        match="variables are not declared in arguments: 'bar', 'foo' \\(binaries\\)",
+    ):
+        _validate_template(
+            {
+                "name": "foobar",
+                "url": "some-url",
+                "binaries": {
+                    "urls": {"1.0": "https://foo.com/{{ self.bar }}"},
+                    "env": {"PATH": "{{ self.install_path }}:$PATH"},
+                    "instructions": "{{ self.install_dependencies() }}\n{{ self.foo }}",
+                    "arguments": {"optional": {"install_path": "/opt/foo"}},
+                },
+            }
+        )
+    # uses variable that is not declared in a URL with a checksum
+    with pytest.raises(
+        exceptions.TemplateError,
+        match="variables are not declared in arguments: 'bar' \\(binaries\\)",
+    ):
+        _validate_template(
+            {
+                "name": "foobar",
+                "url": "some-url",
+                "binaries": {
+                    "urls": {
+                        "1.0": {
+                            "url": "https://foo.com/{{ self.bar }}",
+                            "sha256": "0" * 64,
+                        }
+                    },
+                    "instructions": "echo foo",
+                },
+            }
+        )
+    # uses variable that is not an attribute of self
+    with pytest.raises(
+        exceptions.TemplateError, match="must be attributes of `self`, but found 'foo'"
+    ):
+        _validate_template(
+            {
+                "name": "foobar",
+                "url": "some-url",
+                "source": {
+                    "instructions": "{% for x in [1] %}{{ x }}{% endfor %}{{ foo }}"
+                },
+            }
+        )
+    # invalid jinja syntax
+    with pytest.raises(
+        exceptions.TemplateError, match="invalid jinja syntax on line 2"
+    ):
+        _validate_template(
+            {
+                "name": "foobar",
+                "url": "some-url",
+                "source": {"instructions": "echo foo\n{{ self.foo "},
+            }
+        )
 
     #
     # test of 'source' templates
@@ -248,6 +331,29 @@ def test_validate_template_valid_templates():
     )
 
 
+def test_validate_template_once(monkeypatch: pytest.MonkeyPatch):
+    template = {
+        "name": "foobar",
+        "url": "some-url",
+        "binaries": {"urls": {"v1": "foo"}, "instructions": "validate-once"},
+    }
+    _validate_template(template)
+    assert state._get_template_hash(template) in state._valid_template_hashes
+
+    class FailingValidator:
+        def iter_errors(self, instance):
+            raise AssertionError("template should not be validated again")
+
+    monkeypatch.setattr(state, "_get_template_validator", FailingValidator)
+    # same content, different object
+    _validate_template(copy.deepcopy(template))
+
+    # changed content is validated
+    template["binaries"]["instructions"] = "validate-twice"
+    with pytest.raises(AssertionError):
+        _validate_template(template)
+
+
 def test_register(tmp_path: Path):
     _TemplateRegistry._reset()
 
@@ -286,10 +392,10 @@ def test_register(tmp_path: Path):
     name: str = "customname"
     _TemplateRegistry._reset()
     _TemplateRegistry.register(_one_test_template, name=name)
-    assert _TemplateRegistry._templates[name] == _one_test_template
+    assert state._thaw(_TemplateRegistry._templates[name]) == _one_test_template
     assert not _TemplateRegistry._templates[name] is _one_test_template
-    assert _TemplateRegistry.get(name) == _one_test_template
-    assert _TemplateRegistry.get(name.upper()) == _one_test_template
+    assert state._thaw(_TemplateRegistry.get(name)) == _one_test_template
+    assert _TemplateRegistry.get(name.upper()) is _TemplateRegistry.get(name)
     with pytest.raises(exceptions.TemplateNotFound):
         _TemplateRegistry.get(_one_test_template["name"])
 
@@ -304,23 +410,175 @@ def test_register(tmp_path: Path):
     name = _one_test_template["name"]
     _TemplateRegistry._reset()
     _TemplateRegistry.register(yaml_path)
-    assert _TemplateRegistry._templates[name] == _one_test_template
+    assert state._thaw(_TemplateRegistry._templates[name]) == _one_test_template
     assert not _TemplateRegistry._templates[name] is _one_test_template
-    assert _TemplateRegistry.get(name) == _one_test_template
-    assert _TemplateRegistry.get(name.upper()) == _one_test_template
+    assert state._thaw(_TemplateRegistry.get(name)) == _one_test_template
+    assert state._thaw(_TemplateRegistry.get(name.upper())) == _one_test_template
 
     # register using custom name
     name = "customfoobar"
     _TemplateRegistry._reset()
     _TemplateRegistry.register(yaml_path, name=name)
-    assert _TemplateRegistry._templates[name] == _one_test_template
+    assert state._thaw(_TemplateRegistry._templates[name]) == _one_test_template
     assert not _TemplateRegistry._templates[name] is _one_test_template
-    assert _TemplateRegistry.get(name) == _one_test_template
-    assert _TemplateRegistry.get(name.upper()) == _one_test_template
+    assert state._thaw(_TemplateRegistry.get(name)) == _one_test_template
+    assert state._thaw(_TemplateRegistry.get(name.upper())) == _one_test_template
     with pytest.raises(exceptions.TemplateNotFound):
         _TemplateRegistry.get(_one_test_template["name"])
 
 
+def test_index(tmp_path: Path):
+    _TemplateRegistry._reset()
+
+    _one_test_template: types.TemplateType = {
+        "name": "foobar",
+        "url": "some-url",
+        "binaries": {"urls": {"1.0.0": "foobar.com"}, "instructions": "foobar"},
+    }
+    yaml_path = tmp_path / "foo.yaml"
+    with yaml_path.open("w") as f:
+        yaml.dump(_one_test_template, f)
+
+    with pytest.raises(ValueError):
+        _TemplateRegistry.index(tmp_path / "baz.yaml")
+
+    # name is read from the file, but the template is not loaded yet
+    assert _TemplateRegistry.index(yaml_path) == "foobar"
+    entry = _TemplateRegistry._templates["foobar"]
+    assert isinstance(entry, _TemplateIndexEntry)
+    assert entry.path == yaml_path
+    assert _TemplateRegistry.keys() == {"foobar"}
+    # loaded on first use
+    assert state._thaw(_TemplateRegistry.get("foobar")) == _one_test_template
+    assert state._thaw(_TemplateRegistry._templates["foobar"]) == _one_test_template
+
+    # register using custom name
+    _TemplateRegistry._reset()
+    assert _TemplateRegistry.index(yaml_path, name="custom") == "custom"
+    assert dict(_TemplateRegistry.items()) == {"custom": _one_test_template}
+
+    # invalid templates raise when they are loaded
+    bad_path = tmp_path / "bad.yaml"
+    bad_path.write_text("name: bad\nurl: some-url\n")
+    _TemplateRegistry._reset()
+    _TemplateRegistry.index(bad_path)
+    with pytest.raises(exceptions.TemplateError):
+        _TemplateRegistry.get("bad")
+
+
+def test_template_file_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("REPROENV_CACHE_DIR", str(cache_dir))
+    _TemplateRegistry._reset()
+
+    _one_test_template: types.TemplateType = {
+        "name": "foobar",
+        "url": "some-url",
+        "binaries": {"urls": {"1.0.0": "foobar.com"}, "instructions": "foobar"},
+    }
+    yaml_path = tmp_path / "foo.yaml"
+    with yaml_path.open("w") as f:
+        yaml.dump(_one_test_template, f)
+
+    # first load parses the file and writes the cache
+    _TemplateRegistry.register(yaml_path)
+    assert len(list(cache_dir.glob("*.marshal"))) == 1
+    assert _TemplateRegistry.derived("foobar", "n_urls", lambda t: 1) == 1
+
+    # unchanged file is loaded from the cache, including derived values
+    def fail(*args, **kwds):
+        raise AssertionError("template should be loaded from the cache")
+
+    monkeypatch.setattr(yaml, "load", fail)
+    monkeypatch.setattr(state, "_validate_template", fail)
+    _TemplateRegistry._reset()
+    assert _TemplateRegistry.register(yaml_path) == _one_test_template
+    assert _TemplateRegistry.derived("foobar", "n_urls", fail) == 1
+    _TemplateRegistry._reset()
+    _TemplateRegistry.index(yaml_path)
+    assert state._thaw(_TemplateRegistry.get("foobar")) == _one_test_template
+    monkeypatch.undo()
+
+    # changed file is parsed again
+    monkeypatch.setenv("REPROENV_CACHE_DIR", str(cache_dir))
+    _one_test_template["binaries"]["urls"]["2.0.0"] = "foobar.com"
+    with yaml_path.open("w") as f:
+        yaml.dump(_one_test_template, f)
+    _TemplateRegistry._reset()
+    assert _TemplateRegistry.register(yaml_path) == _one_test_template
+    assert _TemplateRegistry.derived("foobar", "n_urls", lambda t: 2) == 2
+
+    # cache can be disabled
+    monkeypatch.setenv("REPROENV_CACHE_DIR", "")
+    assert state._get_cache_dir() is None
+    _TemplateRegistry._reset()
+    assert _TemplateRegistry.register(yaml_path) == _one_test_template
+
+
+def test_register_many(tmp_path: Path):
+    _TemplateRegistry._reset()
+
+    templates: list[types.TemplateType] = [
+        {
+            "name": f"foobar{i}",
+            "url": "some-url",
+            "binaries": {"urls": {"1.0.0": "foobar.com"}, "instructions": "foobar"},
+        }
+        for i in range(4)
+    ]
+    yaml_path = tmp_path / "foo.yaml"
+    with yaml_path.open("w") as f:
+        yaml.dump(templates[0], f)
+
+    names = _TemplateRegistry.register_many([yaml_path] + templates[1:])
+    assert names == ["foobar0", "foobar1", "foobar2", "foobar3"]
+    assert dict(_TemplateRegistry.items()) == {t["name"]: t for t in templates}
+
+    # nothing is registered if one template is invalid
+    _TemplateRegistry._reset()
+    with pytest.raises(exceptions.TemplateError):
+        _TemplateRegistry.register_many(templates + [{"name": "bad", "url": ""}])
+    assert _TemplateRegistry.keys() == set()
+
+
+def test_validate_renderer():
+    _TemplateRegistry._reset()
+    _TemplateRegistry.register(
+        {
+            "name": "foobar",
+            "url": "some-url",
+            "binaries": {"urls": {"1.0.0": "foobar.com"}, "instructions": "foobar"},
+        },
+        name="foobar",
+    )
+    d = {
+        "pkg_manager": "apt",
+        "instructions": [
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            {"name": "foobar", "kwds": {"version": "1.0.0"}},
+        ],
+    }
+    _validate_renderer(d)
+
+    with pytest.raises(exceptions.RendererError, match="'pkg_manager' is a required"):
+        _validate_renderer({"instructions": d["instructions"]})
+    with pytest.raises(exceptions.RendererError, match="'base_image' is a required"):
+        _validate_renderer(
+            {"pkg_manager": "apt", "instructions": [{"name": "from_", "kwds": {}}]}
+        )
+    with pytest.raises(exceptions.RendererError, match="unknown instruction or templ"):
+        _validate_renderer(
+            {"pkg_manager": "apt", "instructions": [{"name": "baz", "kwds": {}}]}
+        )
+    with pytest.raises(exceptions.RendererError, match="'baz' was unexpected"):
+        _validate_renderer(
+            {
+                "pkg_manager": "apt",
+                "instructions": [{"name": "foobar", "kwds": {}, "baz": 1}],
+            }
+        )
+
+
 def test_get():
     _TemplateRegistry._reset()
 
@@ -329,7 +587,7 @@ def test_get():
 
     d = {"name": "foo"}
     _TemplateRegistry._templates["foobar"] = d
-    assert _TemplateRegistry.get("foobar") == d
+    assert state._thaw(_TemplateRegistry.get("foobar")) == d
 
     with pytest.raises(exceptions.TemplateNotFound):
         _TemplateRegistry.get("baz")
@@ -1,6 +1,7 @@
 import pytest
 
 from neurodocker.reproenv import exceptions, template, types
+from neurodocker.reproenv.state import _thaw
 
 
 def test_template():
@@ -55,9 +56,14 @@ def test_template():
     assert t.source.boo == d["source"]["arguments"]["optional"]["boo"]
 
     assert t.name == d["name"]
-    assert t.binaries._template == d["binaries"]
-    assert t.source._template == d["source"]
-    assert t._template is not d  # check for deepcopy
+    assert _thaw(t.binaries._template) == d["binaries"]
+    assert _thaw(t.source._template) == d["source"]
+    assert t._template is not d  # check for copy
+    # templates are read-only
+    with pytest.raises(TypeError):
+        t._template["name"] = "baz"  # type: ignore[index]
+    # frozen templates are shared instead of copied
+    assert template.Template(t._template)._template is t._template
 
     # only contains binaries
     t = template.Template(
@@ -115,7 +121,7 @@ def test_installation_template_base():
     }
 
     it = template._BaseInstallationTemplate(d)
-    assert it._template == d
+    assert _thaw(it._template) == d
     assert it.env == {}
     assert it.instructions == d["instructions"]
     assert it.arguments == {}
@@ -160,6 +166,14 @@ def test_installation_template_base():
     with pytest.raises(exceptions.TemplateError):
         template._BinariesTemplate(d, version="2.0.0").validate_kwds()
 
+    # URLs with checksums
+    sha256 = "0" * 64
+    d["urls"] = {"1.0.0": {"url": "foobar", "sha256": sha256}, "2.0.0": "baz"}
+    it = template._BinariesTemplate(d, name="didi", version="2.0.0")
+    assert it.urls == {"1.0.0": "foobar", "2.0.0": "baz"}
+    assert it.checksums == {"1.0.0": sha256}
+    assert it.versions == {"1.0.0", "2.0.0"}
+
     #
     # Source template
     #
@@ -180,10 +194,10 @@ def test_installation_template_base():
         "dependencies": {"apt": ["curl"], "dpkg": [], "yum": ["python"]},
     }
     it = template._SourceTemplate(d, name="foobar", age=42, height=100)
-    assert it._template == d
+    assert _thaw(it._template) == d
     assert it.env == {"foo": "bar", "cat": "dog"}
     assert it.instructions == d["instructions"]
-    assert it.arguments == d["arguments"]
+    assert _thaw(it.arguments) == d["arguments"]
     assert it.required_arguments == set(d["arguments"]["required"])
     assert it.optional_arguments == d["arguments"]["optional"]
     assert it.dependencies("apt") == d["dependencies"]["apt"]
@@ -194,6 +208,16 @@ def test_installation_template_base():
     assert it.name == "foobar"
     assert it.age == "42"
     assert it.height == "100"
+    # keyword arguments are not stored as instance attributes
+    assert not hasattr(it, "__dict__")
+    with pytest.raises(AttributeError):
+        it.weight
+
+    # keyword arguments cannot shadow attributes
+    with pytest.raises(exceptions.TemplateKeywordArgumentError, match="'urls'"):
+        template._BinariesTemplate({"urls": {}}, urls="foo")
+    with pytest.raises(exceptions.TemplateKeywordArgumentError, match="'_kwds'"):
+        template._SourceTemplate(d, _kwds="foo")
 
 
 def test_template_alert():
@@ -209,3 +233,19 @@ def test_template_alert():
     del d["alert"]
     tmpl = template.Template(d)
     assert tmpl.alert == ""
+
+
+def test_template_urls_with_checksums():
+    d: types.TemplateType = {
+        "name": "testing",
+        "url": "some-url",
+        "binaries": {
+            "urls": {"1.0": {"url": "foo.tar.gz", "sha256": "0" * 64}},
+            "instructions": "do nothing",
+        },
+    }
+    template.Template(d)
+    for url in [{"url": "foo.tar.gz"}, {"url": "foo.tar.gz", "sha256": "0"}]:
+        d["binaries"]["urls"]["1.0"] = url
+        with pytest.raises(exceptions.TemplateError):
+            template.Template(d)
@@ -2,9 +2,7 @@
 
 from __future__ import annotations
 
-from typing import Mapping, TypedDict
-
-from typing_extensions import Literal
+from typing import Literal, Mapping, TypedDict, Union
 
 # The path to the JSON file within the container, which contains the information of
 # how the container was generated. The contents of the JSON file conform to the
@@ -14,12 +12,22 @@ from typing_extensions import Literal
 # renderer dictionary, so compatibility is not guaranteed.
 REPROENV_SPEC_FILE_IN_CONTAINER = "/.reproenv.json"
 
+# The label that holds the fingerprint of the renderer that generated the container,
+# if the renderer adds it.
+REPROENV_FINGERPRINT_LABEL = "org.repronim.reproenv.fingerprint"
+
 allowed_installation_methods = {"binaries", "source"}
 installation_methods_type = Literal["binaries", "source"]
 
 allowed_pkg_managers = {"apt", "yum"}
 pkg_managers_type = Literal["apt", "yum"]
 
+# How the JSON specification is written to `REPROENV_SPEC_FILE_IN_CONTAINER`. With
+# "printf", the indented JSON is escaped and written with `printf`. With "gzip", the
+# compact JSON is compressed, base64-encoded and decoded in the container.
+allowed_spec_encodings = {"printf", "gzip"}
+spec_encodings_type = Literal["printf", "gzip"]
+
 # Cross-reference the dictionary types below with the JSON schemas.
 
 
@@ -56,10 +64,29 @@ class _SourceTemplateType(_BaseTemplateType):
     pass
 
 
-class _BinariesTemplateType(_BaseTemplateType):
+class _BaseBinariesTemplateType(_BaseTemplateType, total=False):
+    """Optional keys of templates for pre-compiled binaries. If `self_contained` is
+    true, the installation only writes to `install_path`, so it can be built in a
+    separate stage of a multi-stage Dockerfile. `runtime_dependencies` are the
+    dependencies that the installed software needs, which are installed in the image
+    in that case.
+    """
+
+    self_contained: bool
+    runtime_dependencies: _InstallationDependenciesType
+
+
+class _PinnedUrlType(TypedDict):
+    """URL of a file with the SHA256 checksum of its content."""
+
+    url: str
+    sha256: str
+
+
+class _BinariesTemplateType(_BaseBinariesTemplateType):
     """Template that defines how to install software from pre-compiled binaries."""
 
-    urls: Mapping[str, str]
+    urls: Mapping[str, Union[str, _PinnedUrlType]]
 
 
 class TemplateType(TypedDict, total=False):